@@ -0,0 +1,112 @@
+"""Бенчмарк обработки citations на длинных ответах.
+
+Сравнивает однопроходную замену маркеров (replace_citation_markers +
+strip_markdown_emphasis) с прежней схемой: срез строки на каждый маркер,
+посимвольное экранирование MarkdownV2 и обратное снятие экранирования
+тремя регулярными выражениями.
+
+Запуск: python benchmarks/bench_citations.py [--size 50000] [--annotations 150]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from citations import (Citation, replace_citation_markers,  # noqa: E402
+                       strip_markdown_emphasis)
+
+
+def legacy_escape_markdown_v2(text: str) -> str:
+    special_chars = r'_*[]()~`>#+-=|{}.!'
+    result = []
+    for char in text:
+        if char in special_chars:
+            result.append('\\')
+        result.append(char)
+    return ''.join(result)
+
+
+def legacy_remove_markdown_formatting(text: str) -> str:
+    result = re.sub(r'\\([_*\[\]()~`>#+=|{}.!-])', r'\1', text)
+    result = re.sub(r'_([^_]+)_', r'\1', result)
+    result = re.sub(r'\*([^*]+)\*', r'\1', result)
+    return result
+
+
+def legacy_process(text: str, citations) -> str:
+    processed_text = text
+    for citation in sorted(citations, key=lambda c: c.start_index, reverse=True):
+        if citation.start_index > 0 and citation.end_index > citation.start_index:
+            processed_text = (
+                processed_text[:citation.start_index] +
+                f"[{citation.index}]" +
+                processed_text[citation.end_index:]
+            )
+    return legacy_remove_markdown_formatting(legacy_escape_markdown_v2(processed_text))
+
+
+def new_process(text: str, citations) -> str:
+    return strip_markdown_emphasis(replace_citation_markers(text, citations))
+
+
+def make_answer(size: int, annotations: int):
+    """Генерирует ответ ~size символов с annotations маркерами вида 【n:m†file】."""
+    rng = random.Random(42)
+    words = ["ответ", "модели", "документ", "пункт", "(см.", "раздел)", "1.2", "*важно*",
+             "_курсив_", "—", "file_search", "база", "знаний", "тариф!", "#тег"]
+    chunks = []
+    citations = []
+    length = 0
+    per_chunk = size // annotations
+    for i in range(1, annotations + 1):
+        body = []
+        body_len = 0
+        while body_len < per_chunk:
+            word = rng.choice(words)
+            body.append(word)
+            body_len += len(word) + 1
+        chunk = " ".join(body) + " "
+        chunks.append(chunk)
+        length += len(chunk)
+        marker = f"【{i}:{rng.randint(0, 9)}†doc_{i % 7}.pdf】"
+        citations.append(Citation(
+            index=i, file_id=f"file-{i % 7}", filename=f"doc_{i % 7}.pdf", quote=None,
+            marker_text=marker, start_index=length, end_index=length + len(marker),
+        ))
+        chunks.append(marker)
+        length += len(marker)
+    return "".join(chunks), citations
+
+
+def bench(func, text, citations, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func(text, citations)
+    return (time.perf_counter() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=50_000)
+    parser.add_argument("--annotations", type=int, default=150)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    text, citations = make_answer(args.size, args.annotations)
+    print(f"answer: {len(text)} chars, {len(citations)} annotations")
+    print(f"outputs identical: {legacy_process(text, citations) == new_process(text, citations)}")
+
+    legacy = bench(legacy_process, text, citations, args.repeat)
+    new = bench(new_process, text, citations, args.repeat)
+    print(f"legacy: {legacy * 1e3:.2f} ms")
+    print(f"single-pass: {new * 1e3:.2f} ms ({legacy / new:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
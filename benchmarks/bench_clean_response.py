@@ -0,0 +1,107 @@
+"""Бенчмарк и проверка эквивалентности utils.clean_response.
+
+Сравнивает ChunkCleaner (правила компилируются один раз, два прохода по
+тексту) с прежней многопроходной реализацией на корпусе ответов с
+маркерами file_search 【n:m†file】 и разнообразными пробелами.
+Скрипт завершается с ошибкой, если результаты хоть раз различаются.
+
+Запуск: python benchmarks/bench_clean_response.py [--responses 300] [--files 40]
+"""
+import argparse
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from utils import ChunkCleaner  # noqa: E402
+
+
+def legacy_clean(response: str, remove_for_files, rewrite_markers: bool) -> str:
+    """Прежний алгоритм: отдельный re.sub на каждый файл и четыре прохода пробелов."""
+    cleaned = response
+
+    if "*" in remove_for_files:
+        cleaned = re.sub(r"【\d+:\d+†[^】]+】", "", cleaned)
+        return cleaned.strip()
+
+    for filename in remove_for_files:
+        filename = filename.strip()
+        if filename:
+            cleaned = re.sub(r"【\d+:\d+†" + re.escape(filename) + r"】", "", cleaned)
+
+    if rewrite_markers:
+        cleaned = re.sub(
+            r"【\d+:\d+†([^】]+)】", lambda m: f" ({m.group(1)}) ", cleaned
+        )
+
+    cleaned = re.sub(r" +", " ", cleaned)
+    cleaned = re.sub(r"\n\s*\n\s*\n", "\n\n", cleaned)
+    cleaned = re.sub(r" +\n", "\n", cleaned)
+    cleaned = re.sub(r"\n +", "\n", cleaned)
+
+    return cleaned.strip()
+
+
+def make_corpus(count: int, filenames, seed: int = 7):
+    """Ответы, похожие на реальные: абзацы, списки, маркеры после предложений."""
+    rng = random.Random(seed)
+    words = ["Тариф", "включает", "доступ", "к", "базе", "знаний", "и", "поддержке.",
+             "Оплата", "(ежемесячно)", "—", "через", "личный", "кабинет:", "1.", "2.",
+             "**важно**", "см.", "раздел", "3.4", "file.pdf", "10%", "скидка!"]
+    whitespace = [" ", " ", " ", "  ", "\n", "\n\n", "\n\n\n", " \n", "\n  ", "\t", " \n \n \n "]
+    corpus = []
+    for _ in range(count):
+        parts = []
+        for _ in range(rng.randint(50, 400)):
+            parts.append(rng.choice(words))
+            if rng.random() < 0.08:
+                parts.append(f"【{rng.randint(0, 20)}:{rng.randint(0, 9)}†{rng.choice(filenames)}】")
+            parts.append(rng.choice(whitespace))
+        corpus.append("".join(parts))
+    return corpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--responses", type=int, default=300)
+    parser.add_argument("--files", type=int, default=40, help="файлов в REMOVE_CHUNKS_FOR_FILES")
+    args = parser.parse_args()
+
+    filenames = [f"doc_{i}.pdf" for i in range(args.files * 2)]
+    corpus = make_corpus(args.responses, filenames)
+    total_chars = sum(len(text) for text in corpus)
+    print(f"corpus: {len(corpus)} responses, {total_chars} chars")
+
+    configs = [
+        (["*"], True),
+        (filenames[:args.files], True),
+        (filenames[:args.files], False),
+        ([""], True),
+    ]
+    mismatches = 0
+    for remove_for_files, rewrite_markers in configs:
+        cleaner = ChunkCleaner(remove_for_files, rewrite_markers)
+        label = "*" if "*" in remove_for_files else f"{len(remove_for_files)} files"
+
+        started = time.perf_counter()
+        expected = [legacy_clean(text, remove_for_files, rewrite_markers) for text in corpus]
+        legacy = time.perf_counter() - started
+
+        started = time.perf_counter()
+        actual = [cleaner.clean(text) for text in corpus]
+        new = time.perf_counter() - started
+
+        diff = sum(a != b for a, b in zip(expected, actual))
+        mismatches += diff
+        print(f"[{label}, markers={rewrite_markers}] legacy: {legacy * 1e3:.1f} ms, "
+              f"compiled: {new * 1e3:.1f} ms ({legacy / new:.1f}x), mismatches: {diff}")
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
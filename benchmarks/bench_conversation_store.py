@@ -0,0 +1,92 @@
+"""Микробенчмарк TTL-индекса conversations на 1M диалогов.
+
+Сравнивает стоимость update/delete/cleanup в MemoryConversationStore
+с прежней схемой (heapq.heapify на каждое обновление).
+
+Запуск: python benchmarks/bench_conversation_store.py [--size 1000000]
+"""
+import argparse
+import heapq
+import random
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from conversation_store import MemoryConversationStore  # noqa: E402
+
+
+@dataclass
+class _LegacyInfo:
+    """Запись прежней реализации: heap + heapify при обновлении."""
+    last_access: datetime
+
+    def __lt__(self, other):
+        return self.last_access < other.last_access
+
+
+def _per_op(total_seconds: float, ops: int) -> str:
+    return f"{total_seconds / ops * 1e6:.2f} µs/op"
+
+
+def bench_store(size: int, ops: int):
+    store = MemoryConversationStore()
+    base = datetime.now() - timedelta(hours=48)
+
+    started = time.perf_counter()
+    for i in range(size):
+        store.upsert(i % 1000, i, f"resp_{i}", base + timedelta(microseconds=i))
+    print(f"fill {size}: {time.perf_counter() - started:.2f} s")
+
+    keys = [(i % 1000, i) for i in random.sample(range(size), ops)]
+    now = datetime.now()
+    started = time.perf_counter()
+    for chat_id, user_id in keys:
+        store.upsert(chat_id, user_id, "resp_new", now)
+    print(f"update: {_per_op(time.perf_counter() - started, ops)}")
+
+    started = time.perf_counter()
+    for chat_id, user_id in keys[: ops // 2]:
+        store.delete(chat_id, user_id)
+    print(f"delete: {_per_op(time.perf_counter() - started, ops // 2)}")
+
+    # Истекает ~10% самых старых записей
+    cutoff = base + timedelta(microseconds=size // 10)
+    started = time.perf_counter()
+    removed = store.delete_expired(cutoff)
+    elapsed = time.perf_counter() - started
+    print(f"cleanup: {len(removed)} expired in {elapsed * 1e3:.1f} ms "
+          f"({_per_op(elapsed, max(len(removed), 1))}), live={len(store)}")
+
+
+def bench_legacy(size: int, ops: int):
+    base = datetime.now() - timedelta(hours=48)
+    heap = [_LegacyInfo(base + timedelta(microseconds=i)) for i in range(size)]
+    heapq.heapify(heap)
+
+    now = datetime.now()
+    started = time.perf_counter()
+    for item in random.sample(heap, ops):
+        item.last_access = now
+        heapq.heapify(heap)
+    print(f"legacy heapify update: {_per_op(time.perf_counter() - started, ops)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=1_000_000)
+    parser.add_argument("--ops", type=int, default=100_000)
+    parser.add_argument("--legacy-ops", type=int, default=10,
+                        help="обновлений для прежней реализации (0 - пропустить)")
+    args = parser.parse_args()
+
+    bench_store(args.size, args.ops)
+    if args.legacy_ops:
+        bench_legacy(args.size, args.legacy_ops)
+
+
+if __name__ == "__main__":
+    main()
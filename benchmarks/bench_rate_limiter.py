@@ -0,0 +1,138 @@
+"""Микробенчмарк rate limiter на 1M различных пользователей.
+
+Сравнивает SlidingWindowLimiter с прежней схемой (список datetime на
+пользователя, пересоздаваемый на каждое сообщение): время проверки и
+память процесса до и после sweep.
+
+Запуск: python benchmarks/bench_rate_limiter.py [--users 1000000]
+"""
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from rate_limiter import SlidingWindowLimiter  # noqa: E402
+
+WINDOW = 60
+LIMIT = 10
+
+
+def _per_op(total_seconds: float, ops: int) -> str:
+    return f"{total_seconds / ops * 1e6:.2f} µs/op"
+
+
+def _user_check(user_id: int):
+    return [(f"user:{user_id}", LIMIT)]
+
+
+def _all_checks(user_id: int):
+    return [(f"user:{user_id}", LIMIT), (f"chat:{user_id % 1000}", 1000), ("global", 10**9)]
+
+
+def _memory_mib(fill) -> float:
+    """Память, занятая структурой после fill()."""
+    tracemalloc.start()
+    holder = fill()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del holder
+    return memory / 2**20
+
+
+def bench_limiter(users: int, ops: int, make_checks):
+    limiter = SlidingWindowLimiter(WINDOW)
+    now = 1_000_000.0
+
+    started = time.perf_counter()
+    for user_id in range(users):
+        limiter.allow(make_checks(user_id), now)
+    print(f"first message of {users} users: "
+          f"{_per_op(time.perf_counter() - started, users)}, keys={len(limiter)}")
+
+    active = random.sample(range(users), ops)
+    started = time.perf_counter()
+    for user_id in active:
+        limiter.allow(make_checks(user_id), now + 1)
+    print(f"repeat message: {_per_op(time.perf_counter() - started, ops)}")
+
+    # Через два окна без сообщений все ключи устаревают
+    started = time.perf_counter()
+    removed = limiter.sweep(now + 3 * WINDOW)
+    print(f"sweep: {removed} idle keys in {(time.perf_counter() - started) * 1e3:.0f} ms, "
+          f"keys left={len(limiter)}")
+
+
+def bench_limiter_memory(users: int, messages: int):
+    def fill():
+        limiter = SlidingWindowLimiter(WINDOW)
+        for i in range(messages):
+            for user_id in range(users):
+                limiter.allow(_user_check(user_id), 1_000_000.0 + i)
+        return limiter
+
+    print(f"memory for {users} users x {messages} messages: "
+          f"{_memory_mib(fill):.0f} MiB (released by sweep)")
+
+
+def _legacy_check(user_message_times, user_id: int) -> bool:
+    now = datetime.now()
+    window_start = now - timedelta(seconds=WINDOW)
+    user_message_times[user_id] = [t for t in user_message_times[user_id] if t > window_start]
+    if len(user_message_times[user_id]) >= LIMIT:
+        return False
+    user_message_times[user_id].append(now)
+    return True
+
+
+def bench_legacy(users: int, ops: int, messages: int):
+    user_message_times = defaultdict(list)
+
+    started = time.perf_counter()
+    for user_id in range(users):
+        _legacy_check(user_message_times, user_id)
+    print(f"legacy first message: {_per_op(time.perf_counter() - started, users)}")
+
+    active = random.sample(range(users), ops)
+    started = time.perf_counter()
+    for user_id in active:
+        _legacy_check(user_message_times, user_id)
+    print(f"legacy repeat message: {_per_op(time.perf_counter() - started, ops)}")
+
+    def fill():
+        times = defaultdict(list)
+        for _ in range(messages):
+            for user_id in range(users):
+                _legacy_check(times, user_id)
+        return times
+
+    print(f"legacy memory for {users} users x {messages} messages: "
+          f"{_memory_mib(fill):.0f} MiB (never released)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--ops", type=int, default=100_000)
+    parser.add_argument("--messages", type=int, default=3,
+                        help="сообщений на пользователя при замере памяти")
+    parser.add_argument("--skip-legacy", action="store_true")
+    args = parser.parse_args()
+
+    print("-- per-user limit")
+    bench_limiter(args.users, args.ops, _user_check)
+    bench_limiter_memory(args.users, args.messages)
+    print("-- per-user + per-chat + global limits")
+    bench_limiter(args.users, args.ops, _all_checks)
+    if not args.skip_legacy:
+        print("-- legacy list of datetimes")
+        bench_legacy(args.users, args.ops, args.messages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""Заглушка OpenAI Responses и Files API для нагрузочного теста.
+
+Отвечает через заданную задержку текстом заданной длины с annotations
+file_citation; поддерживает stream=True (SSE, часть потоков можно обрывать
+событием response.failed), files.retrieve/list, files.create (тело
+загрузки читается потоком и отбрасывается) и листинг файлов vector store.
+"""
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass
+from itertools import count
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+_WORDS = ("ответ", "документ", "раздел", "пункт", "данные", "источник", "пример", "текст")
+
+
+@dataclass
+class OpenAISettings:
+    latency: float = 1.0            # Средняя задержка ответа (сек)
+    jitter: float = 0.2             # Разброс задержки (доля от latency)
+    answer_chars: int = 1500        # Длина текста ответа
+    annotations: int = 5            # Число file_citation в ответе
+    files: int = 50                 # Размер пула file_id
+    omit_filenames: bool = False    # Без filename - бот вызывает files.retrieve
+    stream_chunks: int = 20         # Число delta-событий при stream=True
+    files_latency: float = 0.05     # Задержка files.retrieve (сек)
+    stream_failure_share: float = 0.0   # Доля потоков, обрываемых на середине
+    other_files: int = 100          # Файлы files.list вне vector store (не прогреваются)
+
+
+class FakeOpenAI:
+    def __init__(self, settings: OpenAISettings):
+        self.settings = settings
+        self.responses = 0
+        self.file_requests = 0
+        self.uploads = 0
+        self.uploaded_bytes = 0
+        self.stream_failures = 0
+        self.vector_store_listings = 0
+        self.file_listings = 0
+        self._ids = count(1)
+
+    async def _delay(self):
+        spread = self.settings.latency * self.settings.jitter
+        await asyncio.sleep(max(self.settings.latency + random.uniform(-spread, spread), 0))
+
+    def _text(self) -> str:
+        words = []
+        length = 0
+        while length < self.settings.answer_chars:
+            word = random.choice(_WORDS)
+            words.append(word)
+            length += len(word) + 1
+        return " ".join(words)[: self.settings.answer_chars]
+
+    def _annotations(self, text: str) -> list:
+        annotations = []
+        for _ in range(self.settings.annotations):
+            file_no = random.randrange(self.settings.files)
+            annotation = {
+                "type": "file_citation",
+                "file_id": f"file-loadtest{file_no:04d}",
+                "index": random.randrange(len(text) + 1),
+            }
+            if not self.settings.omit_filenames:
+                annotation["filename"] = f"document_{file_no}.pdf"
+            annotations.append(annotation)
+        annotations.sort(key=lambda annotation: annotation["index"])
+        return annotations
+
+    def _response(self, text: str, status: str = "completed") -> dict:
+        input_tokens = random.randint(1500, 4000)
+        output_tokens = max(len(text) // 3, 1)
+        return {
+            "id": f"resp_loadtest{next(self._ids)}",
+            "object": "response",
+            "created_at": time.time(),
+            "model": "gpt-loadtest",
+            "status": status,
+            "output": [{
+                "id": f"msg_loadtest{next(self._ids)}",
+                "type": "message",
+                "role": "assistant",
+                "status": status,
+                "content": [{
+                    "type": "output_text",
+                    "text": text,
+                    "annotations": self._annotations(text) if text else [],
+                }],
+            }],
+            "parallel_tool_calls": True,
+            "tool_choice": "auto",
+            "tools": [],
+            "usage": {
+                "input_tokens": input_tokens,
+                "input_tokens_details": {"cached_tokens": input_tokens // 2},
+                "output_tokens": output_tokens,
+                "output_tokens_details": {"reasoning_tokens": 0},
+                "total_tokens": input_tokens + output_tokens,
+            },
+        }
+
+    async def responses_create(self, request: Request):
+        body = await request.json()
+        self.responses += 1
+        if body.get("stream"):
+            return StreamingResponse(self._stream(), media_type="text/event-stream")
+        await self._delay()
+        return JSONResponse(self._response(self._text()))
+
+    async def _stream(self):
+        sequence = count()
+
+        def event(payload: dict) -> str:
+            payload["sequence_number"] = next(sequence)
+            return f"event: {payload['type']}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+        yield event({"type": "response.created", "response": self._response("", "in_progress")})
+        text = self._text()
+        chunks = max(self.settings.stream_chunks, 1)
+        step = max(len(text) // chunks, 1)
+        pause = self.settings.latency / chunks
+        fail_at = (
+            len(text) // 2 if random.random() < self.settings.stream_failure_share else None
+        )
+        for start in range(0, len(text), step):
+            if fail_at is not None and start >= fail_at:
+                self.stream_failures += 1
+                yield event({"type": "response.failed", "response": self._response(
+                    text[:start], "failed"
+                )})
+                return
+            await asyncio.sleep(pause)
+            yield event({
+                "type": "response.output_text.delta",
+                "item_id": "msg_loadtest",
+                "output_index": 0,
+                "content_index": 0,
+                "delta": text[start:start + step],
+                "logprobs": [],
+            })
+        yield event({"type": "response.completed", "response": self._response(text)})
+
+    def _file(self, file_id: str) -> dict:
+        return {
+            "id": file_id,
+            "object": "file",
+            "bytes": 1024,
+            "created_at": int(time.time()),
+            "filename": f"document_{file_id[-4:].lstrip('0') or '0'}.pdf",
+            "purpose": "assistants",
+            "status": "processed",
+        }
+
+    async def files_retrieve(self, request: Request):
+        self.file_requests += 1
+        await asyncio.sleep(self.settings.files_latency)
+        return JSONResponse(self._file(request.path_params["file_id"]))
+
+    async def files_create(self, request: Request):
+        self.uploads += 1
+        size = 0
+        async for chunk in request.stream():
+            size += len(chunk)
+        self.uploaded_bytes += size
+        entry = self._file(f"file-upload{next(self._ids):06d}")
+        entry.update({"bytes": size, "purpose": "user_data"})
+        return JSONResponse(entry)
+
+    async def files_list(self, request: Request):
+        self.file_listings += 1
+        data = [self._file(f"file-loadtest{i:04d}") for i in range(self.settings.files)]
+        data += [self._file(f"file-other{i:04d}") for i in range(self.settings.other_files)]
+        return JSONResponse({"object": "list", "data": data, "has_more": False})
+
+    async def vector_store_files_list(self, request: Request):
+        """Файлы vector store - пул file_id, на которые ссылаются annotations."""
+        self.vector_store_listings += 1
+        vector_store_id = request.path_params["vector_store_id"]
+        data = [
+            {
+                "id": f"file-loadtest{i:04d}",
+                "object": "vector_store.file",
+                "created_at": int(time.time()),
+                "vector_store_id": vector_store_id,
+                "status": "completed",
+                "usage_bytes": 1024,
+                "last_error": None,
+            }
+            for i in range(self.settings.files)
+        ]
+        return JSONResponse({
+            "object": "list",
+            "data": data,
+            "first_id": data[0]["id"] if data else None,
+            "last_id": data[-1]["id"] if data else None,
+            "has_more": False,
+        })
+
+
+def create_app(fake: FakeOpenAI) -> Starlette:
+    return Starlette(routes=[
+        Route("/v1/responses", fake.responses_create, methods=["POST"]),
+        Route("/v1/files", fake.files_list, methods=["GET"]),
+        Route("/v1/files", fake.files_create, methods=["POST"]),
+        Route("/v1/files/{file_id}", fake.files_retrieve, methods=["GET"]),
+        Route(
+            "/v1/vector_stores/{vector_store_id}/files",
+            fake.vector_store_files_list,
+            methods=["GET"],
+        ),
+    ])
@@ -0,0 +1,240 @@
+"""Заглушка Telegram Bot API для нагрузочного теста.
+
+Отдаёт боту сгенерированные сообщения через getUpdates и принимает ответы
+(sendMessage, editMessageText, sendChatAction, deleteMessage), замеряя
+время от постановки сообщения в очередь до первого ответа на него.
+Часть отправок можно отклонять с 429, проверяя обработку flood control.
+Сообщения с документом отдают файл через getFile и /file/bot<token>/...
+"""
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+BOT_USER = {
+    "id": 100000,
+    "is_bot": True,
+    "first_name": "LoadTest",
+    "username": "loadtest_bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False,
+}
+
+_FLOOD_METHODS = {"sendMessage", "editMessageText"}
+
+# Блок отдачи файла
+_FILE_CHUNK = 64 * 1024
+
+
+class FakeTelegram:
+    """Состояние заглушки: очередь обновлений и ожидающие ответа сообщения."""
+
+    def __init__(self, flood_share: float = 0.0):
+        # Доля sendMessage/editMessageText, отклоняемых с 429 (flood control)
+        self.flood_share = flood_share
+        self.updates: asyncio.Queue = asyncio.Queue()
+        self.latencies: List[float] = []
+        self.unanswered = 0
+        # Сообщений в группах, не адресованных боту
+        self.chatter = 0
+        # Сообщений серии, на которые отвечает ответ на последнее сообщение серии
+        self.burst_messages = 0
+        self.requests: Dict[str, int] = defaultdict(int)
+        self._update_id = 0
+        self._message_id = 0
+        # Сообщения без ответа: (chat_id, message_id) -> время отправки боту
+        self._waiting: Dict[Tuple[int, int], float] = {}
+        # Порядок сообщений чата - для ответов без reply_parameters (личные чаты)
+        self._chat_order: Dict[int, Deque[int]] = defaultdict(deque)
+
+    def push_message(
+        self,
+        chat_id: int,
+        user_id: int,
+        text: str,
+        group: bool = False,
+        mention: bool = True,
+        expect_reply: bool = True,
+        document: Optional[Tuple[int, int]] = None,
+    ):
+        """Ставит сообщение пользователя в очередь getUpdates.
+
+        Сообщение в группе без упоминания бота (mention=False) ответа не ждёт,
+        как и сообщение серии, кроме последнего (expect_reply=False).
+        document - (вариант содержимого, размер): PDF с text в подписи.
+        """
+        self._update_id += 1
+        self._message_id += 1
+        chat = (
+            {"id": chat_id, "type": "supergroup", "title": f"Load group {chat_id}"}
+            if group
+            else {"id": chat_id, "type": "private", "first_name": f"user{user_id}"}
+        )
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": chat,
+            "from": {
+                "id": user_id,
+                "is_bot": False,
+                "first_name": f"user{user_id}",
+                "username": f"user{user_id}",
+            },
+            "text": text,
+        }
+        if document is not None:
+            variant, size = document
+            message["document"] = {
+                "file_id": f"doc{self._message_id}_{variant}_{size}",
+                "file_unique_id": f"u{self._message_id}",
+                "file_name": f"file{variant}.pdf",
+                "mime_type": "application/pdf",
+                "file_size": size,
+            }
+            message["caption"] = message.pop("text")
+        if group and not mention:
+            self.chatter += 1
+            self.updates.put_nowait({"update_id": self._update_id, "message": message})
+            return
+        if group:
+            bot_mention = f"@{BOT_USER['username']}"
+            field = "caption" if document is not None else "text"
+            message[field] = f"{bot_mention} {text}"
+            message["caption_entities" if document is not None else "entities"] = [
+                {"type": "mention", "offset": 0, "length": len(bot_mention)}
+            ]
+        if not expect_reply:
+            self.burst_messages += 1
+            self.updates.put_nowait({"update_id": self._update_id, "message": message})
+            return
+
+        self._waiting[(chat_id, self._message_id)] = time.perf_counter()
+        self._chat_order[chat_id].append(self._message_id)
+        self.unanswered += 1
+        self.updates.put_nowait({"update_id": self._update_id, "message": message})
+
+    def _record_answer(self, chat_id: int, reply_to: Optional[int]):
+        order = self._chat_order.get(chat_id)
+        if reply_to is None:
+            # Без reply_parameters ответ относится к самому старому сообщению чата
+            while order and (chat_id, order[0]) not in self._waiting:
+                order.popleft()
+            if not order:
+                return
+            reply_to = order.popleft()
+        sent_at = self._waiting.pop((chat_id, reply_to), None)
+        if sent_at is not None:
+            self.latencies.append(time.perf_counter() - sent_at)
+            self.unanswered -= 1
+
+    def _message(self, chat_id: int, text: str) -> dict:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": text,
+        }
+
+    async def handle(self, request: Request) -> JSONResponse:
+        method = request.path_params["method"]
+        self.requests[method] += 1
+        params = await _read_params(request)
+        if method in _FLOOD_METHODS and random.random() < self.flood_share:
+            self.requests["429"] += 1
+            return JSONResponse(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                },
+                status_code=429,
+            )
+        handler = getattr(self, f"_method_{method}", None)
+        if handler is None:
+            return JSONResponse({"ok": True, "result": True})
+        return JSONResponse({"ok": True, "result": await handler(params)})
+
+    async def _method_getMe(self, params: dict):
+        return BOT_USER
+
+    async def _method_getUpdates(self, params: dict):
+        timeout = float(params.get("timeout") or 0)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), timeout=max(timeout, 0.01)))
+        except asyncio.TimeoutError:
+            return []
+        limit = int(params.get("limit") or 100)
+        while len(updates) < limit and not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    async def _method_sendMessage(self, params: dict):
+        chat_id = int(params["chat_id"])
+        reply_to = params.get("reply_to_message_id")
+        reply_parameters = params.get("reply_parameters")
+        if reply_parameters:
+            if isinstance(reply_parameters, str):
+                reply_parameters = json.loads(reply_parameters)
+            reply_to = reply_parameters.get("message_id")
+        self._record_answer(chat_id, int(reply_to) if reply_to else None)
+        return self._message(chat_id, params.get("text", ""))
+
+    async def _method_editMessageText(self, params: dict):
+        return self._message(int(params["chat_id"]), params.get("text", ""))
+
+    async def _method_getFile(self, params: dict):
+        file_id = params["file_id"]
+        _, variant, size = file_id.split("_")
+        return {
+            "file_id": file_id,
+            "file_unique_id": f"u{file_id}",
+            "file_size": int(size),
+            "file_path": f"documents/{variant}_{size}.pdf",
+        }
+
+    async def download(self, request: Request) -> StreamingResponse:
+        """Содержимое файла: size байт, одинаковых для одного варианта."""
+        self.requests["file"] += 1
+        variant, size = request.path_params["path"].rsplit("/", 1)[-1][:-4].split("_")
+        size = int(size)
+        block = bytes([int(variant) % 256]) * _FILE_CHUNK
+
+        async def body():
+            for start in range(0, size, _FILE_CHUNK):
+                yield block[:min(_FILE_CHUNK, size - start)]
+
+        return StreamingResponse(
+            body(), media_type="application/pdf", headers={"Content-Length": str(size)}
+        )
+
+
+async def _read_params(request: Request) -> dict:
+    """Параметры метода Bot API: urlencoded-форма, JSON или query string."""
+    params = dict(request.query_params)
+    content_type = request.headers.get("content-type", "")
+    body = await request.body()
+    if "application/json" in content_type:
+        params.update(json.loads(body))
+    elif body:
+        params.update(parse_qsl(body.decode()))
+    return params
+
+
+def create_app(fake: FakeTelegram) -> Starlette:
+    return Starlette(routes=[
+        Route("/bot{token}/{method}", fake.handle, methods=["GET", "POST"]),
+        Route("/file/bot{token}/{path:path}", fake.download, methods=["GET"]),
+    ])
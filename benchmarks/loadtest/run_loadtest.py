@@ -0,0 +1,329 @@
+"""Нагрузочный тест бота с заглушками Telegram и OpenAI.
+
+Запускает src/bot.py отдельным процессом против локальных заглушек Bot API
+и OpenAI, подаёт --rate сообщений в секунду из --chats чатов в течение
+--duration секунд и печатает пропускную способность, задержку от сообщения
+до первого ответа (p50/p95/p99), задержку event loop и RSS бота (по его
+/metrics).
+
+Запуск из корня репозитория:
+    python benchmarks/loadtest/run_loadtest.py --rate 50 --chats 500 --duration 60
+"""
+import argparse
+import asyncio
+import functools
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import httpx
+import uvicorn
+
+import fake_openai
+import fake_telegram
+
+SRC_DIR = Path(__file__).resolve().parents[2] / "src"
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def _parse_metrics(text: str) -> Dict[str, float]:
+    """Разбирает текстовый формат Prometheus в {имя{метки}: значение}."""
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, _, value = line.rpartition(" ")
+            samples[name] = float(value)
+    return samples
+
+
+def _histogram_quantile(samples: Dict[str, float], name: str, q: float, labels: str = "") -> float:
+    """Квантиль гистограммы по верхним границам корзин."""
+    prefix = f"{name}_bucket{{{labels + ',' if labels else ''}le=\""
+    buckets: List[Tuple[float, float]] = sorted(
+        (float(key[len(prefix):-2]), value)
+        for key, value in samples.items()
+        if key.startswith(prefix)
+    )
+    if not buckets or buckets[-1][1] == 0:
+        return float("nan")
+    target = q * buckets[-1][1]
+    for bound, cumulative in buckets:
+        if cumulative >= target:
+            return bound
+    return float("inf")
+
+
+async def _serve(app, port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(
+        app, host="127.0.0.1", port=port, log_level="critical", lifespan="off"
+    ))
+    asyncio.get_running_loop().create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    return server
+
+
+def _bot_env(args, workdir: Path, telegram_port: int, openai_port: int, http_port: int) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": "123456:loadtest",
+        "OPENAI_API_KEY": "sk-loadtest",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{openai_port}/v1",
+        "TELEGRAM_API_BASE_URL": f"http://127.0.0.1:{telegram_port}",
+        "PROMPT_ID": "pmpt_loadtest",
+        "BOT_MODE": "polling",
+        "HTTP_LISTEN": "127.0.0.1",
+        "HTTP_PORT": str(http_port),
+        "HEALTH_CHECK_ENABLED": "true",
+        "METRICS_PORT": "0",
+        "LOG_DIR": str(workdir / "logs"),
+        "LOCK_DIR": str(workdir / "data"),
+        "RATE_LIMIT_MESSAGES": "1000000",
+        "SENTRY_DSN": "",
+        "RESPONSES_STREAMING": "true" if args.streaming else "false",
+    })
+    if args.prefetch:
+        env.update({
+            "FILE_CACHE_PREFETCH": "true",
+            "FILE_CACHE_VECTOR_STORE_IDS": "vs_loadtest",
+        })
+    for assignment in args.env:
+        key, _, value = assignment.partition("=")
+        env[key] = value
+    return env
+
+
+async def _wait_for_bot(client: httpx.AsyncClient, url: str, bot: subprocess.Popen):
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if bot.poll() is not None:
+            raise RuntimeError(f"Bot exited with code {bot.returncode}")
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("Bot did not become healthy in 30 s")
+
+
+async def _check_prefetch(client: httpx.AsyncClient, metrics_url: str, openai):
+    """Ждёт прогрева кэша имён: в нём ровно файлы vector store, без прочих.
+
+    Имена должны прийти из постраничного files.list, без files.retrieve.
+    """
+    expected = openai.settings.files
+    deadline = time.monotonic() + 30
+    entries = 0.0
+    while time.monotonic() < deadline:
+        samples = _parse_metrics((await client.get(metrics_url)).text)
+        entries = samples.get("bot_file_cache_entries", 0)
+        if entries >= expected:
+            break
+        await asyncio.sleep(0.2)
+    if (entries != expected or openai.vector_store_listings == 0
+            or openai.file_listings == 0 or openai.file_requests != 0):
+        raise RuntimeError(
+            f"File cache prefetch: {entries:.0f} entries, expected {expected} "
+            f"({openai.vector_store_listings} vector store listings, "
+            f"{openai.file_listings} files.list, {openai.file_requests} files.retrieve)"
+        )
+    print(f"prefetch:    {entries:.0f} filenames cached from the vector store, "
+          f"{openai.file_listings} files.list, {openai.file_requests} files.retrieve")
+
+
+async def run(args):
+    telegram = fake_telegram.FakeTelegram(flood_share=args.flood_share)
+    openai = fake_openai.FakeOpenAI(fake_openai.OpenAISettings(
+        latency=args.openai_latency,
+        jitter=args.openai_jitter,
+        answer_chars=args.answer_chars,
+        annotations=args.annotations,
+        omit_filenames=args.resolve_files,
+        stream_failure_share=args.stream_failure_share,
+    ))
+    telegram_port, openai_port, http_port = _free_port(), _free_port(), _free_port()
+    servers = [
+        await _serve(fake_telegram.create_app(telegram), telegram_port),
+        await _serve(fake_openai.create_app(openai), openai_port),
+    ]
+
+    workdir = Path(tempfile.mkdtemp(prefix="bot-loadtest-"))
+    (workdir / "logs").mkdir()
+    bot = subprocess.Popen(
+        [sys.executable, str(SRC_DIR / "bot.py")],
+        cwd=workdir,
+        env=_bot_env(args, workdir, telegram_port, openai_port, http_port),
+    )
+    metrics_url = f"http://127.0.0.1:{http_port}/metrics"
+    rss_samples: List[float] = []
+    lag_samples: List[float] = []
+
+    async with httpx.AsyncClient(timeout=5) as client:
+        try:
+            await _wait_for_bot(client, f"http://127.0.0.1:{http_port}/healthz", bot)
+            print(f"bot ready (pid {bot.pid}, workdir {workdir})")
+            if args.prefetch:
+                await _check_prefetch(client, metrics_url, openai)
+
+            async def sample_metrics():
+                while True:
+                    await asyncio.sleep(1)
+                    try:
+                        samples = _parse_metrics((await client.get(metrics_url)).text)
+                    except httpx.HTTPError:
+                        continue
+                    rss_samples.append(samples.get("process_resident_memory_bytes", 0))
+                    lag_samples.append(samples.get("bot_event_loop_lag_last_seconds", 0))
+
+            sampler = asyncio.create_task(sample_metrics())
+
+            # Равномерная подача сообщений с заданной частотой
+            total = int(args.rate * args.duration)
+            groups = int(args.chats * args.group_share)
+            loop = asyncio.get_running_loop()
+            started = time.perf_counter()
+            for i in range(total):
+                delay = started + i / args.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                chat_no = random.randrange(args.chats)
+                user_id = 1_000_000 + random.randrange(args.chats * 3)
+                text = f"вопрос {random.randrange(args.questions) if args.questions else i}"
+                if chat_no < groups:
+                    push = functools.partial(
+                        telegram.push_message, -1_000_000 - chat_no, user_id, group=True,
+                        mention=random.random() >= args.chatter_share,
+                    )
+                else:
+                    push = functools.partial(
+                        telegram.push_message, 1_000_000 + chat_no, 1_000_000 + chat_no
+                    )
+                if random.random() < args.document_share:
+                    push = functools.partial(
+                        push, document=(random.randrange(args.document_variants),
+                                        args.document_kb * 1024)
+                    )
+                # Вопрос серией сообщений: ответ ожидается на последнее
+                for part in range(args.burst_size - 1):
+                    loop.call_later(
+                        part * args.burst_gap,
+                        functools.partial(push, f"{text} ч.{part + 1}", expect_reply=False),
+                    )
+                loop.call_later((args.burst_size - 1) * args.burst_gap, push, text)
+            sent_seconds = time.perf_counter() - started
+
+            # Ждём последних сообщений серий и ответов на отправленные сообщения
+            await asyncio.sleep((args.burst_size - 1) * args.burst_gap)
+            deadline = time.perf_counter() + args.drain_timeout
+            while telegram.unanswered and time.perf_counter() < deadline:
+                await asyncio.sleep(0.2)
+            elapsed = time.perf_counter() - started
+
+            samples = _parse_metrics((await client.get(metrics_url)).text)
+            sampler.cancel()
+        finally:
+            # Заглушки должны отвечать, пока бот завершает работу
+            bot.terminate()
+            try:
+                await asyncio.to_thread(bot.wait, 60)
+            except subprocess.TimeoutExpired:
+                bot.kill()
+            for server in servers:
+                server.should_exit = True
+
+    latencies = telegram.latencies
+    print(f"\nsent:        {total} msgs in {sent_seconds:.1f} s ({total / sent_seconds:.1f} msg/s)")
+    print(f"answered:    {len(latencies)} ({telegram.unanswered} unanswered, "
+          f"{telegram.chatter} group messages not for the bot, "
+          f"{telegram.burst_messages} earlier messages of bursts), "
+          f"throughput {len(latencies) / elapsed:.1f} msg/s")
+    print(f"latency:     p50 {_percentile(latencies, 0.5):.3f} s, "
+          f"p95 {_percentile(latencies, 0.95):.3f} s, p99 {_percentile(latencies, 0.99):.3f} s")
+    print(f"loop lag:    p50 <= {_histogram_quantile(samples, 'bot_event_loop_lag_seconds', 0.5)} s, "
+          f"p99 <= {_histogram_quantile(samples, 'bot_event_loop_lag_seconds', 0.99)} s, "
+          f"max sampled {max(lag_samples, default=0):.3f} s")
+    print(f"rss:         max {max(rss_samples, default=0) / 2**20:.0f} MiB, "
+          f"final {samples.get('process_resident_memory_bytes', 0) / 2**20:.0f} MiB")
+    print(f"openai:      {openai.responses} responses, {openai.file_requests} files.retrieve, "
+          f"{openai.uploads} files.create ({openai.uploaded_bytes / 2**20:.0f} MiB), "
+          f"{telegram.requests['file']} file downloads")
+    print(f"telegram:    {telegram.requests['sendMessage']} sendMessage, "
+          f"{telegram.requests['429']} rejected with 429, "
+          f"{samples.get('bot_telegram_flood_waits_total', 0):.0f} flood waits in bot, "
+          f"{telegram.requests['deleteMessage']} deleteMessage "
+          f"({openai.stream_failures} failed streams)")
+    print("stages (p50 / p99 upper bound, s):")
+    for stage in ("coalesce", "access", "queue_wait", "attachments", "openai", "citations",
+                  "resolve_filenames", "send_queue", "telegram_send"):
+        labels = f'stage="{stage}"'
+        p50 = _histogram_quantile(samples, "bot_stage_duration_seconds", 0.5, labels)
+        p99 = _histogram_quantile(samples, "bot_stage_duration_seconds", 0.99, labels)
+        print(f"  {stage:<18} {p50} / {p99}")
+    print("http pool wait (p50 / p99 upper bound, s):")
+    for pool in ("openai", "telegram", "telegram_updates", "telegram_files"):
+        labels = f'client="{pool}"'
+        p50 = _histogram_quantile(samples, "bot_http_pool_wait_seconds", 0.5, labels)
+        p99 = _histogram_quantile(samples, "bot_http_pool_wait_seconds", 0.99, labels)
+        print(f"  {pool:<18} {p50} / {p99}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=20, help="сообщений в секунду")
+    parser.add_argument("--chats", type=int, default=200, help="число чатов")
+    parser.add_argument("--duration", type=float, default=30, help="длительность подачи (сек)")
+    parser.add_argument("--group-share", type=float, default=0.2,
+                        help="доля групповых чатов (сообщения с упоминанием бота)")
+    parser.add_argument("--chatter-share", type=float, default=0.0,
+                        help="доля сообщений в группах без упоминания бота")
+    parser.add_argument("--burst-size", type=int, default=1,
+                        help="сообщений в вопросе (серия подряд, ответ - на последнее)")
+    parser.add_argument("--burst-gap", type=float, default=0.2,
+                        help="интервал между сообщениями серии (сек)")
+    parser.add_argument("--questions", type=int, default=0,
+                        help="число различных вопросов (0 - все разные; проверка кэша ответов)")
+    parser.add_argument("--document-share", type=float, default=0.0,
+                        help="доля вопросов с PDF-документом (текст - в подписи)")
+    parser.add_argument("--document-kb", type=int, default=5120, help="размер документа (КБ)")
+    parser.add_argument("--document-variants", type=int, default=10,
+                        help="число различных документов (повторы - проверка дедупликации)")
+    parser.add_argument("--openai-latency", type=float, default=1.0)
+    parser.add_argument("--openai-jitter", type=float, default=0.2)
+    parser.add_argument("--answer-chars", type=int, default=1500)
+    parser.add_argument("--annotations", type=int, default=5)
+    parser.add_argument("--resolve-files", action="store_true",
+                        help="annotations без filename - нагрузка на files.retrieve")
+    parser.add_argument("--streaming", action="store_true", help="RESPONSES_STREAMING=true")
+    parser.add_argument("--prefetch", action="store_true",
+                        help="прогрев кэша имён файлов из vector store заглушки (с проверкой)")
+    parser.add_argument("--stream-failure-share", type=float, default=0.0,
+                        help="доля потоков ответа, обрываемых response.failed на середине")
+    parser.add_argument("--flood-share", type=float, default=0.0,
+                        help="доля sendMessage/editMessageText с ответом 429 retry_after=1")
+    parser.add_argument("--drain-timeout", type=float, default=60)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="дополнительные переменные окружения бота")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
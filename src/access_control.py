@@ -1,33 +1,36 @@
 """Контроль доступа - file lock, rate limiting, проверка разрешений."""
+import asyncio
 import fcntl
 import logging
 import os
 import sys
-from collections import defaultdict
-from datetime import datetime, timedelta
-from typing import Dict, Optional
+from enum import Enum
+from typing import List, Optional, Tuple
 
 from telegram import Message
-from telegram.constants import ChatType
-from telegram.ext import ContextTypes
+from telegram.constants import ChatType, MessageEntityType
 
-from config import (ALLOWED_CHATS, BANNED_CHATS, BANNED_USERS, LOCK_FILE,
-                    RATE_LIMIT_MESSAGES, RATE_LIMIT_WINDOW)
+from config import LOCK_FILE, RATE_LIMIT_WINDOW, WORKER_COUNT, get_settings
+from metrics import STAGE_LATENCY
+from rate_limiter import SlidingWindowLimiter
+from shared_state import SharedRateLimiter
 
 # File lock
 lock_fd: Optional[int] = None
 
-# Rate limiting - хранение времени последних сообщений пользователей
-user_message_times: Dict[int, list] = defaultdict(list)
+# Rate limiting - счётчики по пользователю, чату и боту в целом
+rate_limiter = SlidingWindowLimiter(RATE_LIMIT_WINDOW)
 
-# Глобальная переменная для информации о боте (устанавливается при инициализации)
-bot_info = None
+# В многопроцессном режиме счётчики общие для всех воркеров
+shared_rate_limiter: Optional[SharedRateLimiter] = (
+    SharedRateLimiter() if WORKER_COUNT > 1 else None
+)
 
+# Проверка общего rate limit: транзакция SQLite вне event loop (с ожиданием блокировки)
+_rate_limit_latency = STAGE_LATENCY.labels("rate_limit")
 
-def set_bot_info(info):
-    """Устанавливает информацию о боте."""
-    global bot_info
-    bot_info = info
+# Глобальная переменная для информации о боте (устанавливается при инициализации)
+bot_info = None
 
 
 def acquire_lock():
@@ -59,97 +62,114 @@ def release_lock():
             logging.error(f"Error releasing lock: {e}")
 
 
-def check_rate_limit(user_id: int) -> bool:
-    """Проверяет, не превышен ли лимит сообщений для пользователя.
-    Возвращает True, если сообщение разрешено, False если превышен лимит."""
-    now = datetime.now()
-    window_start = now - timedelta(seconds=RATE_LIMIT_WINDOW)
-
-    # Очищаем старые записи
-    user_message_times[user_id] = [
-        t for t in user_message_times[user_id] if t > window_start
-    ]
+async def sweep_rate_limits():
+    """Удаляет счётчики rate limit неактивных ключей (фоновая задача)."""
+    if shared_rate_limiter is not None:
+        removed = await asyncio.to_thread(shared_rate_limiter.sweep, RATE_LIMIT_WINDOW)
+    else:
+        removed = rate_limiter.sweep()
+    if removed:
+        logging.info(f"Removed {removed} stale rate limit counters")
+
+
+def _rate_limit_checks(user_id: int, chat_id: Optional[int]) -> List[Tuple[str, int]]:
+    settings = get_settings()
+    checks = [(f"user:{user_id}", settings.rate_limit_messages)]
+    if settings.rate_limit_chat_messages > 0 and chat_id is not None:
+        checks.append((f"chat:{chat_id}", settings.rate_limit_chat_messages))
+    if settings.rate_limit_global_messages > 0:
+        checks.append(("global", settings.rate_limit_global_messages))
+    return checks
+
+
+async def check_rate_limit(user_id: int, chat_id: Optional[int] = None) -> bool:
+    """Проверяет лимиты сообщений пользователя, чата и бота в целом.
+    Возвращает True, если сообщение разрешено, False если превышен лимит.
+
+    Общие счётчики воркеров проверяются в отдельном потоке: транзакция
+    ждёт блокировку записи других воркеров (до 5 сек), не останавливая
+    event loop.
+    """
+    checks = _rate_limit_checks(user_id, chat_id)
+    if shared_rate_limiter is not None:
+        with _rate_limit_latency.time():
+            return await asyncio.to_thread(
+                shared_rate_limiter.allow, checks, RATE_LIMIT_WINDOW
+            )
+    return rate_limiter.allow(checks)
 
-    # Проверяем лимит
-    if len(user_message_times[user_id]) >= RATE_LIMIT_MESSAGES:
-        return False
 
-    # Добавляем текущее время
-    user_message_times[user_id].append(now)
-    return True
+class Access(Enum):
+    """Решение по входящему сообщению."""
+    IGNORE = "ignore"              # Не адресовано боту - без ответа
+    ALLOW = "allow"
+    DENIED = "denied"              # Пользователь не в USERS
+    BANNED_USER = "banned_user"
+    BANNED_CHAT = "banned_chat"
 
 
-async def should_bot_respond(
-    message: Message, context: ContextTypes.DEFAULT_TYPE
-) -> bool:
-    """Проверяет, должен ли бот отвечать на это сообщение."""
-    global bot_info
+# Упоминание бота (@username в нижнем регистре), вычисляется один раз
+_bot_mention: Optional[str] = None
 
-    if not message or not message.from_user:
-        logging.warning("Получено сообщение без необходимых атрибутов")
-        return False
 
-    chat_id = message.chat_id if message.chat else None
-    user_id = message.from_user.id if message.from_user else None
-
-    if chat_id is None or user_id is None:
-        logging.warning("Сообщение не содержит chat_id или user_id")
-        return False
+def set_bot_info(info):
+    """Устанавливает информацию о боте."""
+    global bot_info, _bot_mention
+    bot_info = info
+    _bot_mention = f"@{info.username}".casefold()
 
-    # Проверяем бан пользователя
-    if user_id in BANNED_USERS:
-        try:
-            await message.reply_text(
-                f"Вы заблокированы.\n\nПричина: {BANNED_USERS[user_id]}"
-            )
-        except Exception as e:
-            logging.error(f"Ошибка при отправке сообщения о бане: {e}")
-        return False
 
-    # Для личных чатов проверяем бан чата
-    if message.chat and message.chat.type == ChatType.PRIVATE:
-        if chat_id in BANNED_CHATS:
-            try:
-                await message.reply_text(
-                    f"Этот чат заблокирован.\n\nПричина: {BANNED_CHATS[chat_id]}"
-                )
-            except Exception as e:
-                logging.error(f"Ошибка при отправке сообщения о бане чата: {e}")
-            return False
+def _is_addressed_to_bot(message: Message) -> bool:
+    """Ответ на сообщение бота или упоминание @бота в группе."""
+    reply = message.reply_to_message
+    if reply is not None and reply.from_user is not None and reply.from_user.id == bot_info.id:
         return True
-
-    # Проверяем, разрешен ли этот чат
-    if ALLOWED_CHATS != "*" and chat_id not in ALLOWED_CHATS:
+    # Упоминание в тексте или в подписи к фото/документу
+    if message.text is not None:
+        text, entities, parse_entity = message.text, message.entities, message.parse_entity
+    else:
+        text, entities = message.caption or "", message.caption_entities
+        parse_entity = message.parse_caption_entity
+    # Без сущностей mention упоминания нет - текст не просматривается
+    if not entities or _bot_mention not in text.casefold():
         return False
-
-    if not bot_info:
-        logging.error("bot_info не инициализирован")
-        return False
-
-    # Проверяем, является ли сообщение ответом на сообщение бота или есть упоминание
-    is_reply_to_bot = (
-        message.reply_to_message
-        and message.reply_to_message.from_user
-        and message.reply_to_message.from_user.id == bot_info.id
+    return any(
+        entity.type == MessageEntityType.MENTION
+        and parse_entity(entity).casefold() == _bot_mention
+        for entity in entities
     )
 
-    is_mention = False
-    if message.entities:
-        for entity in message.entities:
-            if entity.type == "mention":
-                username = message.text[entity.offset: entity.offset + entity.length]
-                if username.lower() == f"@{bot_info.username.lower()}":
-                    is_mention = True
-                    break
-
-    # Если это обращение к боту и чат забанен, показываем сообщение
-    if (is_reply_to_bot or is_mention) and chat_id in BANNED_CHATS:
-        try:
-            await message.reply_text(
-                f"Этот чат заблокирован.\n\nПричина: {BANNED_CHATS[chat_id]}"
-            )
-        except Exception as e:
-            logging.error(f"Ошибка при отправке сообщения о бане чата: {e}")
-        return False
 
-    return is_reply_to_bot or is_mention
+def check_access(message: Message) -> Tuple[Access, Optional[str]]:
+    """Решает, отвечать ли на сообщение, без I/O.
+
+    Возвращает решение и причину бана. Сообщения в группах, не адресованные
+    боту, отсекаются первыми: их большинство, и на них не тратятся ни
+    проверки списков, ни запись в список чатов.
+    """
+    chat = message.chat
+    user = message.from_user
+    if user is None:
+        return Access.IGNORE, None
+
+    settings = get_settings()
+    if chat.type != ChatType.PRIVATE:
+        if bot_info is None:
+            logging.error("bot_info не инициализирован")
+            return Access.IGNORE, None
+        if not _is_addressed_to_bot(message):
+            return Access.IGNORE, None
+        if settings.allowed_chats is not None and chat.id not in settings.allowed_chats:
+            return Access.IGNORE, None
+
+    reason = settings.banned_users.get(user.id)
+    if reason is not None:
+        return Access.BANNED_USER, reason
+    reason = settings.banned_chats.get(chat.id)
+    if reason is not None:
+        return Access.BANNED_CHAT, reason
+    if settings.users is not None and (
+        user.username is None or user.username.casefold() not in settings.users
+    ):
+        return Access.DENIED, None
+    return Access.ALLOW, None
@@ -0,0 +1,247 @@
+"""Фото и документы пользователей как input_image / input_file Responses API.
+
+Файл скачивается из Telegram потоком в SpooledTemporaryFile (до
+ATTACHMENT_SPOOL_KB в памяти, дальше - на диске) и оттуда же потоком
+загружается в Files API, поэтому память не растёт ни с размером файла, ни
+с числом одновременных загрузок. Загруженный файл запоминается по
+file_unique_id Telegram (повтор не скачивается) и по SHA-256 содержимого
+(тот же файл, отправленный заново, не загружается второй раз). Файлы
+загружаются с expires_after и удаляются OpenAI сами, когда на них уже не
+может сослаться ни запись кэша, ни диалог.
+"""
+import asyncio
+import hashlib
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import IO, Dict, List, Optional, Tuple
+
+import httpx
+from telegram import Bot, Message
+
+import tracing
+from cache import LRUCache
+from config import (ATTACHMENT_CACHE_MAX_SIZE, ATTACHMENT_CACHE_TTL_HOURS,
+                    ATTACHMENT_CONCURRENCY, ATTACHMENT_SPOOL_KB, CONVERSATION_LIFETIME_HOURS,
+                    Settings, get_settings)
+from conversation_manager import UserContent, client
+from http_clients import create_telegram_file_client
+from metrics import STAGE_LATENCY, Counter, GaugeFunction
+
+# Размер блока при скачивании
+_CHUNK_SIZE = 64 * 1024
+
+# Срок хранения файла в Files API (expires_after): 1 час - 30 дней
+_MIN_FILE_TTL = 3600
+_MAX_FILE_TTL = 30 * 24 * 3600
+
+# Файл, взятый из кэша в последний момент записи, должен пережить и диалог,
+# в который он попал (previous_response_id ссылается на его file_id)
+_conversation_ttl = CONVERSATION_LIFETIME_HOURS * 3600
+_file_ttl = min(
+    max((ATTACHMENT_CACHE_TTL_HOURS * 3600) + _conversation_ttl, _MIN_FILE_TTL), _MAX_FILE_TTL
+)
+_cache_ttl = max(_file_ttl - _conversation_ttl, 0)
+
+# Загруженные файлы: "tg:<file_unique_id>" или "sha256:<hash>:<purpose>" ->
+# (file_id OpenAI, момент удаления файла в Files API)
+_uploaded = LRUCache(maxsize=ATTACHMENT_CACHE_MAX_SIZE, ttl=_cache_ttl)
+
+# Загрузки в процессе: "tg:<file_unique_id>" -> future с file_id OpenAI
+_inflight: Dict[str, asyncio.Future] = {}
+
+# Одновременные скачивания и загрузки (каждая держит не больше spool в памяти)
+_semaphore = asyncio.Semaphore(ATTACHMENT_CONCURRENCY)
+
+_download_client: Optional[httpx.AsyncClient] = None
+
+_attachments_latency = STAGE_LATENCY.labels("attachments")
+
+ATTACHMENTS = Counter(
+    "bot_attachments_total",
+    "User files by how they reached the Files API "
+    "(uploaded, cached by Telegram file, duplicate content)",
+    labelnames=("result",),
+)
+GaugeFunction("bot_attachment_cache_entries", "Uploaded files cache size", lambda: len(_uploaded))
+
+
+@dataclass(frozen=True)
+class Attachment:
+    """Файл из сообщения Telegram."""
+    file_id: str                # file_id Telegram (для getFile)
+    file_unique_id: str         # Постоянный ID файла в Telegram
+    mime_type: str
+    file_name: str
+    file_size: Optional[int]    # Размер по данным Telegram (может отсутствовать)
+
+    @property
+    def is_image(self) -> bool:
+        return self.mime_type.startswith("image/")
+
+
+class AttachmentTooLarge(Exception):
+    """Файл без размера в сообщении оказался больше лимита при скачивании."""
+
+
+def message_attachment(message: Message) -> Optional[Attachment]:
+    """Фото (наибольший размер) или документ сообщения; None - файла нет."""
+    if message.photo:
+        photo = message.photo[-1]
+        return Attachment(
+            file_id=photo.file_id,
+            file_unique_id=photo.file_unique_id,
+            mime_type="image/jpeg",
+            file_name=f"{photo.file_unique_id}.jpg",
+            file_size=photo.file_size,
+        )
+    document = message.document
+    if document is not None:
+        return Attachment(
+            file_id=document.file_id,
+            file_unique_id=document.file_unique_id,
+            mime_type=(document.mime_type or "application/octet-stream").lower(),
+            file_name=document.file_name or document.file_unique_id,
+            file_size=document.file_size,
+        )
+    return None
+
+
+def max_attachment_bytes(settings: Settings) -> int:
+    return int(settings.max_attachment_mb * 1024 * 1024)
+
+
+def attachment_error(attachment: Attachment, settings: Settings) -> Optional[str]:
+    """Текст отказа, если файл не проходит ограничения (None - файл подходит)."""
+    if not settings.attachment_types:
+        return "Бот принимает только текстовые сообщения."
+    if attachment.mime_type not in settings.attachment_types:
+        return (
+            "Этот тип файлов не поддерживается. Можно отправить: "
+            f"{', '.join(sorted(settings.attachment_types))}."
+        )
+    if attachment.file_size is not None and attachment.file_size > max_attachment_bytes(settings):
+        return f"Файл слишком большой. Максимум: {settings.max_attachment_mb:g} МБ."
+    return None
+
+
+def _purpose(attachment: Attachment) -> str:
+    return "vision" if attachment.is_image else "user_data"
+
+
+async def _download(
+    bot: Bot, attachment: Attachment, max_bytes: int, out: IO[bytes]
+) -> Tuple[str, int]:
+    """Скачивает файл в out блоками; возвращает SHA-256 и размер."""
+    global _download_client
+    if _download_client is None:
+        _download_client = create_telegram_file_client(ATTACHMENT_CONCURRENCY)
+
+    tg_file = await bot.get_file(attachment.file_id)
+    digest = hashlib.sha256()
+    size = 0
+    async with _download_client.stream("GET", tg_file.file_path) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(_CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_bytes:
+                raise AttachmentTooLarge(
+                    f"Файл слишком большой. Максимум: {max_bytes / 1024 / 1024:g} МБ."
+                )
+            digest.update(chunk)
+            out.write(chunk)
+    out.seek(0)
+    return digest.hexdigest(), size
+
+
+def _remember(key: str, uploaded: Tuple[str, float]):
+    """Кэширует файл, пока он проживёт ещё хотя бы один диалог."""
+    ttl = uploaded[1] - _conversation_ttl - time.time()
+    if ttl > 0:
+        _uploaded.set(key, uploaded, ttl=min(ttl, _cache_ttl))
+
+
+async def _upload(bot: Bot, attachment: Attachment, max_bytes: int) -> Tuple[str, float]:
+    """Скачивает файл и загружает его в Files API, если такого ещё нет."""
+    spool_size = ATTACHMENT_SPOOL_KB * 1024
+    async with _semaphore:
+        with tempfile.SpooledTemporaryFile(max_size=spool_size) as spool:
+            digest, size = await _download(bot, attachment, max_bytes, spool)
+            purpose = _purpose(attachment)
+            content_key = f"sha256:{digest}:{purpose}"
+            cached = _uploaded.get(content_key)
+            if cached is not None:
+                ATTACHMENTS.labels("duplicate").inc()
+                return cached
+
+            # Небольшой файл уже в памяти; больший httpx читает с диска блоками
+            content = spool.read() if size <= spool_size else spool
+            created = await client.files.create(
+                file=(attachment.file_name, content, attachment.mime_type),
+                purpose=purpose,
+                expires_after={"anchor": "created_at", "seconds": _file_ttl},
+            )
+    uploaded = (created.id, time.time() + _file_ttl)
+    _remember(content_key, uploaded)
+    ATTACHMENTS.labels("uploaded").inc()
+    return uploaded
+
+
+async def upload_attachment(bot: Bot, attachment: Attachment, max_bytes: int) -> str:
+    """file_id OpenAI для файла Telegram (скачивание и загрузка - один раз).
+
+    Одновременные запросы одного файла разделяют одну загрузку.
+    """
+    key = f"tg:{attachment.file_unique_id}"
+    cached = _uploaded.get(key)
+    if cached is not None:
+        ATTACHMENTS.labels("cached").inc()
+        return cached[0]
+    future = _inflight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(_upload(bot, attachment, max_bytes))
+        _inflight[key] = future
+        future.add_done_callback(lambda _: _inflight.pop(key, None))
+    # shield: отмена одного ожидающего не отменяет общую загрузку
+    uploaded = await asyncio.shield(future)
+    _remember(key, uploaded)
+    return uploaded[0]
+
+
+def _file_part(attachment: Attachment, file_id: str) -> dict:
+    if attachment.is_image:
+        return {"type": "input_image", "file_id": file_id, "detail": "auto"}
+    return {"type": "input_file", "file_id": file_id}
+
+
+async def build_user_contents(
+    bot: Bot, message_texts: List[str], attachments: List[Optional[Attachment]]
+) -> List[UserContent]:
+    """Содержимое сообщений вопроса: текст и файлы, загруженные в Files API.
+
+    message_texts и attachments - по одному элементу на сообщение Telegram.
+    """
+    max_bytes = max_attachment_bytes(get_settings())
+    files = [attachment for attachment in attachments if attachment is not None]
+    with _attachments_latency.time(), tracing.span("attachments", files=len(files)):
+        file_ids = iter(await asyncio.gather(
+            *(upload_attachment(bot, attachment, max_bytes) for attachment in files)
+        ))
+
+    contents: List[UserContent] = []
+    for text, attachment in zip(message_texts, attachments):
+        if attachment is None:
+            contents.append(text)
+            continue
+        parts = [{"type": "input_text", "text": text}] if text else []
+        parts.append(_file_part(attachment, next(file_ids)))
+        contents.append(parts)
+    return contents
+
+
+async def close_attachments():
+    """Закрывает HTTP-клиент скачивания файлов (при остановке)."""
+    global _download_client
+    if _download_client is not None:
+        await _download_client.aclose()
+        _download_client = None
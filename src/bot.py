@@ -1,22 +1,57 @@
 """Telegram бот с интеграцией OpenAI Responses API."""
+import asyncio
 import logging
 import signal
 import sys
+from typing import Set
 
 import sentry_sdk
 from sentry_sdk.integrations.logging import LoggingIntegration
+from telegram import Update
 from telegram.ext import (Application, ApplicationBuilder, CommandHandler,
-                          ContextTypes, JobQueue, MessageHandler, filters)
+                          ContextTypes, JobQueue, MessageHandler, TypeHandler,
+                          filters)
 
-from access_control import acquire_lock, release_lock, set_bot_info
-from config import (BOT_TOKEN, SENTRY_DSN, SENTRY_ENVIRONMENT,
-                    SENTRY_PROFILES_SAMPLE_RATE, SENTRY_TRACES_SAMPLE_RATE)
-from handlers import chat_manager, get_chat_info, handle_message, reset_conversation
-from conversation_manager import cleanup_old_conversations, clear_all_conversations
-from utils import setup_logging
+from access_control import (acquire_lock, release_lock, set_bot_info,
+                            sweep_rate_limits)
+from attachments import close_attachments
+from citations import (cleanup_file_cache, load_file_cache_snapshot,
+                       refresh_file_cache, save_file_cache_snapshot)
+from cluster import close_cluster_client
+from config import (BOT_MODE, BOT_TOKEN, CHAT_SAVE_INTERVAL,
+                    CONVERSATION_DB_FLUSH_INTERVAL, FILE_CACHE_PREFETCH,
+                    FILE_CACHE_PREFETCH_INTERVAL, FILE_CACHE_VECTOR_STORE_IDS,
+                    RATE_LIMIT_WINDOW, SENTRY_DSN,
+                    SENTRY_ENVIRONMENT, SENTRY_PROFILES_SAMPLE_RATE,
+                    SENTRY_TRACES_SAMPLE_RATE, SETTINGS_RELOAD_INTERVAL,
+                    TELEGRAM_API_BASE_URL,
+                    TOKEN_USAGE_SAVE_INTERVAL,
+                    UPDATE_CONCURRENCY, WEBHOOK_MAX_CONNECTIONS, WEBHOOK_PATH,
+                    WEBHOOK_SECRET_TOKEN, WEBHOOK_URL, WORKER_COUNT,
+                    WORKER_INDEX, WORKER_SECRET, WORKER_URLS, reload_settings,
+                    reload_settings_if_changed)
+from handlers import (assign_request_id, chat_manager, get_chat_info, handle_message,
+                      message_coalescer, request_scheduler, reset_conversation,
+                      token_quota)
+from conversation_manager import (cleanup_old_conversations, clear_all_conversations,
+                                  conversation_store, flush_conversations)
+from http_clients import create_telegram_requests
+from log_pipeline import setup_logging
+from metrics import monitor_event_loop_lag
+from outbox import outbox
+from response_cache import response_cache
+from server import create_metrics_server, create_server
+from tracing import setup_tracing
 
 # Настройка логирования
 setup_logging()
+setup_tracing()
+
+# Сколько ждать завершения принятых запросов при остановке (сек)
+SHUTDOWN_DRAIN_TIMEOUT = 20
+
+# Задачи, запущенные из обработчиков сигналов (ссылка защищает их от сборщика мусора)
+_signal_tasks: Set[asyncio.Task] = set()
 
 
 def sentry_before_send(event, hint):
@@ -56,63 +91,223 @@ async def init_bot(application: Application):
 async def startup(application: Application):
     """Действия при запуске бота."""
     await init_bot(application)
-    logging.info("Очистка локального кэша conversations при запуске...")
-    clear_all_conversations()
+    load_file_cache_snapshot()
+    if FILE_CACHE_PREFETCH and FILE_CACHE_VECTOR_STORE_IDS:
+        application.create_task(refresh_file_cache())
+    response_cache.load_snapshot()
+    if conversation_store.persistent:
+        logging.info(f"Conversations restored from storage: {len(conversation_store)}")
+    else:
+        logging.info("Очистка локального кэша conversations при запуске...")
+        clear_all_conversations()
 
 
-def graceful_shutdown(signum, frame):
-    """Обработчик сигналов для graceful shutdown."""
-    sig_name = signal.Signals(signum).name
-    logging.info(f"Received signal {sig_name}, initiating graceful shutdown...")
+async def shutdown(application: Application):
+    """Действия при остановке бота: финальный flush данных о чатах и conversations."""
+    # Даём уже принятым запросам завершиться до сохранения состояния
+    message_coalescer.flush_all()
+    await request_scheduler.drain(timeout=SHUTDOWN_DRAIN_TIMEOUT)
+    await outbox.close(timeout=SHUTDOWN_DRAIN_TIMEOUT)
+    await chat_manager.flush()
+    logging.info("Chat data flushed on shutdown")
+    await flush_conversations()
+    await token_quota.flush()
+    await save_file_cache_snapshot()
+    await response_cache.save_snapshot()
+    await close_cluster_client()
+    await close_attachments()
 
-    try:
-        chat_manager._save_chats()
-        logging.info("Chat data saved successfully")
-    except Exception as e:
-        logging.error(f"Error saving chat data: {e}")
 
-    release_lock()
+def _reload_on_sighup():
+    task = asyncio.get_running_loop().create_task(reload_settings("SIGHUP"))
+    _signal_tasks.add(task)
+    task.add_done_callback(_signal_tasks.discard)
+
+
+async def run_application(application: Application):
+    """Запускает бота (polling или webhook) и встроенный HTTP-сервер.
+
+    Работает до SIGTERM/SIGINT, затем останавливает получение обновлений,
+    Application и выполняет shutdown (финальный flush данных). SIGHUP
+    перечитывает настройки без остановки.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+    loop.add_signal_handler(signal.SIGHUP, _reload_on_sighup)
+
+    servers = [
+        server
+        for server in (create_server(application), create_metrics_server())
+        if server is not None
+    ]
+
+    async with application:
+        await startup(application)
+        await application.start()
+
+        if BOT_MODE == "webhook" and WORKER_INDEX > 0:
+            # Webhook регистрирует только воркер 0, остальные получают обновления от него
+            logging.info(f"Webhook mode: worker {WORKER_INDEX}/{WORKER_COUNT}")
+        elif BOT_MODE == "webhook":
+            await application.bot.set_webhook(
+                url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET_TOKEN or None,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+            logging.info(f"Webhook mode: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        else:
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            logging.info("Polling mode")
+
+        server_tasks = [asyncio.create_task(server.serve()) for server in servers]
+        lag_task = asyncio.create_task(monitor_event_loop_lag())
+        stop_task = asyncio.create_task(stop_event.wait())
+        await asyncio.wait({*server_tasks, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+        logging.info("Stopping bot...")
+
+        for server in servers:
+            server.should_exit = True
+        stop_task.cancel()
+        lag_task.cancel()
+        await asyncio.gather(*server_tasks)
+
+        if application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+        await shutdown(application)
+
     logging.info("Graceful shutdown completed")
-    sys.exit(0)
+
+
+def validate_worker_config():
+    """Проверяет настройки многопроцессного режима; при ошибке завершает процесс."""
+    if WORKER_COUNT == 1:
+        return
+    errors = []
+    if BOT_MODE != "webhook":
+        errors.append("WORKER_COUNT > 1 requires BOT_MODE=webhook")
+    if not 0 <= WORKER_INDEX < WORKER_COUNT:
+        errors.append(f"WORKER_INDEX must be in [0, {WORKER_COUNT})")
+    if len(WORKER_URLS) != WORKER_COUNT:
+        errors.append("WORKER_URLS must list one URL per worker")
+    if not WORKER_SECRET:
+        errors.append("WORKER_COUNT > 1 requires WORKER_SECRET")
+    for error in errors:
+        logging.error(error)
+    if errors:
+        sys.exit(1)
 
 
 def main():
     """Точка входа в приложение."""
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        logging.error("BOT_MODE=webhook requires WEBHOOK_URL")
+        sys.exit(1)
+    validate_worker_config()
+
     # Получаем блокировку
     acquire_lock()
 
-    # Устанавливаем обработчики сигналов
-    signal.signal(signal.SIGTERM, graceful_shutdown)
-    signal.signal(signal.SIGINT, graceful_shutdown)
-
     try:
+        # Отдельные пулы: долгий getUpdates не занимает соединения отправки
+        send_request, get_updates_request = create_telegram_requests()
         application = (
             ApplicationBuilder()
             .token(BOT_TOKEN)
+            .base_url(f"{TELEGRAM_API_BASE_URL.rstrip('/')}/bot")
+            .base_file_url(f"{TELEGRAM_API_BASE_URL.rstrip('/')}/file/bot")
             .job_queue(JobQueue())
-            .post_init(startup)
-            .connect_timeout(30.0)
-            .read_timeout(30.0)
-            .write_timeout(30.0)
+            .concurrent_updates(UPDATE_CONCURRENCY)
+            .request(send_request)
+            .get_updates_request(get_updates_request)
             .build()
         )
 
         # Регистрация обработчиков
+        # Раньше остальных обработчиков: request_id для записей лога обновления
+        application.add_handler(TypeHandler(Update, assign_request_id), group=-1)
         application.add_handler(CommandHandler("chatinfo", get_chat_info))
         application.add_handler(CommandHandler("reset", reset_conversation))
         application.add_handler(
-            MessageHandler(filters.TEXT & (~filters.COMMAND), handle_message)
+            MessageHandler(
+                (filters.TEXT & ~filters.COMMAND) | filters.PHOTO | filters.Document.ALL,
+                handle_message,
+            )
         )
 
-        # Фоновая задача очистки conversations
+        # Фоновая задача очистки conversations, кэша имён файлов и кэша ответов
         async def cleanup_job(context: ContextTypes.DEFAULT_TYPE):
             await cleanup_old_conversations()
+            await cleanup_file_cache()
+            await response_cache.cleanup()
 
         application.job_queue.run_repeating(cleanup_job, interval=3600)
 
+        # Прогрев кэша имён файлов: при запуске (startup) и затем периодически
+        if FILE_CACHE_PREFETCH and not FILE_CACHE_VECTOR_STORE_IDS:
+            logging.warning("FILE_CACHE_PREFETCH is ignored: FILE_CACHE_VECTOR_STORE_IDS is empty")
+        elif FILE_CACHE_PREFETCH:
+            async def file_cache_prefetch_job(context: ContextTypes.DEFAULT_TYPE):
+                await refresh_file_cache()
+
+            # Первый прогрев - в startup: задача с first=0, добавленная до старта
+            # планировщика, впервые выполнилась бы только через интервал
+            application.job_queue.run_repeating(
+                file_cache_prefetch_job,
+                interval=FILE_CACHE_PREFETCH_INTERVAL,
+                first=FILE_CACHE_PREFETCH_INTERVAL,
+            )
+
+        # Пакетная запись conversations в персистентное хранилище
+        if conversation_store.persistent:
+            async def conversations_flush_job(context: ContextTypes.DEFAULT_TYPE):
+                await flush_conversations()
+
+            application.job_queue.run_repeating(
+                conversations_flush_job, interval=CONVERSATION_DB_FLUSH_INTERVAL
+            )
+
+        # Фоновая запись списка чатов (write-behind)
+        if CHAT_SAVE_INTERVAL > 0:
+            async def chat_flush_job(context: ContextTypes.DEFAULT_TYPE):
+                await chat_manager.flush()
+
+            application.job_queue.run_repeating(
+                chat_flush_job, interval=CHAT_SAVE_INTERVAL
+            )
+
+        # Фоновая запись учёта токенов
+        async def token_usage_flush_job(context: ContextTypes.DEFAULT_TYPE):
+            await token_quota.flush()
+
+        application.job_queue.run_repeating(
+            token_usage_flush_job, interval=TOKEN_USAGE_SAVE_INTERVAL
+        )
+
+        # Перечитывание настроек при изменении .env, SETTINGS_PATH или ACCESS_LIST_PATH
+        if SETTINGS_RELOAD_INTERVAL > 0:
+            async def settings_reload_job(context: ContextTypes.DEFAULT_TYPE):
+                await reload_settings_if_changed()
+
+            application.job_queue.run_repeating(
+                settings_reload_job, interval=SETTINGS_RELOAD_INTERVAL
+            )
+
+        # Очистка счётчиков rate limit неактивных пользователей
+        async def rate_limit_sweep_job(context: ContextTypes.DEFAULT_TYPE):
+            await sweep_rate_limits()
+
+        application.job_queue.run_repeating(
+            rate_limit_sweep_job, interval=max(RATE_LIMIT_WINDOW, 60)
+        )
+
         # Запуск бота
-        application.run_polling()
+        asyncio.run(run_application(application))
     finally:
+        conversation_store.close()
         release_lock()
 
 
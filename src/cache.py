@@ -0,0 +1,111 @@
+"""LRU-кэш с TTL и сохранением снимка на диск."""
+import json
+import logging
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Hashable, List, Optional
+
+from utils import write_file_atomic
+
+
+class LRUCache:
+    """Ограниченный по размеру кэш с TTL записей.
+
+    При превышении maxsize вытесняется давно не использовавшаяся запись.
+    Срок жизни хранится в wall-clock времени, поэтому снимок, сохранённый
+    через save, остаётся корректным после перезапуска. Для каждой записи
+    можно задать свой ttl (например, короткий для негативного кэширования).
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (value, expires_at)
+        self._data: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Возвращает значение или default, если записи нет или она истекла."""
+        entry = self._data.get(key)
+        if entry is not None:
+            if entry[1] > time.time():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Сохраняет значение; ttl по умолчанию берётся из настроек кэша."""
+        self._data[key] = (value, time.time() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def evict_expired(self) -> int:
+        """Удаляет истёкшие записи. Возвращает количество удалённых."""
+        now = time.time()
+        expired = [key for key, (_, expires_at) in self._data.items() if expires_at <= now]
+        for key in expired:
+            del self._data[key]
+        return len(expired)
+
+    def clear(self):
+        self._data.clear()
+
+    def keys(self) -> List[Hashable]:
+        """Ключи записей (включая ещё не удалённые истёкшие), от старых к новым."""
+        return list(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and entry[1] > time.time()
+
+    def dumps(
+        self,
+        encode: Callable[[Any], Any] = lambda value: value,
+        include: Callable[[Any], bool] = lambda value: True,
+    ) -> str:
+        """Сериализует неистёкшие записи в JSON (ключи должны быть строками)."""
+        now = time.time()
+        data = {
+            key: [encode(value), expires_at]
+            for key, (value, expires_at) in self._data.items()
+            if expires_at > now and include(value)
+        }
+        return json.dumps(data, ensure_ascii=False)
+
+    def save(self, path: Path, **kwargs):
+        """Атомарно сохраняет снимок кэша в файл (параметры как у dumps)."""
+        write_file_atomic(path, self.dumps(**kwargs))
+
+    def load(self, path: Path, decode: Callable[[Any], Any] = lambda value: value) -> int:
+        """Загружает снимок, пропуская истёкшие записи. Возвращает количество."""
+        path = Path(path)
+        if not path.exists():
+            return 0
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except Exception as e:
+            logging.error(f"Error loading cache snapshot {path}: {e}")
+            return 0
+
+        now = time.time()
+        loaded = 0
+        for key, (value, expires_at) in sorted(data.items(), key=lambda item: item[1][1]):
+            if expires_at > now:
+                self._data[key] = (decode(value), expires_at)
+                loaded += 1
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return loaded
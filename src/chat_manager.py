@@ -1,10 +1,16 @@
-"""Менеджер чатов - персистентность данных о чатах."""
+"""Менеджер чатов - персистентность данных о чатах (write-behind)."""
+import asyncio
 import json
 import logging
+import threading
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Set
+
+from config import CHAT_SAVE_INTERVAL, CHAT_SAVE_MAX_DIRTY
+from shared_state import open_sqlite
+from utils import write_file_atomic
 
 
 @dataclass
@@ -17,11 +23,52 @@ class ChatInfo:
 
 
 class ChatManager:
-    def __init__(self, file_path: str = "data/chat_list.json"):
+    """Хранит чаты в памяти и сбрасывает их на диск отложенно.
+
+    update_chat только помечает чат как изменённый (O(1)). Запись выполняется
+    в отдельном потоке: по таймеру (flush из job_queue) или досрочно, когда
+    изменилось save_max_dirty чатов. При save_interval=0 данные записываются
+    синхронно на каждое сообщение, как раньше.
+
+    По умолчанию чаты хранятся в JSON-файле. Если задан db_path (общая SQLite
+    в многопроцессном режиме), в базу записываются только изменённые чаты,
+    и воркеры не затирают данные друг друга.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id INTEGER PRIMARY KEY,
+            type TEXT NOT NULL,
+            name TEXT NOT NULL,
+            first_seen TEXT NOT NULL,
+            last_message TEXT NOT NULL
+        );
+    """
+
+    def __init__(
+        self,
+        file_path: str = "data/chat_list.json",
+        save_interval: int = CHAT_SAVE_INTERVAL,
+        save_max_dirty: int = CHAT_SAVE_MAX_DIRTY,
+        db_path: Optional[str] = None,
+    ):
         self.file_path = Path(file_path)
+        self.save_interval = save_interval
+        self.save_max_dirty = save_max_dirty
         self.chats: Dict[int, ChatInfo] = {}
-        self._ensure_file_exists()
-        self._load_chats()
+        self._dirty_ids: Set[int] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        # Один flush за раз: иначе более старый снимок может лечь поверх нового
+        self._flush_lock = asyncio.Lock()
+        self._write_lock = threading.Lock()
+        self._db = None
+        if db_path:
+            self._db = open_sqlite(db_path)
+            self._db.executescript(self._SCHEMA)
+            self._load_chats_from_db()
+        else:
+            self._ensure_file_exists()
+            self._load_chats()
 
     def _ensure_file_exists(self):
         """Создает директорию и файл, если они не существуют"""
@@ -45,22 +92,112 @@ class ChatManager:
         except Exception as e:
             logging.error(f"Error loading chats: {e}")
 
-    def _save_chats(self):
-        """Сохраняет список чатов в файл"""
+    def _load_chats_from_db(self):
+        """Загружает список чатов из общей базы"""
         try:
-            data = {
-                str(chat_id): {
-                    "type": info.chat_type,
-                    "name": info.name,
-                    "first_seen": info.first_seen,
-                    "last_message": info.last_message,
-                }
-                for chat_id, info in self.chats.items()
+            rows = self._db.execute(
+                "SELECT chat_id, type, name, first_seen, last_message FROM chats"
+            ).fetchall()
+            for chat_id, chat_type, name, first_seen, last_message in rows:
+                self.chats[chat_id] = ChatInfo(
+                    chat_id=chat_id,
+                    chat_type=chat_type,
+                    name=name,
+                    first_seen=first_seen,
+                    last_message=last_message,
+                )
+        except Exception as e:
+            logging.error(f"Error loading chats: {e}")
+
+    def _write_chats_to_db(self, snapshot: List[ChatInfo]):
+        """Записывает изменённые чаты в общую базу одной транзакцией"""
+        rows = [
+            (info.chat_id, info.chat_type, info.name, info.first_seen, info.last_message)
+            for info in snapshot
+        ]
+        with self._write_lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany(
+                    "INSERT INTO chats (chat_id, type, name, first_seen, last_message) "
+                    "VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (chat_id) DO UPDATE SET "
+                    "type = excluded.type, name = excluded.name, "
+                    "first_seen = MIN(first_seen, excluded.first_seen), "
+                    "last_message = MAX(last_message, excluded.last_message)",
+                    rows,
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _write_chats(self, snapshot: List[ChatInfo]):
+        """Сериализует снимок чатов и атомарно записывает его в файл"""
+        if self._db is not None:
+            self._write_chats_to_db(snapshot)
+            return
+
+        data = {
+            str(info.chat_id): {
+                "type": info.chat_type,
+                "name": info.name,
+                "first_seen": info.first_seen,
+                "last_message": info.last_message,
             }
-            self.file_path.write_text(json.dumps(data, indent=2, ensure_ascii=False))
+            for info in snapshot
+        }
+        with self._write_lock:
+            write_file_atomic(
+                self.file_path, json.dumps(data, indent=2, ensure_ascii=False)
+            )
+
+    def _snapshot(self, dirty_ids: Set[int]) -> List[ChatInfo]:
+        """Чаты для записи: в базу - только изменённые, в файл - все"""
+        if self._db is not None:
+            return [self.chats[chat_id] for chat_id in dirty_ids]
+        return list(self.chats.values())
+
+    def _save_chats(self):
+        """Синхронно сохраняет список чатов (финальный flush)"""
+        dirty_ids, self._dirty_ids = self._dirty_ids, set()
+        try:
+            self._write_chats(self._snapshot(dirty_ids))
         except Exception as e:
+            self._dirty_ids |= dirty_ids
             logging.error(f"Error saving chats: {e}")
 
+    async def flush(self):
+        """Сбрасывает накопленные изменения на диск вне event loop.
+
+        Flush по таймеру и внеочередной выполняются по очереди: снимок
+        берётся после завершения предыдущей записи.
+        """
+        if not self._dirty_ids:
+            return
+        async with self._flush_lock:
+            if not self._dirty_ids:
+                return
+            # Снимок берём в event loop: дальнейшие изменения попадут в следующий flush
+            dirty_ids, self._dirty_ids = self._dirty_ids, set()
+            snapshot = self._snapshot(dirty_ids)
+            try:
+                await asyncio.to_thread(self._write_chats, snapshot)
+            except Exception as e:
+                self._dirty_ids |= dirty_ids
+                logging.error(f"Error saving chats: {e}")
+
+    def _schedule_flush(self):
+        """Запускает внеочередной flush, если он ещё не выполняется"""
+        if self._flush_task and not self._flush_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._save_chats()
+            return
+        self._flush_task = loop.create_task(self.flush())
+
     def update_chat(self, chat_id: int, chat_type: str, name: str):
         """Обновляет информацию о чате или добавляет новый"""
         now = datetime.now().isoformat()
@@ -75,7 +212,12 @@ class ChatManager:
             logging.info(f"New chat discovered: {name} (ID: {chat_id})")
         else:
             self.chats[chat_id].last_message = now
-        self._save_chats()
+
+        self._dirty_ids.add(chat_id)
+        if self.save_interval <= 0:
+            self._save_chats()
+        elif len(self._dirty_ids) >= self.save_max_dirty:
+            self._schedule_flush()
 
     def get_chat_info(self, chat_id: int) -> Optional[ChatInfo]:
         """Возвращает информацию о чате"""
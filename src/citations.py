@@ -1,19 +1,41 @@
 """Обработка citations и annotations из OpenAI Responses API."""
+import asyncio
 import logging
+import re
 from dataclasses import dataclass
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Set, Tuple
+from typing import Dict, List, Optional, Set
 
+from cache import LRUCache
 from config import (
-    CITATIONS_MAX_QUOTE_LENGTH,
-    CITATIONS_SHOW_QUOTES,
-    ENABLE_CITATIONS,
+    FILE_CACHE_MAX_SIZE,
+    FILE_CACHE_NEGATIVE_TTL,
+    FILE_CACHE_SNAPSHOT_PATH,
     FILE_CACHE_TTL_HOURS,
+    FILE_CACHE_VECTOR_STORE_IDS,
+    FILE_RESOLVE_CONCURRENCY,
+    get_settings,
 )
 from conversation_manager import client
+from metrics import STAGE_LATENCY, CounterFunction, GaugeFunction
+import tracing
+from utils import write_file_atomic
 
-# Кэш метаданных файлов: file_id -> (filename, cached_at)
-_file_cache: Dict[str, Tuple[str, datetime]] = {}
+# Кэш метаданных файлов: file_id -> filename (None - файл не удалось получить)
+_file_cache = LRUCache(maxsize=FILE_CACHE_MAX_SIZE, ttl=FILE_CACHE_TTL_HOURS * 3600)
+
+# Запросы files.retrieve в процессе: file_id -> future с именем файла
+_inflight: Dict[str, asyncio.Future] = {}
+
+# Ограничение параллельных запросов files.retrieve
+_resolve_semaphore = asyncio.Semaphore(FILE_RESOLVE_CONCURRENCY)
+
+_MISSING = object()
+
+_resolve_latency = STAGE_LATENCY.labels("resolve_filenames")
+
+CounterFunction("bot_file_cache_hits_total", "Filename cache hits", lambda: _file_cache.hits)
+CounterFunction("bot_file_cache_misses_total", "Filename cache misses", lambda: _file_cache.misses)
+GaugeFunction("bot_file_cache_entries", "Filename cache size", lambda: len(_file_cache))
 
 
 @dataclass
@@ -25,51 +47,134 @@ class Citation:
     quote: Optional[str]    # Цитата (может быть None)
     marker_text: str        # Оригинальный маркер
     start_index: int        # Позиция в тексте
-    end_index: int          # Конец маркера
+    end_index: int          # Конец маркера (== start_index - вставка номера)
 
 
 @dataclass
 class ProcessedResponse:
-    """Обработанный ответ с citations."""
+    """Обработанный ответ с citations (plain text, готов к отправке)."""
     text: str               # Текст с [1], [2] вместо маркеров
     citations: List[Citation]
     footnotes: str          # Готовые сноски
 
 
+def _fallback_filename(file_id: str) -> str:
+    return f"source_{file_id[:8]}"
+
+
+async def _fetch_filename(file_id: str) -> Optional[str]:
+    """Запрашивает имя файла у OpenAI и кэширует результат (включая неудачу)."""
+    async with _resolve_semaphore:
+        try:
+            file_info = await client.files.retrieve(file_id)
+        except Exception as e:
+            logging.warning(f"Failed to retrieve file {file_id}: {e}")
+            _file_cache.set(file_id, None, ttl=FILE_CACHE_NEGATIVE_TTL)
+            return None
+    _file_cache.set(file_id, file_info.filename)
+    return file_info.filename
+
+
 async def get_cached_filename(file_id: str) -> str:
-    """Получает имя файла с кэшированием."""
-    if file_id in _file_cache:
-        filename, cached_at = _file_cache[file_id]
-        if datetime.now() - cached_at < timedelta(hours=FILE_CACHE_TTL_HOURS):
-            return filename
+    """Получает имя файла с кэшированием.
+
+    Одновременные запросы одного file_id разделяют один вызов files.retrieve.
+    """
+    filename = _file_cache.get(file_id, _MISSING)
+    if filename is _MISSING:
+        future = _inflight.get(file_id)
+        if future is None:
+            future = asyncio.ensure_future(_fetch_filename(file_id))
+            _inflight[file_id] = future
+            future.add_done_callback(lambda _: _inflight.pop(file_id, None))
+        # shield: отмена одного ожидающего не отменяет общий запрос
+        filename = await asyncio.shield(future)
+    return filename or _fallback_filename(file_id)
 
+
+async def resolve_filenames(file_ids: Set[str]) -> Dict[str, str]:
+    """Получает имена файлов для набора file_id (параллельно)."""
+    ordered = list(file_ids)
+    cache_misses = sum(1 for file_id in ordered if file_id not in _file_cache)
+    with _resolve_latency.time(), tracing.span(
+        "resolve_filenames", files=len(ordered), cache_misses=cache_misses
+    ):
+        filenames = await asyncio.gather(*(get_cached_filename(f) for f in ordered))
+    return dict(zip(ordered, filenames))
+
+
+async def prefetch_filenames() -> int:
+    """Прогревает кэш имён файлов vector stores из FILE_CACHE_VECTOR_STORE_IDS.
+
+    file_id собираются постраничными листингами vector stores, имена
+    недостающих берутся постранично из files.list(purpose="assistants")
+    (листинг останавливается, как только найдены все). files.retrieve
+    вызывается только для файлов, которых в files.list не оказалось.
+    Возвращает количество имён файлов vector stores в кэше.
+    """
+    wanted: Set[str] = set()
+    for vector_store_id in FILE_CACHE_VECTOR_STORE_IDS:
+        async for vector_store_file in client.vector_stores.files.list(
+            vector_store_id=vector_store_id, limit=100
+        ):
+            wanted.add(vector_store_file.id)
+
+    missing = {file_id for file_id in wanted if file_id not in _file_cache}
+    if missing:
+        async for file_info in client.files.list(purpose="assistants", limit=1000):
+            if file_info.id in missing:
+                _file_cache.set(file_info.id, file_info.filename)
+                missing.discard(file_info.id)
+                if not missing:
+                    break
+    await asyncio.gather(*(get_cached_filename(file_id) for file_id in missing))
+    return sum(1 for file_id in wanted if _file_cache.get(file_id) is not None)
+
+
+async def refresh_file_cache():
+    """Фоновое обновление кэша имён файлов из листингов (при старте и по таймеру)."""
     try:
-        file_info = await client.files.retrieve(file_id)
-        filename = file_info.filename
-        _file_cache[file_id] = (filename, datetime.now())
-        return filename
+        cached = await prefetch_filenames()
+        logging.info(f"File cache warmed: {cached} filenames")
     except Exception as e:
-        logging.warning(f"Failed to retrieve file {file_id}: {e}")
-        return f"source_{file_id[:8]}"
+        logging.error(f"Error prefetching filenames: {e}")
 
 
-async def resolve_filenames(file_ids: Set[str]) -> Dict[str, str]:
-    """Получает имена файлов для набора file_id."""
-    result = {}
-    for file_id in file_ids:
-        result[file_id] = await get_cached_filename(file_id)
-    return result
+def load_file_cache_snapshot():
+    """Загружает снимок кэша имён файлов с диска (если включён)."""
+    if not FILE_CACHE_SNAPSHOT_PATH:
+        return
+    loaded = _file_cache.load(FILE_CACHE_SNAPSHOT_PATH)
+    logging.info(f"File cache snapshot loaded: {loaded} entries")
+
+
+async def save_file_cache_snapshot():
+    """Сохраняет кэш имён файлов на диск (негативные записи не сохраняются)."""
+    if not FILE_CACHE_SNAPSHOT_PATH:
+        return
+    try:
+        payload = _file_cache.dumps(include=lambda filename: filename is not None)
+        await asyncio.to_thread(write_file_atomic, FILE_CACHE_SNAPSHOT_PATH, payload)
+    except Exception as e:
+        logging.error(f"Error saving file cache snapshot: {e}")
+
 
+async def cleanup_file_cache():
+    """Удаляет истёкшие записи кэша и обновляет снимок (фоновая задача)."""
+    evicted = _file_cache.evict_expired()
+    if evicted:
+        logging.info(f"Evicted {evicted} expired file cache entries")
+    await save_file_cache_snapshot()
 
-def escape_markdown_v2(text: str) -> str:
-    """Экранирует спецсимволы для MarkdownV2."""
-    special_chars = r'_*[]()~`>#+-=|{}.!'
-    result = []
-    for char in text:
-        if char in special_chars:
-            result.append('\\')
-        result.append(char)
-    return ''.join(result)
+
+# Курсив и жирный из Markdown модели: _текст_ и *текст*
+_ITALIC_RE = re.compile(r'_([^_]+)_')
+_BOLD_RE = re.compile(r'\*([^*]+)\*')
+
+
+def strip_markdown_emphasis(text: str) -> str:
+    """Убирает курсив и жирный Markdown - ответ отправляется plain text."""
+    return _BOLD_RE.sub(r'\1', _ITALIC_RE.sub(r'\1', text))
 
 
 def truncate_quote(quote: str, max_length: int) -> str:
@@ -80,105 +185,145 @@ def truncate_quote(quote: str, max_length: int) -> str:
 
 
 def format_footnotes(citations: List[Citation]) -> str:
-    """Форматирует сноски с курсивными цитатами для MarkdownV2."""
+    """Форматирует сноски с цитатами (plain text)."""
     if not citations:
         return ""
 
-    lines = ["", "\\-\\-\\-", "*Sources:*"]
+    lines = ["", "---", "Sources:"]
+    settings = get_settings()
 
     for c in citations:
-        filename_escaped = escape_markdown_v2(c.filename)
-        line = f"\\[{c.index}\\]: {filename_escaped}"
+        line = f"[{c.index}]: {c.filename}"
 
-        if CITATIONS_SHOW_QUOTES and c.quote:
-            truncated = truncate_quote(c.quote, CITATIONS_MAX_QUOTE_LENGTH)
-            quote_escaped = escape_markdown_v2(truncated)
-            line += f" — _\"{quote_escaped}\"_"
+        if settings.citations_show_quotes and c.quote:
+            truncated = truncate_quote(c.quote, settings.citations_max_quote_length)
+            line += f" — \"{truncated}\""
 
         lines.append(line)
 
     return "\n".join(lines)
 
 
+def replace_citation_markers(text: str, citations: List[Citation]) -> str:
+    """Заменяет маркеры на номера сносок [1], [2]... за один проход.
+
+    Citations обходятся по возрастанию позиции, текст собирается из срезов
+    между маркерами одним join. Пересекающиеся маркеры пропускаются.
+    """
+    parts = []
+    position = 0
+    for citation in sorted(citations, key=lambda c: c.start_index):
+        start, end = citation.start_index, citation.end_index
+        if start <= 0 or end < start or start < position or start > len(text):
+            continue
+        parts.append(text[position:start])
+        parts.append(f"[{citation.index}]")
+        position = end
+    parts.append(text[position:])
+    return "".join(parts)
+
+
+def _collect_annotations(response) -> list:
+    """Собирает annotations из output (у message-элементов - из content)."""
+    annotations = []
+    for item in getattr(response, 'output', None) or []:
+        if hasattr(item, 'annotations'):
+            annotations.extend(item.annotations or [])
+        for content in getattr(item, 'content', None) or []:
+            annotations.extend(getattr(content, 'annotations', None) or [])
+    return annotations
+
+
+def _parse_file_citation(ann) -> Optional[dict]:
+    """Извлекает поля file_citation из annotation обоих форматов.
+
+    Assistants API: ann.file_citation.file_id и маркер [start_index, end_index).
+    Responses API: ann.file_id, ann.filename и позиция вставки ann.index.
+    """
+    if getattr(ann, 'type', None) != "file_citation":
+        return None
+
+    file_citation = getattr(ann, 'file_citation', None)
+    if file_citation:
+        return {
+            "file_id": file_citation.file_id,
+            "filename": None,
+            "quote": getattr(file_citation, 'quote', None),
+            "start_index": getattr(ann, 'start_index', 0),
+            "end_index": getattr(ann, 'end_index', 0),
+        }
+
+    file_id = getattr(ann, 'file_id', None)
+    if file_id:
+        index = getattr(ann, 'index', 0) or 0
+        return {
+            "file_id": file_id,
+            "filename": getattr(ann, 'filename', None),
+            "quote": None,
+            "start_index": index,
+            "end_index": index,
+        }
+    return None
+
+
+async def _plain_response(text: str) -> ProcessedResponse:
+    """Ответ без citations: очистка чанков и Markdown-выделения."""
+    from utils import clean_response
+    cleaned = await clean_response(text)
+    return ProcessedResponse(
+        text=strip_markdown_emphasis(cleaned), citations=[], footnotes=""
+    )
+
+
 async def process_response_with_citations(response) -> ProcessedResponse:
     """Обрабатывает ответ OpenAI Responses API с извлечением citations."""
     # Проверяем, включена ли обработка citations
-    if not ENABLE_CITATIONS:
-        from utils import clean_response
-        cleaned = await clean_response(response.output_text)
-        return ProcessedResponse(text=cleaned, citations=[], footnotes="")
+    if not get_settings().enable_citations:
+        return await _plain_response(response.output_text)
 
     text = response.output_text
 
     # Получаем annotations из response (если есть)
-    # В Responses API структура может отличаться от Assistants API
-    annotations = []
-    if hasattr(response, 'output') and response.output:
-        for item in response.output:
-            if hasattr(item, 'annotations'):
-                annotations.extend(item.annotations or [])
+    annotations = _collect_annotations(response)
+    span = tracing.current_span()
+    if span is not None:
+        span.set("annotations", len(annotations))
 
     # Если нет annotations - fallback к старой логике
     if not annotations:
-        from utils import clean_response
-        cleaned = await clean_response(text)
-        return ProcessedResponse(text=cleaned, citations=[], footnotes="")
+        return await _plain_response(text)
+
+    parsed = [(i, _parse_file_citation(ann), ann) for i, ann in enumerate(annotations, 1)]
+    parsed = [(i, fields, ann) for i, fields, ann in parsed if fields]
 
-    # Собираем уникальные file_id
-    file_ids: Set[str] = set()
-    for ann in annotations:
-        if hasattr(ann, 'type') and ann.type == "file_citation":
-            file_citation = getattr(ann, 'file_citation', None)
-            if file_citation:
-                file_ids.add(file_citation.file_id)
+    # Если citations пусты после фильтрации - fallback
+    if not parsed:
+        return await _plain_response(text)
 
-    # Получаем имена файлов
-    filenames = await resolve_filenames(file_ids)
+    # Получаем имена файлов, которых нет в самих annotations
+    file_ids: Set[str] = {
+        fields["file_id"] for _, fields, _ in parsed if not fields["filename"]
+    }
+    filenames = await resolve_filenames(file_ids) if file_ids else {}
 
     # Создаём citations
-    citations: List[Citation] = []
-    for i, ann in enumerate(annotations, 1):
-        if hasattr(ann, 'type') and ann.type == "file_citation":
-            file_citation = getattr(ann, 'file_citation', None)
-            if file_citation:
-                file_id = file_citation.file_id
-                quote = getattr(file_citation, 'quote', None)
-
-                citations.append(Citation(
-                    index=i,
-                    file_id=file_id,
-                    filename=filenames.get(file_id, "unknown"),
-                    quote=quote,
-                    marker_text=getattr(ann, 'text', ''),
-                    start_index=getattr(ann, 'start_index', 0),
-                    end_index=getattr(ann, 'end_index', 0)
-                ))
-
-    # Если citations пусты после фильтрации - fallback
-    if not citations:
-        from utils import clean_response
-        cleaned = await clean_response(text)
-        return ProcessedResponse(text=cleaned, citations=[], footnotes="")
-
-    # Заменяем маркеры на номера сносок [1], [2]...
-    # Важно: заменять с конца, чтобы не сбить индексы
-    processed_text = text
-    for citation in sorted(citations, key=lambda c: c.start_index, reverse=True):
-        if citation.start_index > 0 and citation.end_index > citation.start_index:
-            processed_text = (
-                processed_text[:citation.start_index] +
-                f"[{citation.index}]" +
-                processed_text[citation.end_index:]
-            )
-
-    # Формируем сноски
-    footnotes = format_footnotes(citations)
-
-    # Экранируем основной текст для MarkdownV2
-    escaped_text = escape_markdown_v2(processed_text)
+    citations: List[Citation] = [
+        Citation(
+            index=i,
+            file_id=fields["file_id"],
+            filename=fields["filename"] or filenames.get(fields["file_id"], "unknown"),
+            quote=fields["quote"],
+            marker_text=getattr(ann, 'text', ''),
+            start_index=fields["start_index"],
+            end_index=fields["end_index"],
+        )
+        for i, fields, ann in parsed
+    ]
+
+    processed_text = replace_citation_markers(text, citations)
 
     return ProcessedResponse(
-        text=escaped_text,
+        text=strip_markdown_emphasis(processed_text),
         citations=citations,
-        footnotes=footnotes
+        footnotes=format_footnotes(citations)
     )
@@ -0,0 +1,68 @@
+"""Многопроцессный режим - распределение чатов по воркерам и пересылка обновлений."""
+import hashlib
+import logging
+from typing import Optional
+
+import httpx
+
+from config import WORKER_COUNT, WORKER_INDEX, WORKER_SECRET, WORKER_URLS
+
+# Путь приёма обновлений, пересланных другим воркером
+INTERNAL_UPDATE_PATH = "/internal/update"
+WORKER_SECRET_HEADER = "X-Worker-Secret"
+
+# HTTP-клиент для пересылки (создаётся при первой пересылке)
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def is_multi_worker() -> bool:
+    return WORKER_COUNT > 1
+
+
+def worker_for_chat(chat_id: int) -> int:
+    """Индекс воркера, владеющего чатом (rendezvous hashing).
+
+    Каждый чат закреплён за одним воркером, поэтому его обновления
+    обрабатываются по порядку в одном процессе. При изменении числа воркеров
+    переезжает только доля чатов, а не все.
+    """
+    def weight(worker: int) -> bytes:
+        return hashlib.blake2b(f"{chat_id}:{worker}".encode(), digest_size=8).digest()
+
+    return max(range(WORKER_COUNT), key=weight)
+
+
+def is_local_chat(chat_id: int) -> bool:
+    """Обрабатывается ли чат этим воркером."""
+    return not is_multi_worker() or worker_for_chat(chat_id) == WORKER_INDEX
+
+
+async def forward_update(chat_id: int, body: bytes) -> bool:
+    """Пересылает исходный JSON обновления воркеру-владельцу чата."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(timeout=10.0)
+
+    worker = worker_for_chat(chat_id)
+    try:
+        response = await _http_client.post(
+            f"{WORKER_URLS[worker]}{INTERNAL_UPDATE_PATH}",
+            content=body,
+            headers={
+                "Content-Type": "application/json",
+                WORKER_SECRET_HEADER: WORKER_SECRET,
+            },
+        )
+        response.raise_for_status()
+        return True
+    except Exception as e:
+        logging.error(f"Failed to forward update for chat={chat_id} to worker {worker}: {e}")
+        return False
+
+
+async def close_cluster_client():
+    """Закрывает HTTP-клиент пересылки (при остановке)."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
@@ -0,0 +1,93 @@
+"""Объединение сообщений, отправленных подряд, в один запрос к OpenAI."""
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from metrics import STAGE_LATENCY
+
+# Тип ключа: (chat_id, user_id)
+ConversationKey = Tuple[int, int]
+
+# Обработчик серии: сообщения серии и время perf_counter первого
+FlushCallback = Callable[[List[Any], float], None]
+
+# Ожидание серии: от первого сообщения до передачи серии дальше
+_coalesce_latency = STAGE_LATENCY.labels("coalesce")
+
+
+class _Burst:
+    __slots__ = ("items", "started", "on_flush", "timer")
+
+    def __init__(self, started: float, on_flush: FlushCallback):
+        self.items: List[Any] = []
+        self.started = started
+        self.on_flush = on_flush
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class MessageCoalescer:
+    """Серии сообщений одного (chat_id, user_id) с окном ожидания.
+
+    Первое сообщение открывает серию, каждое следующее в пределах window
+    секунд от предыдущего продлевает её. Когда окно истекает (или серия
+    набрала max_messages), on_flush получает все сообщения серии и время
+    perf_counter первого - они уходят одним запросом с одним ответом.
+    """
+
+    def __init__(self):
+        self._bursts: Dict[ConversationKey, _Burst] = {}
+        self.coalesced = 0
+
+    def has_pending(self, chat_id: int, user_id: int) -> bool:
+        """Открыта ли серия сообщений пользователя."""
+        return (chat_id, user_id) in self._bursts
+
+    def add(
+        self,
+        chat_id: int,
+        user_id: int,
+        item: Any,
+        window: float,
+        max_messages: int,
+        started: float,
+        on_flush: FlushCallback,
+    ) -> bool:
+        """Добавляет сообщение в серию. False - окно выключено, обработать сразу."""
+        key = (chat_id, user_id)
+        burst = self._bursts.get(key)
+        if burst is None:
+            if window <= 0 or max_messages <= 1:
+                return False
+            burst = self._bursts[key] = _Burst(started, on_flush)
+        else:
+            burst.timer.cancel()
+            self.coalesced += 1
+
+        burst.items.append(item)
+        if len(burst.items) >= max_messages:
+            self._flush(key)
+        else:
+            # Контекст вызова (request_id) - последнего сообщения серии
+            burst.timer = asyncio.get_running_loop().call_later(window, self._flush, key)
+        return True
+
+    def _flush(self, key: ConversationKey):
+        burst = self._bursts.pop(key, None)
+        if burst is None:
+            return
+        burst.timer.cancel()
+        _coalesce_latency.observe(time.perf_counter() - burst.started)
+        try:
+            burst.on_flush(burst.items, burst.started)
+        except Exception as e:
+            logging.error(f"Error handling message burst chat={key[0]}, user={key[1]}: {e}")
+
+    def flush_all(self):
+        """Передаёт дальше все открытые серии (при остановке бота)."""
+        for key in list(self._bursts):
+            self._flush(key)
+
+    def __len__(self) -> int:
+        return len(self._bursts)
+
@@ -1,43 +1,200 @@
-"""Конфигурация бота - загрузка переменных окружения и настройки."""
+"""Конфигурация бота - загрузка переменных окружения и настройки.
+
+Параметры запуска (токены, пулы, пути, воркеры) - константы модуля.
+Параметры, которые можно менять без перезапуска (списки доступа, лимиты,
+citations, очистка ответов), собраны в Settings: модули читают текущий
+снимок через get_settings() при каждом использовании, а reload по SIGHUP
+или изменению SETTINGS_PATH атомарно подменяет снимок целиком.
+"""
+import asyncio
 import logging
 import os
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, List, Union
+from typing import Callable, Dict, FrozenSet, List, Mapping, Optional, Tuple
 
-from dotenv import load_dotenv
+from dotenv import dotenv_values, find_dotenv, load_dotenv
 
-load_dotenv()
+# Окружение процесса до .env: при перечитывании оно, как и в load_dotenv,
+# важнее значений из .env
+_PROCESS_ENV = dict(os.environ)
+_DOTENV_PATH = find_dotenv()
+load_dotenv(_DOTENV_PATH)
 
 # Основные настройки
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 PROMPT_ID = os.getenv("PROMPT_ID")  # Prompt из Dashboard (pmpt_xxx)
+# Адрес Bot API (локальный Bot API сервер или заглушка нагрузочного теста);
+# адрес OpenAI задаётся стандартной переменной OPENAI_BASE_URL
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "https://api.telegram.org")
 
-# Настройки доступа
-USERS: Union[str, List[str]] = os.getenv("USERS", "*")
-ALLOWED_CHATS: Union[str, List[int]] = os.getenv("ALLOWED_CHATS", "*")
+# Перечитываемые настройки (формат .env): SETTINGS_PATH - любые параметры
+# Settings, ACCESS_LIST_PATH - только USERS, ALLOWED_CHATS, BANNED_USERS,
+# BANNED_CHATS. Файлы проверяются раз в SETTINGS_RELOAD_INTERVAL сек
+SETTINGS_PATH = os.getenv("SETTINGS_PATH", "")
+ACCESS_LIST_PATH = os.getenv("ACCESS_LIST_PATH", "")
+SETTINGS_RELOAD_INTERVAL = int(os.getenv("SETTINGS_RELOAD_INTERVAL", "30"))
 
 # Настройки conversations
 CONVERSATION_LIFETIME_HOURS = int(os.getenv("CONVERSATION_LIFETIME_HOURS", "24"))
+# Хранилище conversations: memory (сбрасывается при перезапуске) или sqlite
+CONVERSATION_STORE = os.getenv("CONVERSATION_STORE", "memory").lower()
+CONVERSATION_DB_PATH = os.getenv("CONVERSATION_DB_PATH", "data/conversations.db")
+CONVERSATION_DB_BATCH_SIZE = int(os.getenv("CONVERSATION_DB_BATCH_SIZE", "50"))
+CONVERSATION_DB_FLUSH_INTERVAL = int(os.getenv("CONVERSATION_DB_FLUSH_INTERVAL", "5"))
+# Сжатие длинных диалогов: когда контекст ответа (input_tokens) достигает
+# CONVERSATION_COMPACT_TOKENS (0 - выключено), модель пишет краткое содержание
+# диалога, и следующий вопрос начинает новую цепочку с него
+CONVERSATION_COMPACT_TOKENS = int(os.getenv("CONVERSATION_COMPACT_TOKENS", "0"))
+CONVERSATION_SUMMARY_PROMPT = os.getenv(
+    "CONVERSATION_SUMMARY_PROMPT",
+    "Кратко изложи этот диалог для продолжения разговора: о чём спрашивал "
+    "пользователь, какие ответы и факты из документов были даны, что осталось "
+    "нерешённым. Пиши от третьего лица, без вступления.",
+)
+CONVERSATION_SUMMARY_MAX_TOKENS = int(os.getenv("CONVERSATION_SUMMARY_MAX_TOKENS", "1000"))
 
-# Настройки очистки ответов
-REMOVE_CHUNKS_FOR_FILES = os.getenv("REMOVE_CHUNKS_FOR_FILES", "*").split(",")
-REMOVE_CHUNK_MARKERS = os.getenv("REMOVE_CHUNK_MARKERS", "true").lower() == "true"
+# Сохранение списка чатов (write-behind): интервал фоновой записи в секундах
+# (0 - запись на каждое сообщение) и число изменений для внеочередной записи
+CHAT_SAVE_INTERVAL = int(os.getenv("CHAT_SAVE_INTERVAL", "30"))
+CHAT_SAVE_MAX_DIRTY = int(os.getenv("CHAT_SAVE_MAX_DIRTY", "500"))
 
-# Настройки citations (источников)
-ENABLE_CITATIONS = os.getenv("ENABLE_CITATIONS", "true").lower() == "true"
-CITATIONS_SHOW_QUOTES = os.getenv("CITATIONS_SHOW_QUOTES", "true").lower() == "true"
-CITATIONS_MAX_QUOTE_LENGTH = int(os.getenv("CITATIONS_MAX_QUOTE_LENGTH", "200"))
+# Кэш имён файлов для citations
 FILE_CACHE_TTL_HOURS = int(os.getenv("FILE_CACHE_TTL_HOURS", "24"))
+FILE_CACHE_MAX_SIZE = int(os.getenv("FILE_CACHE_MAX_SIZE", "10000"))
+FILE_CACHE_NEGATIVE_TTL = int(os.getenv("FILE_CACHE_NEGATIVE_TTL", "300"))
+FILE_CACHE_SNAPSHOT_PATH = os.getenv("FILE_CACHE_SNAPSHOT_PATH", "")
+FILE_RESOLVE_CONCURRENCY = int(os.getenv("FILE_RESOLVE_CONCURRENCY", "8"))
+# Прогрев кэша имён файлов vector stores при старте и по таймеру (без
+# FILE_CACHE_VECTOR_STORE_IDS прогрев не выполняется)
+FILE_CACHE_PREFETCH = os.getenv("FILE_CACHE_PREFETCH", "false").lower() == "true"
+FILE_CACHE_PREFETCH_INTERVAL = int(os.getenv("FILE_CACHE_PREFETCH_INTERVAL", "3600"))
+FILE_CACHE_VECTOR_STORE_IDS = [
+    vs_id.strip()
+    for vs_id in os.getenv("FILE_CACHE_VECTOR_STORE_IDS", "").split(",")
+    if vs_id.strip()
+]
+
+# Фото и документы пользователей: скачивание и загрузка в Files API
+# одновременно (файлов), размер файла в памяти до сброса во временный файл
+# (КБ), срок кэша уже загруженных файлов (по file_unique_id и SHA-256)
+ATTACHMENT_CONCURRENCY = int(os.getenv("ATTACHMENT_CONCURRENCY", "4"))
+ATTACHMENT_SPOOL_KB = int(os.getenv("ATTACHMENT_SPOOL_KB", "1024"))
+ATTACHMENT_CACHE_TTL_HOURS = int(os.getenv("ATTACHMENT_CACHE_TTL_HOURS", "24"))
+ATTACHMENT_CACHE_MAX_SIZE = int(os.getenv("ATTACHMENT_CACHE_MAX_SIZE", "10000"))
+
+# Кэш ответов на первые вопросы диалога (одинаковые FAQ - без запроса к OpenAI).
+# RESPONSE_CACHE_SIMILARITY > 0 включает поиск похожих вопросов (0.8-0.9)
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+RESPONSE_CACHE_TTL_HOURS = int(os.getenv("RESPONSE_CACHE_TTL_HOURS", "24"))
+RESPONSE_CACHE_MAX_SIZE = int(os.getenv("RESPONSE_CACHE_MAX_SIZE", "1000"))
+RESPONSE_CACHE_MAX_CHARS = int(os.getenv("RESPONSE_CACHE_MAX_CHARS", "300"))
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0"))
+RESPONSE_CACHE_SNAPSHOT_PATH = os.getenv("RESPONSE_CACHE_SNAPSHOT_PATH", "")
+
+# Потоковая выдача ответов (stream=True + редактирование сообщения)
+RESPONSES_STREAMING = os.getenv("RESPONSES_STREAMING", "false").lower() == "true"
 
 # Лимиты и таймауты
-MAX_MESSAGE_LENGTH = int(os.getenv("MAX_MESSAGE_LENGTH", "10000"))
 RESPONSE_TIMEOUT = int(os.getenv("RESPONSE_TIMEOUT", "120"))
-RATE_LIMIT_MESSAGES = int(os.getenv("RATE_LIMIT_MESSAGES", "10"))
+# Окно rate limit меняется только перезапуском: по нему ведутся счётчики
 RATE_LIMIT_WINDOW = int(os.getenv("RATE_LIMIT_WINDOW", "60"))
 
-# File lock
-LOCK_FILE = Path("/app/data/bot.lock")
+# Дневные квоты токенов (в Settings) учитываются в условных токенах:
+# вывод и кэшированный ввод умножаются на свои веса
+TOKEN_OUTPUT_WEIGHT = float(os.getenv("TOKEN_OUTPUT_WEIGHT", "4.0"))
+TOKEN_CACHED_WEIGHT = float(os.getenv("TOKEN_CACHED_WEIGHT", "0.1"))
+# Предварительная оценка запроса: символов на токен и начальная добавка
+# контекста (prompt, история, file_search), дальше уточняется по usage
+TOKEN_ESTIMATE_CHARS = int(os.getenv("TOKEN_ESTIMATE_CHARS", "3"))
+TOKEN_ESTIMATE_OVERHEAD = int(os.getenv("TOKEN_ESTIMATE_OVERHEAD", "2000"))
+TOKEN_USAGE_PATH = os.getenv("TOKEN_USAGE_PATH", "data/token_usage.json")
+TOKEN_USAGE_SAVE_INTERVAL = int(os.getenv("TOKEN_USAGE_SAVE_INTERVAL", "30"))
+
+# Исходящие сообщения Telegram: бюджеты отправки (сообщений в секунду) и запас
+# для коротких всплесков - на бота в целом, на личный чат и на группу
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))
+OUTBOX_GLOBAL_BURST = float(os.getenv("OUTBOX_GLOBAL_BURST", "30"))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+OUTBOX_CHAT_BURST = float(os.getenv("OUTBOX_CHAT_BURST", "3"))
+OUTBOX_GROUP_RATE = float(os.getenv("OUTBOX_GROUP_RATE", "0.33"))
+OUTBOX_GROUP_BURST = float(os.getenv("OUTBOX_GROUP_BURST", "3"))
+# Попыток отправки при сетевых ошибках (RetryAfter повторяется без ограничения)
+OUTBOX_SEND_ATTEMPTS = int(os.getenv("OUTBOX_SEND_ATTEMPTS", "3"))
+
+# Планировщик запросов к OpenAI
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "20"))
+MAX_CONCURRENT_PER_CHAT = int(os.getenv("MAX_CONCURRENT_PER_CHAT", "3"))
+REQUEST_QUEUE_SIZE = int(os.getenv("REQUEST_QUEUE_SIZE", "200"))
+
+# HTTP-клиенты OpenAI и Bot API: размеры пулов соединений, ожидание свободного
+# соединения (сек), время жизни простаивающего keep-alive соединения (сек)
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "20"))
+OPENAI_POOL_TIMEOUT = float(os.getenv("OPENAI_POOL_TIMEOUT", "30"))
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "64"))
+TELEGRAM_UPDATES_POOL_SIZE = int(os.getenv("TELEGRAM_UPDATES_POOL_SIZE", "1"))
+TELEGRAM_POOL_TIMEOUT = float(os.getenv("TELEGRAM_POOL_TIMEOUT", "5"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+# HTTP/2 (нужен пакет h2 из httpx[http2]; без него - HTTP/1.1)
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() == "true"
+
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Встроенный HTTP-сервер (webhook и /healthz). В режиме polling он
+# запускается, только если включён /healthz или /metrics на HTTP_PORT
+HTTP_LISTEN = os.getenv("HTTP_LISTEN", "0.0.0.0")
+HTTP_PORT = int(os.getenv("HTTP_PORT", "8080"))
+HEALTH_CHECK_ENABLED = os.getenv("HEALTH_CHECK_ENABLED", "false").lower() == "true"
+# Отдельный сервер /metrics, по умолчанию доступный только локально
+# (METRICS_PORT=0 - /metrics на HTTP_PORT вместе с webhook)
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+# Сколько обновлений Application обрабатывает одновременно (1 - по порядку)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "1"))
+
+# Многопроцессный режим: WORKER_COUNT воркеров за балансировщиком (только webhook).
+# Чаты распределяются по воркерам, общее состояние - в SQLite на общем томе.
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "1"))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+# Внутренние адреса всех воркеров по порядку индексов, через запятую
+WORKER_URLS = [
+    url.strip().rstrip("/")
+    for url in os.getenv("WORKER_URLS", "").split(",")
+    if url.strip()
+]
+WORKER_SECRET = os.getenv("WORKER_SECRET", "")
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", "data/shared_state.db")
+
+# Каталоги логов и file lock (по умолчанию - пути в Docker-образе)
+LOG_DIR = os.getenv("LOG_DIR", "/app/logs")
+# Формат лога (text или json с request_id), очередь записей и что делать при
+# её переполнении: drop - отбрасывать INFO, block - ждать места
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_QUEUE_POLICY = os.getenv("LOG_QUEUE_POLICY", "drop").lower()
+# Доля INFO-записей одного места в коде, попадающих в лог (первая - всегда)
+LOG_INFO_SAMPLE_RATE = float(os.getenv("LOG_INFO_SAMPLE_RATE", "1.0"))
+LOCK_DIR = Path(os.getenv("LOCK_DIR", "/app/data"))
+
+# File lock (в многопроцессном режиме - отдельный на каждый индекс воркера)
+LOCK_FILE = (
+    LOCK_DIR / "bot.lock"
+    if WORKER_COUNT == 1
+    else LOCK_DIR / f"bot.{WORKER_INDEX}.lock"
+)
+
+# Трассировка этапов обработки сообщения: без SENTRY_DSN - строки JSON в
+# TRACE_EXPORT_PATH (доля TRACE_SAMPLE_RATE); запросы дольше
+# SLOW_REQUEST_THRESHOLD сек пишутся в лог с разбивкой по этапам (0 - нет)
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+SLOW_REQUEST_THRESHOLD = float(os.getenv("SLOW_REQUEST_THRESHOLD", "30"))
 
 # Sentry
 SENTRY_DSN = os.getenv("SENTRY_DSN")
@@ -45,34 +202,261 @@ SENTRY_TRACES_SAMPLE_RATE = float(os.getenv("SENTRY_TRACES_SAMPLE_RATE", "0.1"))
 SENTRY_PROFILES_SAMPLE_RATE = float(os.getenv("SENTRY_PROFILES_SAMPLE_RATE", "0.1"))
 SENTRY_ENVIRONMENT = os.getenv("SENTRY_ENVIRONMENT", "production")
 
-# Парсинг списков банов
-BANNED_USERS: Dict[int, str] = {}
-BANNED_CHATS: Dict[int, str] = {}
 
-banned_users_str = os.getenv("BANNED_USERS", "")
-if banned_users_str:
-    try:
-        for ban_entry in banned_users_str.split(","):
-            if ":" in ban_entry:
-                user_id, reason = ban_entry.strip().split(":", 1)
-                reason = reason.replace("\\n", "\n").strip()
-                BANNED_USERS[int(user_id.strip())] = reason
-    except Exception as e:
-        logging.error(f"Error parsing BANNED_USERS: {e}")
-
-banned_chats_str = os.getenv("BANNED_CHATS", "")
-if banned_chats_str:
+class SettingsError(ValueError):
+    """Недопустимые значения настроек."""
+
+
+# Парсинг списков доступа
+def parse_ban_list(value: str) -> Dict[int, str]:
+    """Разбирает список банов вида "id:причина,id:причина"."""
+    banned: Dict[int, str] = {}
+    for ban_entry in value.split(","):
+        if ":" in ban_entry:
+            entry_id, reason = ban_entry.strip().split(":", 1)
+            banned[int(entry_id.strip())] = reason.replace("\\n", "\n").strip()
+    return banned
+
+
+def parse_users(value: str) -> Optional[FrozenSet[str]]:
+    """Whitelist usernames (без @, в нижнем регистре); None - "*"."""
+    value = value.strip()
+    if value == "*":
+        return None
+    return frozenset(
+        user.strip().lstrip("@").casefold() for user in value.split(",") if user.strip()
+    )
+
+
+def parse_chat_ids(value: str) -> Optional[FrozenSet[int]]:
+    """Whitelist chat_id; None - "*"."""
+    value = value.strip()
+    if value == "*":
+        return None
+    return frozenset(int(chat_id.strip()) for chat_id in value.split(",") if chat_id.strip())
+
+
+# Типы, которые Responses API принимает как input_image и input_file
+DEFAULT_ATTACHMENT_TYPES = frozenset(
+    ("image/jpeg", "image/png", "image/webp", "image/gif", "application/pdf")
+)
+
+
+def parse_mime_types(value: str) -> FrozenSet[str]:
+    """Список MIME-типов через запятую ("image/jpeg,application/pdf")."""
+    types = frozenset(item.strip().lower() for item in value.split(",") if item.strip())
+    for mime_type in types:
+        if "/" not in mime_type:
+            raise ValueError(f"invalid MIME type {mime_type!r}")
+    return types
+
+
+class _EnvReader:
+    """Чтение типизированных значений с накоплением ошибок."""
+
+    def __init__(self, env: Mapping[str, str]):
+        self.env = env
+        self.errors: List[str] = []
+
+    def _parse(self, name: str, default: str, parse: Callable, check=None, hint: str = ""):
+        raw = self.env.get(name)
+        if raw is None or raw == "":
+            raw = default
+        try:
+            value = parse(raw)
+        except (TypeError, ValueError) as e:
+            self.errors.append(f"{name}={raw!r}: {e}")
+            return parse(default)
+        if check is not None and not check(value):
+            self.errors.append(f"{name}={raw!r}: {hint}")
+            return parse(default)
+        return value
+
+    def get_int(self, name: str, default: int, minimum: int = 0) -> int:
+        return self._parse(
+            name, str(default), int, lambda v: v >= minimum, f"must be >= {minimum}"
+        )
+
+    def get_float(self, name: str, default: float, minimum: float = 0.0) -> float:
+        return self._parse(
+            name, str(default), float, lambda v: v >= minimum, f"must be >= {minimum}"
+        )
+
+    def get_bool(self, name: str, default: bool) -> bool:
+        def parse(raw: str) -> bool:
+            lowered = raw.strip().lower()
+            if lowered not in ("true", "false"):
+                raise ValueError("expected true or false")
+            return lowered == "true"
+        return self._parse(name, "true" if default else "false", parse)
+
+    def get(self, name: str, default: str, parse: Callable):
+        return self._parse(name, default, parse)
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Настройки, которые меняются без перезапуска.
+
+    Снимок неизменяем: get_settings() всегда возвращает согласованный набор,
+    а reload подменяет его целиком.
+    """
+
+    # Доступ: None - без ограничения ("*")
+    users: Optional[FrozenSet[str]] = None
+    allowed_chats: Optional[FrozenSet[int]] = None
+    banned_users: Mapping[int, str] = field(default_factory=dict)
+    banned_chats: Mapping[int, str] = field(default_factory=dict)
+
+    # Лимиты сообщений (за окно RATE_LIMIT_WINDOW, 0 - без ограничения)
+    max_message_length: int = 10000
+    # Фото и документы: размер (МБ) и MIME-типы (пусто - файлы не принимаются)
+    max_attachment_mb: float = 20.0
+    attachment_types: FrozenSet[str] = DEFAULT_ATTACHMENT_TYPES
+    rate_limit_messages: int = 10
+    rate_limit_chat_messages: int = 0
+    rate_limit_global_messages: int = 0
+
+    # Дневные квоты токенов OpenAI (сутки по UTC, 0 - без ограничения)
+    token_quota_user_daily: int = 0
+    token_quota_chat_daily: int = 0
+    token_quota_global_daily: int = 0
+
+    # Очистка ответов от маркеров чанков file_search
+    remove_chunks_for_files: Tuple[str, ...] = ("*",)
+    remove_chunk_markers: bool = True
+
+    # Citations (источники)
+    enable_citations: bool = True
+    citations_show_quotes: bool = True
+    citations_max_quote_length: int = 200
+
+    # Интервалы правок сообщения при потоковой выдаче (сек)
+    stream_edit_interval: float = 1.5
+    stream_group_edit_interval: float = 3.0
+
+    # Окно объединения сообщений, отправленных подряд (сек, 0 - выключено)
+    burst_window: float = 0.0
+    burst_private_window: float = 0.0
+    burst_max_messages: int = 5
+
+    @classmethod
+    def from_env(cls, env: Mapping[str, str]) -> "Settings":
+        """Разбирает и проверяет настройки; SettingsError со всеми ошибками."""
+        read = _EnvReader(env)
+        settings = cls(
+            users=read.get("USERS", "*", parse_users),
+            allowed_chats=read.get("ALLOWED_CHATS", "*", parse_chat_ids),
+            banned_users=read.get("BANNED_USERS", "", parse_ban_list),
+            banned_chats=read.get("BANNED_CHATS", "", parse_ban_list),
+            max_message_length=read.get_int("MAX_MESSAGE_LENGTH", 10000, minimum=1),
+            max_attachment_mb=read.get_float("MAX_ATTACHMENT_MB", 20.0),
+            attachment_types=read.get(
+                "ATTACHMENT_TYPES", ",".join(sorted(DEFAULT_ATTACHMENT_TYPES)), parse_mime_types
+            ),
+            rate_limit_messages=read.get_int("RATE_LIMIT_MESSAGES", 10, minimum=1),
+            rate_limit_chat_messages=read.get_int("RATE_LIMIT_CHAT_MESSAGES", 0),
+            rate_limit_global_messages=read.get_int("RATE_LIMIT_GLOBAL_MESSAGES", 0),
+            token_quota_user_daily=read.get_int("TOKEN_QUOTA_USER_DAILY", 0),
+            token_quota_chat_daily=read.get_int("TOKEN_QUOTA_CHAT_DAILY", 0),
+            token_quota_global_daily=read.get_int("TOKEN_QUOTA_GLOBAL_DAILY", 0),
+            remove_chunks_for_files=read.get(
+                "REMOVE_CHUNKS_FOR_FILES", "*", lambda raw: tuple(raw.split(","))
+            ),
+            remove_chunk_markers=read.get_bool("REMOVE_CHUNK_MARKERS", True),
+            enable_citations=read.get_bool("ENABLE_CITATIONS", True),
+            citations_show_quotes=read.get_bool("CITATIONS_SHOW_QUOTES", True),
+            citations_max_quote_length=read.get_int("CITATIONS_MAX_QUOTE_LENGTH", 200, minimum=1),
+            stream_edit_interval=read.get_float("STREAM_EDIT_INTERVAL", 1.5),
+            stream_group_edit_interval=read.get_float("STREAM_GROUP_EDIT_INTERVAL", 3.0),
+            burst_window=read.get_float("BURST_WINDOW", 0.0),
+            burst_private_window=read.get_float("BURST_PRIVATE_WINDOW", 0.0),
+            burst_max_messages=read.get_int("BURST_MAX_MESSAGES", 5, minimum=1),
+        )
+        if read.errors:
+            raise SettingsError("; ".join(read.errors))
+        return settings
+
+
+# Ключи, которые берутся из ACCESS_LIST_PATH
+_ACCESS_LIST_KEYS = ("USERS", "ALLOWED_CHATS", "BANNED_USERS", "BANNED_CHATS")
+
+
+def _settings_env() -> Dict[str, str]:
+    """Окружение для Settings: .env, окружение процесса, SETTINGS_PATH, ACCESS_LIST_PATH."""
+    env: Dict[str, str] = {}
+    if _DOTENV_PATH:
+        env.update({k: v for k, v in dotenv_values(_DOTENV_PATH).items() if v is not None})
+    env.update(_PROCESS_ENV)
+    if SETTINGS_PATH:
+        env.update({k: v for k, v in dotenv_values(SETTINGS_PATH).items() if v is not None})
+    if ACCESS_LIST_PATH and os.path.exists(ACCESS_LIST_PATH):
+        access = dotenv_values(ACCESS_LIST_PATH)
+        env.update({k: access[k] or "" for k in _ACCESS_LIST_KEYS if k in access})
+    return env
+
+
+def load_settings() -> Settings:
+    """Читает настройки из всех источников (блокирующий I/O)."""
+    return Settings.from_env(_settings_env())
+
+
+def settings_files_mtime() -> Tuple[Optional[float], ...]:
+    """Время изменения .env, SETTINGS_PATH и ACCESS_LIST_PATH (None - файла нет)."""
+    mtimes = []
+    for path in (_DOTENV_PATH, SETTINGS_PATH, ACCESS_LIST_PATH):
+        try:
+            mtimes.append(os.stat(path).st_mtime if path else None)
+        except FileNotFoundError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+
+_settings = load_settings()
+_reload_callbacks: List[Callable[[Settings, Settings], None]] = []
+
+
+def get_settings() -> Settings:
+    """Текущий снимок перечитываемых настроек."""
+    return _settings
+
+
+def on_settings_reload(callback: Callable[[Settings, Settings], None]):
+    """Регистрирует callback(old, new), вызываемый после смены настроек."""
+    _reload_callbacks.append(callback)
+    return callback
+
+
+def apply_settings(settings: Settings):
+    """Подменяет текущие настройки и пересобирает зависящие от них структуры."""
+    global _settings
+    old, _settings = _settings, settings
+    for callback in _reload_callbacks:
+        try:
+            callback(old, settings)
+        except Exception as e:
+            logging.error(f"Error applying settings in {callback.__qualname__}: {e}")
+
+
+_settings_mtime = settings_files_mtime()
+
+
+async def reload_settings(reason: str) -> bool:
+    """Перечитывает настройки; при ошибке остаются прежние."""
+    global _settings_mtime
+    _settings_mtime = settings_files_mtime()
     try:
-        for ban_entry in banned_chats_str.split(","):
-            if ":" in ban_entry:
-                chat_id, reason = ban_entry.strip().split(":", 1)
-                reason = reason.replace("\\n", "\n").strip()
-                BANNED_CHATS[int(chat_id.strip())] = reason
-    except Exception as e:
-        logging.error(f"Error parsing BANNED_CHATS: {e}")
-
-# Парсинг списков пользователей и чатов
-if USERS != "*":
-    USERS = [user.strip() for user in USERS.split(",")]
-if ALLOWED_CHATS != "*":
-    ALLOWED_CHATS = [int(chat_id.strip()) for chat_id in ALLOWED_CHATS.split(",")]
+        settings = await asyncio.to_thread(load_settings)
+    except (OSError, SettingsError) as e:
+        logging.error(f"Settings not reloaded ({reason}), keeping current: {e}")
+        return False
+    if settings != _settings:
+        apply_settings(settings)
+        logging.info(f"Settings reloaded ({reason})")
+    return True
+
+
+async def reload_settings_if_changed():
+    """Перечитывает настройки, если изменился один из файлов (фоновая задача)."""
+    if settings_files_mtime() != _settings_mtime:
+        await reload_settings("file changed")
@@ -1,79 +1,190 @@
 """Управление conversations через OpenAI Responses API (previous_response_id)."""
-import heapq
+import asyncio
 import logging
-from dataclasses import dataclass
+import time
 from datetime import datetime, timedelta
-from typing import Dict, Optional, Tuple
+from typing import List, Optional, Union
 
 from openai import AsyncOpenAI
 
-from config import OPENAI_API_KEY, CONVERSATION_LIFETIME_HOURS
+from config import (CONVERSATION_COMPACT_TOKENS, CONVERSATION_LIFETIME_HOURS,
+                    CONVERSATION_SUMMARY_MAX_TOKENS, CONVERSATION_SUMMARY_PROMPT,
+                    OPENAI_API_KEY, PROMPT_ID)
+from conversation_store import create_conversation_store
+from http_clients import create_openai_http_client
+from metrics import STAGE_LATENCY, Counter, GaugeFunction, Histogram
+from tracing import current_span
 
-# OpenAI клиент
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+# OpenAI клиент (пул соединений настраивается в http_clients)
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=create_openai_http_client())
 
-# Тип ключа: (chat_id, user_id)
-ConversationKey = Tuple[int, int]
+# Содержимое сообщения пользователя: текст или части (input_text, input_image...)
+UserContent = Union[str, List[dict]]
 
+# Хранилище conversations (memory или sqlite, см. CONVERSATION_STORE)
+conversation_store = create_conversation_store()
 
-@dataclass
-class ConversationInfo:
-    """Информация о диалоге пользователя."""
-    last_response_id: str  # ID последнего ответа для продолжения диалога
-    last_access: datetime
-    chat_id: int
-    user_id: int
+# Внеочередной flush заполненного буфера хранилища
+_flush_task: Optional[asyncio.Task] = None
 
-    def __lt__(self, other):
-        return self.last_access < other.last_access
+GaugeFunction(
+    "bot_conversations_live", "Conversations with a stored previous_response_id",
+    lambda: len(conversation_store),
+)
+CONTEXT_TOKENS = Histogram(
+    "bot_conversation_input_tokens", "Input tokens per answered turn (conversation context)",
+    buckets=(1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000),
+)
+COMPACTIONS = Counter(
+    "bot_conversation_compactions_total", "Conversations compacted into a summary",
+    labelnames=("result",),
+)
+COMPACTION_TOKENS_SAVED = Counter(
+    "bot_conversation_compaction_tokens_saved_total",
+    "Input tokens saved by the first turn after compaction compared to the turn before it",
+)
+_compaction_latency = STAGE_LATENCY.labels("compaction")
 
-    @property
-    def key(self) -> ConversationKey:
-        return (self.chat_id, self.user_id)
+# Начало первого вопроса после сжатия (summary - в тексте ниже)
+SUMMARY_SEED_PREFIX = "Краткое содержание предыдущей части диалога с пользователем:"
 
+# Начало диалога, первый ответ которого взят из кэша ответов
+CACHED_SEED_TEMPLATE = "Вопрос пользователя:\n{question}\n\nТвой ответ на него:\n{answer}"
 
-# Структуры данных для хранения информации о conversations
-conversation_heap = []  # heap для быстрого доступа к старым conversations
-chat_user_conversations: Dict[ConversationKey, ConversationInfo] = {}
+
+def has_conversation(chat_id: int, user_id: int) -> bool:
+    """Есть ли у пользователя начатый диалог (в том числе сжатый)."""
+    return conversation_store.get(chat_id, user_id) is not None
 
 
 def get_previous_response_id(chat_id: int, user_id: int) -> Optional[str]:
     """Получает previous_response_id для продолжения диалога."""
-    key = (chat_id, user_id)
-    conv_info = chat_user_conversations.get(key)
+    conv_info = conversation_store.get(chat_id, user_id)
     if conv_info:
-        return conv_info.last_response_id
+        # После сжатия цепочки нет до первого ответа с summary
+        return conv_info.last_response_id or None
     return None
 
 
-def update_conversation(chat_id: int, user_id: int, response_id: str):
-    """Обновляет информацию о диалоге после получения ответа."""
-    current_time = datetime.now()
-    key = (chat_id, user_id)
-
-    existing = chat_user_conversations.get(key)
-    if existing:
-        # Обновляем существующий
-        existing.last_response_id = response_id
-        existing.last_access = current_time
-        heapq.heapify(conversation_heap)
-    else:
-        # Создаём новый
-        conv_info = ConversationInfo(
-            last_response_id=response_id,
-            last_access=current_time,
-            chat_id=chat_id,
-            user_id=user_id
+def conversation_input(chat_id: int, user_id: int, contents: List[UserContent]) -> dict:
+    """Параметры продолжения диалога: previous_response_id или summary сжатого.
+
+    contents - сообщения вопроса (несколько, если пользователь отправил их подряд).
+    """
+    conv_info = conversation_store.get(chat_id, user_id)
+    user_messages = [{"role": "user", "content": content} for content in contents]
+    if conv_info is None:
+        return {"input": user_messages}
+    if conv_info.last_response_id:
+        return {"input": user_messages, "previous_response_id": conv_info.last_response_id}
+    # Новая цепочка после сжатия (или ответа из кэша) начинается с краткого
+    # содержания прежней; input_tokens 0 - сжатия не было, это ответ из кэша
+    span = current_span()
+    if span is not None:
+        span.trace.set("compacted" if conv_info.input_tokens else "cache_seeded", True)
+    seed = {"role": "developer", "content": f"{SUMMARY_SEED_PREFIX}\n\n{conv_info.summary}"}
+    return {"input": [seed, *user_messages]}
+
+
+def update_conversation(chat_id: int, user_id: int, response_id: str, input_tokens: int = 0):
+    """Обновляет информацию о диалоге после получения ответа.
+
+    input_tokens - usage.input_tokens ответа: с previous_response_id в него
+    входит весь контекст цепочки, поэтому он и есть размер диалога.
+    """
+    if input_tokens:
+        CONTEXT_TOKENS.observe(input_tokens)
+        if CONVERSATION_COMPACT_TOKENS > 0:
+            _report_compaction_savings(chat_id, user_id, input_tokens)
+    conversation_store.upsert(chat_id, user_id, response_id, datetime.now(), input_tokens)
+    _schedule_flush()
+
+
+def seed_conversation_from_cache(chat_id: int, user_id: int, question: str, answer: str):
+    """Начинает диалог с вопроса пользователя и ответа из кэша ответов.
+
+    Ответ в кэше создан в цепочке другого пользователя, поэтому его
+    response_id не используется: следующий вопрос начнёт новую цепочку с
+    этим вопросом и ответом (как после сжатия, без previous_response_id).
+    """
+    seed = CACHED_SEED_TEMPLATE.format(question=question, answer=answer)
+    conversation_store.upsert(chat_id, user_id, "", datetime.now(), summary=seed)
+    _schedule_flush()
+
+
+def _report_compaction_savings(chat_id: int, user_id: int, input_tokens: int):
+    conv_info = conversation_store.get(chat_id, user_id)
+    if conv_info is None or conv_info.last_response_id or not conv_info.summary:
+        return
+    if not conv_info.input_tokens:
+        # Диалог начат ответом из кэша - сравнивать не с чем
+        return
+    # Первый ответ после сжатия: input_tokens до и после
+    saved = max(conv_info.input_tokens - input_tokens, 0)
+    COMPACTION_TOKENS_SAVED.inc(saved)
+    logging.info(
+        f"Compacted conversation chat={chat_id}, user={user_id}: "
+        f"{conv_info.input_tokens} -> {input_tokens} input tokens per turn"
+    )
+
+
+def needs_compaction(input_tokens: int) -> bool:
+    """Пора ли сжать диалог с таким контекстом последнего ответа."""
+    return 0 < CONVERSATION_COMPACT_TOKENS <= input_tokens
+
+
+async def compact_conversation(chat_id: int, user_id: int):
+    """Заменяет длинную цепочку ответов кратким содержанием диалога.
+
+    Модель пишет summary по previous_response_id (ответ не сохраняется на
+    сервере), следующий вопрос уйдёт без previous_response_id, с summary.
+    Возвращает response запроса summary (для учёта токенов) или None.
+    """
+    conv_info = conversation_store.get(chat_id, user_id)
+    if conv_info is None or not conv_info.last_response_id:
+        return None
+    started = time.perf_counter()
+    try:
+        response = await client.responses.create(
+            prompt={"id": PROMPT_ID},
+            previous_response_id=conv_info.last_response_id,
+            input=[{"role": "developer", "content": CONVERSATION_SUMMARY_PROMPT}],
+            tool_choice="none",
+            max_output_tokens=CONVERSATION_SUMMARY_MAX_TOKENS,
+            store=False,
         )
-        chat_user_conversations[key] = conv_info
-        heapq.heappush(conversation_heap, conv_info)
+    except Exception as e:
+        # Диалог продолжается как есть, сжатие повторится после следующего ответа
+        COMPACTIONS.labels("error").inc()
+        logging.error(f"Error compacting conversation chat={chat_id}, user={user_id}: {e}")
+        return None
+    finally:
+        _compaction_latency.observe(time.perf_counter() - started)
+
+    summary = response.output_text.strip()
+    current = conversation_store.get(chat_id, user_id)
+    if not summary or current is None or current.last_response_id != conv_info.last_response_id:
+        # Пустой summary или диалог сброшен/продолжен, пока писался summary
+        COMPACTIONS.labels("skipped").inc()
+        return response
+
+    conversation_store.upsert(
+        chat_id, user_id, "", datetime.now(), conv_info.input_tokens, summary
+    )
+    _schedule_flush()
+    COMPACTIONS.labels("ok").inc()
+    logging.info(
+        f"Conversation chat={chat_id}, user={user_id} compacted at "
+        f"{conv_info.input_tokens} input tokens into {len(summary)} chars "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
+    return response
 
 
 def delete_user_conversation(chat_id: int, user_id: int) -> bool:
     """Удаляет conversation пользователя (сбрасывает историю). Возвращает True если существовал."""
-    key = (chat_id, user_id)
-    if key in chat_user_conversations:
-        del chat_user_conversations[key]
+    if conversation_store.delete(chat_id, user_id):
+        _schedule_flush()
         logging.info(f"Deleted conversation for chat={chat_id}, user={user_id}")
         return True
     return False
@@ -82,30 +193,49 @@ def delete_user_conversation(chat_id: int, user_id: int) -> bool:
 async def cleanup_old_conversations():
     """Очистка старых conversations (запускается как фоновая задача)."""
     try:
-        current_time = datetime.now()
+        cutoff = datetime.now() - timedelta(hours=CONVERSATION_LIFETIME_HOURS)
 
-        while conversation_heap:
-            oldest = conversation_heap[0]
+        if conversation_store.blocking:
+            removed = await asyncio.to_thread(conversation_store.delete_expired, cutoff)
+        else:
+            removed = conversation_store.delete_expired(cutoff)
 
-            if current_time - oldest.last_access <= timedelta(
-                hours=CONVERSATION_LIFETIME_HOURS
-            ):
-                break
-
-            oldest = heapq.heappop(conversation_heap)
-            key = oldest.key
-            if key in chat_user_conversations:
-                del chat_user_conversations[key]
-                logging.info(
-                    f"Cleaned up old conversation for chat={oldest.chat_id}, user={oldest.user_id}"
-                )
+        for chat_id, user_id in removed:
+            logging.info(
+                f"Cleaned up old conversation for chat={chat_id}, user={user_id}"
+            )
 
     except Exception as e:
         logging.error(f"Error in cleanup: {e}")
 
 
+async def flush_conversations():
+    """Записывает буферизованные изменения conversations (фоновая задача)."""
+    try:
+        if conversation_store.blocking:
+            await asyncio.to_thread(conversation_store.flush)
+        else:
+            conversation_store.flush()
+    except Exception as e:
+        logging.error(f"Error flushing conversations: {e}")
+
+
+def _schedule_flush():
+    """Запускает flush вне event loop, если буфер хранилища заполнен."""
+    global _flush_task
+    if not conversation_store.flush_due():
+        return
+    if _flush_task is not None and not _flush_task.done():
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        conversation_store.flush()
+        return
+    _flush_task = loop.create_task(flush_conversations())
+
+
 def clear_all_conversations():
     """Очистка локального кэша conversations (при перезапуске)."""
-    chat_user_conversations.clear()
-    conversation_heap.clear()
+    conversation_store.clear()
     logging.info("Local conversation cache cleared")
@@ -0,0 +1,345 @@
+"""Хранилища conversations: in-memory и SQLite (переживает перезапуск)."""
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from config import (CONVERSATION_DB_BATCH_SIZE, CONVERSATION_DB_PATH,
+                    CONVERSATION_STORE, WORKER_COUNT)
+from shared_state import open_sqlite
+
+# Тип ключа: (chat_id, user_id)
+ConversationKey = Tuple[int, int]
+
+
+@dataclass
+class ConversationInfo:
+    """Информация о диалоге пользователя."""
+    last_response_id: str  # ID последнего ответа ("" - начать заново с summary)
+    last_access: datetime
+    chat_id: int
+    user_id: int
+    input_tokens: int = 0  # input_tokens последнего ответа - размер контекста диалога
+    summary: Optional[str] = None  # Краткое содержание сжатого диалога
+
+    @property
+    def key(self) -> ConversationKey:
+        return (self.chat_id, self.user_id)
+
+
+class ConversationStore(ABC):
+    """Интерфейс хранилища conversations.
+
+    persistent - данные переживают перезапуск процесса.
+    blocking - методы выполняют дисковый I/O, и тяжёлые операции
+    (flush, delete_expired) нужно вызывать вне event loop.
+    """
+
+    persistent = False
+    blocking = False
+
+    @abstractmethod
+    def get(self, chat_id: int, user_id: int) -> Optional[ConversationInfo]:
+        """Возвращает conversation или None."""
+
+    @abstractmethod
+    def upsert(self, chat_id: int, user_id: int, response_id: str,
+               last_access: datetime, input_tokens: int = 0,
+               summary: Optional[str] = None):
+        """Создаёт или обновляет conversation."""
+
+    @abstractmethod
+    def delete(self, chat_id: int, user_id: int) -> bool:
+        """Удаляет conversation. Возвращает True если существовал."""
+
+    @abstractmethod
+    def delete_expired(self, cutoff: datetime) -> List[ConversationKey]:
+        """Удаляет conversations с last_access < cutoff, возвращает их ключи."""
+
+    @abstractmethod
+    def clear(self):
+        """Удаляет все conversations."""
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """Количество живых conversations."""
+
+    def flush(self):
+        """Записывает накопленные изменения (для буферизующих хранилищ)."""
+
+    def flush_due(self) -> bool:
+        """Накопилось ли достаточно изменений для внеочередного flush."""
+        return False
+
+    def close(self):
+        """Освобождает ресурсы хранилища."""
+
+
+class MemoryConversationStore(ConversationStore):
+    """Хранилище в памяти процесса (сбрасывается при перезапуске).
+
+    OrderedDict служит одновременно индексом по ключу и TTL-индексом:
+    при обновлении conversation переносится в конец (move_to_end), поэтому
+    записи упорядочены по last_access, и самые старые всегда в начале.
+    Обновление и удаление - O(1), очистка - O(число удалённых).
+    """
+
+    def __init__(self):
+        # (chat_id, user_id) -> ConversationInfo, от старых к новым
+        self.chat_user_conversations: OrderedDict = OrderedDict()
+
+    def get(self, chat_id: int, user_id: int) -> Optional[ConversationInfo]:
+        return self.chat_user_conversations.get((chat_id, user_id))
+
+    def upsert(self, chat_id: int, user_id: int, response_id: str,
+               last_access: datetime, input_tokens: int = 0,
+               summary: Optional[str] = None):
+        key = (chat_id, user_id)
+        existing = self.chat_user_conversations.get(key)
+        if existing:
+            existing.last_response_id = response_id
+            existing.last_access = last_access
+            existing.input_tokens = input_tokens
+            existing.summary = summary
+            self.chat_user_conversations.move_to_end(key)
+        else:
+            self.chat_user_conversations[key] = ConversationInfo(
+                last_response_id=response_id,
+                last_access=last_access,
+                chat_id=chat_id,
+                user_id=user_id,
+                input_tokens=input_tokens,
+                summary=summary,
+            )
+
+    def delete(self, chat_id: int, user_id: int) -> bool:
+        return self.chat_user_conversations.pop((chat_id, user_id), None) is not None
+
+    def delete_expired(self, cutoff: datetime) -> List[ConversationKey]:
+        removed = []
+        conversations = self.chat_user_conversations
+        while conversations:
+            oldest = next(iter(conversations.values()))
+            if oldest.last_access >= cutoff:
+                break
+            conversations.popitem(last=False)
+            removed.append(oldest.key)
+        return removed
+
+    def clear(self):
+        self.chat_user_conversations.clear()
+
+    def __len__(self) -> int:
+        return len(self.chat_user_conversations)
+
+
+class SQLiteConversationStore(ConversationStore):
+    """Хранилище в SQLite (WAL) с пакетной записью.
+
+    Изменения копятся в буфере _pending и записываются одной транзакцией
+    методом flush вне event loop: по таймеру или досрочно, когда буфер
+    достигает batch_size (flush_due). Чтение сначала смотрит в буфер и в
+    записываемый пакет, затем в базу по первичному ключу (chat_id, user_id)
+    через отдельное соединение: в WAL чтение не ждёт идущей записи.
+    Индекс по last_access используется при очистке по TTL.
+    """
+
+    persistent = True
+    blocking = True
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            last_response_id TEXT NOT NULL,
+            last_access REAL NOT NULL,
+            input_tokens INTEGER NOT NULL DEFAULT 0,
+            summary TEXT,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_conversations_last_access
+            ON conversations (last_access);
+    """
+
+    # Столбцы, добавленные после первой версии схемы: имя -> определение
+    _ADDED_COLUMNS = {
+        "input_tokens": "INTEGER NOT NULL DEFAULT 0",
+        "summary": "TEXT",
+    }
+
+    def __init__(self, db_path: str = CONVERSATION_DB_PATH,
+                 batch_size: int = CONVERSATION_DB_BATCH_SIZE):
+        self.db_path = Path(db_path)
+        self.batch_size = batch_size
+        # None в буфере означает удаление
+        self._pending: Dict[ConversationKey, Optional[ConversationInfo]] = {}
+        # Пакет, который сейчас записывается (виден чтению до COMMIT)
+        self._flushing: Dict[ConversationKey, Optional[ConversationInfo]] = {}
+        # _lock - только обмен буферов; _write_lock - транзакции записи по очереди
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._closed = False
+        self._conn = open_sqlite(self.db_path)
+        self._conn.executescript(self._SCHEMA)
+        self._migrate()
+        self._read_conn = open_sqlite(self.db_path)
+        self._read_conn.execute("PRAGMA query_only = ON")
+        # Число записей в базе: пересчитывается после записи вне event loop
+        self._count = self._count_rows()
+
+    def _migrate(self):
+        """Добавляет новые столбцы в базу, созданную прежней версией бота."""
+        existing = {row[1] for row in self._conn.execute("PRAGMA table_info(conversations)")}
+        for name, definition in self._ADDED_COLUMNS.items():
+            if name not in existing:
+                self._conn.execute(f"ALTER TABLE conversations ADD COLUMN {name} {definition}")
+                logging.info(f"Conversation store migrated: added column {name}")
+
+    def _count_rows(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+    def get(self, chat_id: int, user_id: int) -> Optional[ConversationInfo]:
+        key = (chat_id, user_id)
+        with self._lock:
+            if key in self._pending:
+                return self._pending[key]
+            if key in self._flushing:
+                return self._flushing[key]
+        row = self._read_conn.execute(
+            "SELECT last_response_id, last_access, input_tokens, summary "
+            "FROM conversations "
+            "WHERE chat_id = ? AND user_id = ?",
+            key,
+        ).fetchone()
+        if row is None:
+            return None
+        return ConversationInfo(
+            last_response_id=row[0],
+            last_access=datetime.fromtimestamp(row[1]),
+            chat_id=chat_id,
+            user_id=user_id,
+            input_tokens=row[2],
+            summary=row[3],
+        )
+
+    def upsert(self, chat_id: int, user_id: int, response_id: str,
+               last_access: datetime, input_tokens: int = 0,
+               summary: Optional[str] = None):
+        conv_info = ConversationInfo(
+            last_response_id=response_id,
+            last_access=last_access,
+            chat_id=chat_id,
+            user_id=user_id,
+            input_tokens=input_tokens,
+            summary=summary,
+        )
+        with self._lock:
+            self._pending[conv_info.key] = conv_info
+
+    def delete(self, chat_id: int, user_id: int) -> bool:
+        existed = self.get(chat_id, user_id) is not None
+        if existed:
+            with self._lock:
+                self._pending[(chat_id, user_id)] = None
+        return existed
+
+    def flush_due(self) -> bool:
+        return len(self._pending) >= self.batch_size
+
+    def flush(self):
+        # Пакеты пишутся по очереди: более старый не ляжет поверх нового
+        with self._write_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                pending = self._flushing = self._pending
+                self._pending = {}
+            upserts = [
+                (c.chat_id, c.user_id, c.last_response_id, c.last_access.timestamp(),
+                 c.input_tokens, c.summary)
+                for c in pending.values() if c is not None
+            ]
+            deletes = [key for key, c in pending.items() if c is None]
+            try:
+                self._conn.execute("BEGIN")
+                if upserts:
+                    self._conn.executemany(
+                        "INSERT INTO conversations "
+                        "(chat_id, user_id, last_response_id, last_access, "
+                        "input_tokens, summary) "
+                        "VALUES (?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (chat_id, user_id) DO UPDATE SET "
+                        "last_response_id = excluded.last_response_id, "
+                        "last_access = excluded.last_access, "
+                        "input_tokens = excluded.input_tokens, "
+                        "summary = excluded.summary",
+                        upserts,
+                    )
+                if deletes:
+                    self._conn.executemany(
+                        "DELETE FROM conversations WHERE chat_id = ? AND user_id = ?",
+                        deletes,
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                with self._lock:
+                    # Возвращаем изменения в буфер, не затирая более свежие
+                    for key, conv_info in pending.items():
+                        self._pending.setdefault(key, conv_info)
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = {}
+            self._count = self._count_rows()
+
+    def delete_expired(self, cutoff: datetime) -> List[ConversationKey]:
+        self.flush()
+        with self._write_lock:
+            rows = self._conn.execute(
+                "DELETE FROM conversations WHERE last_access < ? "
+                "RETURNING chat_id, user_id",
+                (cutoff.timestamp(),),
+            ).fetchall()
+            self._count = self._count_rows()
+        return [(row[0], row[1]) for row in rows]
+
+    def clear(self):
+        with self._write_lock:
+            with self._lock:
+                self._pending.clear()
+            self._conn.execute("DELETE FROM conversations")
+            self._count = 0
+
+    def __len__(self) -> int:
+        # Без запроса к базе: значение на момент последней записи (для /metrics)
+        return self._count
+
+    def close(self):
+        if self._closed:
+            return
+        try:
+            self.flush()
+        finally:
+            with self._write_lock:
+                self._closed = True
+                self._conn.close()
+                self._read_conn.close()
+
+
+def create_conversation_store(kind: str = CONVERSATION_STORE) -> ConversationStore:
+    """Создаёт хранилище conversations по настройке CONVERSATION_STORE."""
+    if WORKER_COUNT > 1 and kind == "memory":
+        # Воркеры должны видеть общее состояние (например, после смены владельца чата)
+        logging.info("Multi-worker mode: using shared SQLite conversation store")
+        kind = "sqlite"
+    if kind == "sqlite":
+        logging.info(f"Using SQLite conversation store: {CONVERSATION_DB_PATH}")
+        return SQLiteConversationStore()
+    if kind != "memory":
+        logging.warning(f"Unknown CONVERSATION_STORE={kind!r}, using memory store")
+    return MemoryConversationStore()
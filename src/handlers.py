@@ -1,195 +1,529 @@
 """Обработчики команд и сообщений Telegram."""
+import asyncio
 import logging
-import re
+import time
+from typing import List, Optional
 
 import sentry_sdk
 from telegram import Update
-from telegram.constants import ChatAction
-from telegram.error import BadRequest, Forbidden, NetworkError
+from telegram.constants import ChatType
 from telegram.ext import ContextTypes
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 
-from access_control import check_rate_limit, should_bot_respond
+from access_control import Access, check_access, check_rate_limit
+from attachments import (Attachment, AttachmentTooLarge, attachment_error,
+                         build_user_contents, message_attachment)
 from chat_manager import ChatManager
 from citations import ProcessedResponse, process_response_with_citations
-from config import MAX_MESSAGE_LENGTH, PROMPT_ID, RATE_LIMIT_WINDOW, USERS
+from coalescer import MessageCoalescer
+from config import (
+    PROMPT_ID,
+    RATE_LIMIT_WINDOW,
+    RESPONSES_STREAMING,
+    SHARED_STATE_PATH,
+    WORKER_COUNT,
+    get_settings,
+)
 from conversation_manager import (
+    UserContent,
     client,
-    get_previous_response_id,
+    compact_conversation,
+    conversation_input,
+    has_conversation,
+    needs_compaction,
+    seed_conversation_from_cache,
     update_conversation,
     delete_user_conversation,
 )
+from log_pipeline import set_request_id
+from metrics import RATE_LIMIT_REJECTIONS, STAGE_LATENCY, CounterFunction, GaugeFunction
+from outbox import Priority, outbox
+from response_cache import response_cache
+from scheduler import RequestScheduler
+from streaming import StreamingReply
+from token_quota import Reservation, TokenUsage, create_token_quota, usage_from_response
+from tracing import Trace, start_trace
+from utils import split_message
+
+# Менеджер чатов (в многопроцессном режиме - в общей базе воркеров)
+chat_manager = ChatManager(db_path=SHARED_STATE_PATH if WORKER_COUNT > 1 else None)
+
+# Планировщик запросов к OpenAI
+request_scheduler = RequestScheduler()
+
+# Дневные квоты токенов
+token_quota = create_token_quota()
+
+# Серии сообщений, отправленных подряд (BURST_WINDOW, BURST_PRIVATE_WINDOW)
+message_coalescer = MessageCoalescer()
+
+# Метрики этапов обработки сообщения
+_access_latency = STAGE_LATENCY.labels("access")
+_openai_latency = STAGE_LATENCY.labels("openai")
+_citations_latency = STAGE_LATENCY.labels("citations")
+_rate_limited = RATE_LIMIT_REJECTIONS.labels("messages")
+_quota_exceeded = RATE_LIMIT_REJECTIONS.labels("tokens")
+_attachments_rejected = RATE_LIMIT_REJECTIONS.labels("attachments")
+
+GaugeFunction(
+    "bot_requests_in_flight", "OpenAI requests being processed",
+    lambda: request_scheduler.in_flight,
+)
+GaugeFunction(
+    "bot_requests_queued", "Requests waiting for a free slot",
+    lambda: request_scheduler.pending - request_scheduler.in_flight,
+)
+CounterFunction(
+    "bot_requests_rejected_total", "Requests rejected because the queue was full",
+    lambda: request_scheduler.rejected,
+)
+CounterFunction(
+    "bot_messages_coalesced_total", "Messages merged into the previous message of a burst",
+    lambda: message_coalescer.coalesced,
+)
+GaugeFunction(
+    "bot_message_bursts_open", "Message bursts waiting for their window to close",
+    lambda: len(message_coalescer),
+)
 
-# Менеджер чатов
-chat_manager = ChatManager()
 
+def format_reply_text(processed: ProcessedResponse) -> str:
+    """Собирает итоговый текст ответа с citations (plain text)."""
+    return processed.text + processed.footnotes
 
-@retry(
-    retry=retry_if_exception_type(NetworkError),
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=2, max=10),
-    reraise=True
-)
-async def send_reply_with_retry(message, text: str, parse_mode: str = None):
-    """Отправка ответа с retry при сетевых ошибках."""
-    await message.reply_text(text, parse_mode=parse_mode)
 
+def send_formatted_reply(message, processed: ProcessedResponse) -> asyncio.Future:
+    """Ставит в очередь отправки форматированный ответ с citations (plain text)."""
+    # Части длинного ответа отправляются подряд, без чужих сообщений между ними
+    return outbox.reply_parts(message, split_message(format_reply_text(processed)))
 
-TELEGRAM_MESSAGE_LIMIT = 4096
 
+def answer_from_cache(
+    message, chat_id: int, user_id: int, message_text: str
+) -> Optional[asyncio.Future]:
+    """Отвечает на первый вопрос диалога из кэша ответов.
 
-def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list[str]:
-    """Разбивает длинное сообщение на части."""
-    if len(text) <= limit:
-        return [text]
+    Возвращает future отправки ответа; None - ответа в кэше нет.
+    """
+    # Кэш только для начала диалога: после ответа, ещё не записавшего
+    # previous_response_id, вопрос должен дождаться своей очереди
+    if request_scheduler.has_pending(chat_id, user_id):
+        return None
+    if has_conversation(chat_id, user_id):
+        return None
+    key = response_cache.key(message_text)
+    if key is None:
+        return None
+    cached = response_cache.get(key)
+    if cached is None:
+        return None
 
-    parts = []
-    while text:
-        if len(text) <= limit:
-            parts.append(text)
-            break
+    # Ответ создан в чужой цепочке: диалог продолжится с этого вопроса и
+    # ответа, без previous_response_id другого пользователя
+    seed_conversation_from_cache(chat_id, user_id, message_text, cached.processed.text)
+    return send_formatted_reply(message, cached.processed)
 
-        # Ищем место для разбивки (по переносу строки или пробелу)
-        split_pos = text.rfind('\n', 0, limit)
-        if split_pos == -1 or split_pos < limit // 2:
-            split_pos = text.rfind(' ', 0, limit)
-        if split_pos == -1 or split_pos < limit // 2:
-            split_pos = limit
 
-        parts.append(text[:split_pos])
-        text = text[split_pos:].lstrip()
+def cache_answer(cache_key: Optional[str], response, processed: ProcessedResponse):
+    """Сохраняет полный ответ на первый вопрос диалога в кэш ответов."""
+    if cache_key and getattr(response, "status", None) == "completed" and processed.text.strip():
+        response_cache.put(cache_key, processed)
 
-    return parts
 
+def build_request_params(chat_id: int, user_id: int, contents: List[UserContent]) -> dict:
+    """Формирует параметры запроса к Responses API."""
+    params = {"prompt": {"id": PROMPT_ID}}
+    # previous_response_id, если есть история (или summary сжатого диалога)
+    params.update(conversation_input(chat_id, user_id, contents))
+    return params
 
-async def send_formatted_reply(message, processed: ProcessedResponse):
-    """Отправляет форматированный ответ с citations (plain text)."""
-    # Убираем MarkdownV2 форматирование - отправляем plain text
-    full_text = remove_markdown_formatting(processed.text)
 
-    if processed.footnotes:
-        full_text += remove_markdown_formatting(processed.footnotes)
+async def process_with_responses(chat_id: int, user_id: int, contents: List[UserContent]):
+    """Отправляет сообщения через Responses API и возвращает response объект."""
+    params = build_request_params(chat_id, user_id, contents)
 
-    # Разбиваем на части если слишком длинное
-    parts = split_message(full_text)
+    # Выполняем запрос к Responses API
+    response = await client.responses.create(**params)
 
-    for part in parts:
-        await send_reply_with_retry(message, part)
+    # Сохраняем response.id для следующего сообщения
+    input_tokens = usage_from_response(response).input_tokens
+    update_conversation(chat_id, user_id, response.id, input_tokens)
 
+    # Возвращаем полный response объект для обработки citations
+    return response
 
-def remove_markdown_formatting(text: str) -> str:
-    """Удаляет форматирование MarkdownV2 из текста."""
-    # Убираем escape-символы
-    result = re.sub(r'\\([_*\[\]()~`>#+=|{}.!-])', r'\1', text)
-    # Убираем курсив и жирный
-    result = re.sub(r'_([^_]+)_', r'\1', result)
-    result = re.sub(r'\*([^*]+)\*', r'\1', result)
-    return result
 
+class StreamInterrupted(RuntimeError):
+    """Поток ответа прервался; usage - из события сбоя, если оно его содержало."""
 
-async def process_with_responses(chat_id: int, user_id: int, message_text: str):
-    """Отправляет сообщение через Responses API и возвращает response объект."""
-    # Получаем previous_response_id для продолжения диалога
-    previous_response_id = get_previous_response_id(chat_id, user_id)
+    def __init__(self, message: str, usage: Optional[TokenUsage] = None):
+        super().__init__(message)
+        self.usage = usage
 
-    # Формируем параметры запроса
-    params = {
-        "prompt": {"id": PROMPT_ID},
-        "input": [{"role": "user", "content": message_text}],
-    }
 
-    # Добавляем previous_response_id если есть история
-    if previous_response_id:
-        params["previous_response_id"] = previous_response_id
+async def stream_with_responses(
+    chat_id: int, user_id: int, contents: List[UserContent], reply: StreamingReply
+):
+    """Выполняет запрос с stream=True, выводя текст в reply по мере генерации.
 
-    # Выполняем запрос к Responses API
-    response = await client.responses.create(**params)
+    Возвращает финальный response (из события response.completed) с annotations.
+    """
+    params = build_request_params(chat_id, user_id, contents)
 
-    # Сохраняем response.id для следующего сообщения
-    update_conversation(chat_id, user_id, response.id)
+    response = None
+    stream = await client.responses.create(stream=True, **params)
+    async for event in stream:
+        if event.type == "response.output_text.delta":
+            await reply.append(event.delta)
+        elif event.type == "response.completed":
+            response = event.response
+        elif event.type in ("response.failed", "response.incomplete"):
+            raise StreamInterrupted(
+                f"Responses stream failed: {event.type}", usage_from_response(event.response)
+            )
+        elif event.type == "error":
+            raise StreamInterrupted(f"Responses stream failed: {event.type}")
 
-    # Возвращаем полный response объект для обработки citations
+    if response is None:
+        raise StreamInterrupted("Responses stream ended without response.completed")
+
+    input_tokens = usage_from_response(response).input_tokens
+    update_conversation(chat_id, user_id, response.id, input_tokens)
     return response
 
 
+def _message_text(message) -> str:
+    """Текст сообщения или подпись к фото/документу."""
+    return message.text or message.caption or ""
+
+
+def _update_chat(update: Update):
+    """Обновляет информацию о чате в списке чатов."""
+    chat = update.effective_chat
+    chat_manager.update_chat(
+        chat_id=chat.id,
+        chat_type=chat.type,
+        name=(
+            chat.title
+            if chat.title
+            else f"Private chat with {update.effective_user.username}"
+        ),
+    )
+
+
+async def assign_request_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Связывает записи лога с обновлением: request_id - update_id."""
+    set_request_id(str(update.update_id))
+
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Основной обработчик сообщений."""
+    started = time.perf_counter()
     try:
         if not update.effective_chat or not update.effective_user or not update.message:
             logging.warning("Получено обновление без необходимых атрибутов")
             return
 
-        # Обновление информации о чате
+        # Проверка доступа до любого I/O: в группах большинство сообщений не боту
         chat = update.effective_chat
-        chat_manager.update_chat(
-            chat_id=chat.id,
-            chat_type=chat.type,
-            name=(
-                chat.title
-                if chat.title
-                else f"Private chat with {update.effective_user.username}"
-            ),
-        )
-
-        # Проверяем, должен ли бот ответить на это сообщение
-        if not await should_bot_respond(update.message, context):
+        access, reason = check_access(update.message)
+        if access is Access.IGNORE:
+            # Новый чат всё же попадает в список чатов
+            if chat.id not in chat_manager.chats:
+                _update_chat(update)
             return
+        _update_chat(update)
 
-        user = update.effective_user
-        username = user.username
-        user_id = user.id
+        if access is Access.BANNED_USER:
+            outbox.reply(update.message, f"Вы заблокированы.\n\nПричина: {reason}", Priority.HIGH)
+            return
+        if access is Access.BANNED_CHAT:
+            outbox.reply(
+                update.message, f"Этот чат заблокирован.\n\nПричина: {reason}", Priority.HIGH
+            )
+            return
+        if access is Access.DENIED:
+            outbox.reply(update.message, "У вас нет доступа к боту.", Priority.HIGH)
+            return
 
-        # Проверка доступа пользователя
-        if USERS != "*":
-            if username is None or username not in USERS:
-                await update.message.reply_text("У вас нет доступа к боту.")
-                return
+        user_id = update.effective_user.id
 
-        # Rate limiting
-        if not check_rate_limit(user_id):
-            await update.message.reply_text(
-                f"Слишком много сообщений. Подождите немного ({RATE_LIMIT_WINDOW} сек)."
+        # Rate limiting (сообщения открытой серии считаются вместе с первым)
+        if not message_coalescer.has_pending(chat.id, user_id) and not await check_rate_limit(
+            user_id, chat.id
+        ):
+            _rate_limited.inc()
+            outbox.reply(
+                update.message,
+                f"Слишком много сообщений. Подождите немного ({RATE_LIMIT_WINDOW} сек).",
+                Priority.HIGH,
             )
             return
 
-        # Валидация длины сообщения
-        message_text = update.message.text
-        if not message_text:
+        # Валидация длины сообщения (подписи к файлу) и самого файла
+        message_text = _message_text(update.message)
+        attachment = message_attachment(update.message)
+        if not message_text and attachment is None:
             return
 
-        if len(message_text) > MAX_MESSAGE_LENGTH:
-            await update.message.reply_text(
-                f"Сообщение слишком длинное. Максимум: {MAX_MESSAGE_LENGTH} символов."
+        settings = get_settings()
+        max_length = settings.max_message_length
+        if len(message_text) > max_length:
+            outbox.reply(
+                update.message,
+                f"Сообщение слишком длинное. Максимум: {max_length} символов.",
+                Priority.HIGH,
             )
             return
+        if attachment is not None:
+            error = attachment_error(attachment, settings)
+            if error is not None:
+                _attachments_rejected.inc()
+                outbox.reply(update.message, error, Priority.HIGH)
+                return
 
-        # Отправка "печатает..."
-        try:
-            await context.bot.send_chat_action(
-                chat_id=update.effective_chat.id, action=ChatAction.TYPING
+        # Сообщения, отправленные подряд, уходят одним запросом (окно BURST_*)
+        window = (
+            settings.burst_private_window
+            if chat.type == ChatType.PRIVATE
+            else settings.burst_window
+        )
+        if message_coalescer.add(
+            chat.id, user_id, update, window, settings.burst_max_messages, started,
+            lambda updates, first: dispatch_message(
+                updates, context, first, time.perf_counter()
+            ),
+        ):
+            return
+        dispatch_message([update], context, started)
+
+    except Exception as e:
+        report_message_error(update, "handle_message", e)
+
+
+def dispatch_message(
+    updates: List[Update],
+    context: ContextTypes.DEFAULT_TYPE,
+    started: float,
+    flushed_at: Optional[float] = None,
+):
+    """Отвечает на вопрос из кэша или передаёт его планировщику.
+
+    updates - сообщения вопроса (серия, если пользователь отправил их
+    подряд); ответ один, на последнее. started - начало обработки первого,
+    flushed_at - закрытие окна серии (None - сообщение не ждало).
+    """
+    update = updates[-1]
+    chat = update.effective_chat
+    chat_id = chat.id
+    user_id = update.effective_user.id
+    message_texts = [_message_text(u.message) for u in updates]
+    attachments = [message_attachment(u.message) for u in updates]
+    message_text = "\n".join(message_texts)
+    try:
+        trace = start_trace(
+            "handle_message", started,
+            chat_id=chat_id, chat_type=chat.type, text_length=len(message_text),
+        )
+        access_started = started
+        if flushed_at is not None:
+            trace.record("coalesce", started, flushed_at)
+            trace.set("burst_messages", len(updates))
+            access_started = flushed_at
+
+        # Повторный вопрос - ответ из кэша, без запроса к OpenAI и расхода квоты
+        sent = (
+            answer_from_cache(update.message, chat_id, user_id, message_text)
+            if not any(attachments)
+            else None
+        )
+        if sent is not None:
+            _access_latency.observe(time.perf_counter() - access_started)
+            trace.record("access", access_started)
+            trace.set("cache", "hit")
+            trace.finish_after(sent)
+            return
+
+        # Квота токенов проверяется по оценке до запроса к OpenAI
+        reservation = token_quota.reserve(user_id, chat_id, message_text)
+        if reservation is None:
+            _quota_exceeded.inc()
+            trace.set("rejected", "token_quota")
+            trace.finish()
+            outbox.reply(
+                update.message,
+                "Дневной лимит запросов к ассистенту исчерпан. Лимит обновится в 00:00 UTC.",
+                Priority.HIGH,
             )
-        except Forbidden:
-            logging.warning(f"User {update.effective_chat.id} blocked the bot")
             return
 
-        # Отправка в OpenAI Responses API
-        chat_id = update.effective_chat.id
-        response = await process_with_responses(chat_id, user_id, message_text)
+        _access_latency.observe(time.perf_counter() - access_started)
+        submitted_at = trace.record("access", access_started).end
 
-        # Обрабатываем citations и отправляем ответ
-        processed = await process_response_with_citations(response)
-        await send_formatted_reply(update.message, processed)
+        # Передаём запрос планировщику и сразу возвращаемся к polling
+        submitted = request_scheduler.submit(
+            chat_id,
+            user_id,
+            lambda: answer_message(
+                update, context, message_texts, attachments, reservation, trace,
+                submitted_at,
+            ),
+        )
+        if not submitted:
+            token_quota.release(reservation)
+            trace.set("rejected", "queue_full")
+            trace.finish()
+            outbox.reply(
+                update.message,
+                "Бот сейчас перегружен. Пожалуйста, повторите запрос через минуту.",
+                Priority.HIGH,
+            )
 
     except Exception as e:
-        logging.exception(f"Error in handle_message: {type(e).__name__}: {e}")
-        sentry_sdk.capture_exception(e)
+        report_message_error(update, "dispatch_message", e)
+
+
+async def answer_message(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    message_texts: List[str],
+    attachments: List[Optional[Attachment]],
+    reservation: Reservation,
+    trace: Trace,
+    submitted_at: float,
+):
+    """Запрашивает ответ у OpenAI и отправляет его (выполняется планировщиком)."""
+    trace.record("queue_wait", submitted_at)
+    try:
+        with trace.activate():
+            await _answer_message(
+                update, context, message_texts, attachments, reservation, trace
+            )
+    except Exception as e:
+        trace.set("error", type(e).__name__)
+        trace.finish()
+        report_message_error(update, "answer_message", e)
+    finally:
+        # Запрос не дошёл до ответа - резерв квоты не нужен
+        token_quota.release(reservation)
+
+
+async def _answer_message(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    message_texts: List[str],
+    attachments: List[Optional[Attachment]],
+    reservation: Reservation,
+    trace: Trace,
+):
+    """Тело answer_message; этапы записываются спанами трассировки."""
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+
+    # "печатает..." - без ожидания, повторные в пределах нескольких секунд не шлются
+    outbox.typing(context.bot, chat_id)
+
+    # Ответ на первый вопрос диалога попадёт в кэш ответов (вопрос без файлов)
+    cache_key = (
+        response_cache.key("\n".join(message_texts))
+        if not has_conversation(chat_id, user_id) and not any(attachments)
+        else None
+    )
+
+    # Файлы скачиваются из Telegram и загружаются в Files API
+    contents: List[UserContent] = message_texts
+    if any(attachments):
         try:
-            if update.message:
-                await update.message.reply_text(
-                    "Произошла ошибка при обработке сообщения. Пожалуйста, попробуйте позже."
-                )
-        except Exception as reply_error:
-            logging.error(f"Ошибка при отправке сообщения об ошибке: {reply_error}")
+            contents = await build_user_contents(context.bot, message_texts, attachments)
+        except AttachmentTooLarge as e:
+            token_quota.release(reservation)
+            _attachments_rejected.inc()
+            trace.set("rejected", "attachment_size")
+            trace.finish()
+            outbox.reply(update.message, str(e), Priority.HIGH)
+            return
+    trace.set("cache", "miss" if cache_key is not None else "skip")
+
+    # Отправка в OpenAI Responses API
+    if RESPONSES_STREAMING:
+        settings = get_settings()
+        edit_interval = (
+            settings.stream_edit_interval
+            if update.effective_chat.type == ChatType.PRIVATE
+            else settings.stream_group_edit_interval
+        )
+        reply = StreamingReply(update.message, edit_interval)
+        # В режиме streaming этап openai включает промежуточные правки сообщения
+        try:
+            with _openai_latency.time(), trace.span("openai", streaming=True) as span:
+                response = await stream_with_responses(chat_id, user_id, contents, reply)
+                _record_retries(span)
+        except Exception as e:
+            # Уже сгенерированные токены учитываются, черновик не остаётся рядом с ошибкой
+            usage = getattr(e, "usage", None)
+            if usage is None or not usage.input_tokens:
+                usage = token_quota.partial_usage(reservation, reply.text)
+            token_quota.release(reservation)
+            token_quota.record(user_id, chat_id, usage)
+            trace.set("input_tokens", usage.input_tokens)
+            await reply.discard()
+            raise
+        usage = usage_from_response(response)
+        token_quota.commit(reservation, user_id, chat_id, usage)
+        trace.set("input_tokens", usage.input_tokens)
+
+        # Citations приходят с финальным response - заменяем черновик
+        with _citations_latency.time(), trace.span("citations"):
+            processed = await process_response_with_citations(response)
+        with trace.span("send"):
+            await reply.finalize(format_reply_text(processed))
+        cache_answer(cache_key, response, processed)
+        trace.finish()
+        await compact_if_needed(chat_id, user_id, usage)
+        return
+
+    with _openai_latency.time(), trace.span("openai", streaming=False) as span:
+        response = await process_with_responses(chat_id, user_id, contents)
+        _record_retries(span)
+    usage = usage_from_response(response)
+    token_quota.commit(reservation, user_id, chat_id, usage)
+    trace.set("input_tokens", usage.input_tokens)
+
+    # Обрабатываем citations и отправляем ответ
+    with _citations_latency.time(), trace.span("citations"):
+        processed = await process_response_with_citations(response)
+    trace.finish_after(send_formatted_reply(update.message, processed))
+    cache_answer(cache_key, response, processed)
+    await compact_if_needed(chat_id, user_id, usage)
+
+
+async def compact_if_needed(chat_id: int, user_id: int, usage: TokenUsage):
+    """Сжимает диалог, контекст которого достиг CONVERSATION_COMPACT_TOKENS.
+
+    Выполняется после отправки ответа, но в очереди запросов пользователя:
+    следующий вопрос уже пойдёт в новую цепочку с summary.
+    """
+    if not needs_compaction(usage.input_tokens):
+        return
+    response = await compact_conversation(chat_id, user_id)
+    if response is not None:
+        token_quota.record(user_id, chat_id, usage_from_response(response))
+
+
+def _record_retries(span):
+    """Повторы запроса к OpenAI: HTTP-запросов этапа сверх первого."""
+    span.set("retries", max(span.attributes.get("http_requests", 1) - 1, 0))
+
+
+def report_message_error(update: Update, where: str, error: Exception):
+    """Логирует ошибку обработки сообщения и сообщает о ней пользователю."""
+    logging.exception(f"Error in {where}: {type(error).__name__}: {error}")
+    sentry_sdk.capture_exception(error)
+    if update.message:
+        outbox.reply(
+            update.message,
+            "Произошла ошибка при обработке сообщения. Пожалуйста, попробуйте позже.",
+            Priority.HIGH,
+        )
 
 
 async def reset_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -199,13 +533,13 @@ async def reset_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE)
         user_id = update.effective_user.id
 
         if delete_user_conversation(chat_id, user_id):
-            await update.message.reply_text("История диалога очищена.")
+            outbox.reply(update.message, "История диалога очищена.", Priority.HIGH)
         else:
-            await update.message.reply_text("У вас нет активного диалога.")
+            outbox.reply(update.message, "У вас нет активного диалога.", Priority.HIGH)
 
     except Exception as e:
         logging.error(f"Ошибка в reset_conversation: {e}")
-        await update.message.reply_text("Произошла ошибка при сбросе диалога.")
+        outbox.reply(update.message, "Произошла ошибка при сбросе диалога.", Priority.HIGH)
 
 
 async def get_chat_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -223,4 +557,4 @@ async def get_chat_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Username: @{user.username if user.username else 'отсутствует'}"
     )
 
-    await update.message.reply_text(info_message)
+    outbox.reply(update.message, info_message, Priority.HIGH)
@@ -0,0 +1,201 @@
+"""HTTP-клиенты OpenAI и Bot API с явно настроенными пулами соединений.
+
+Каждый клиент ограничивает число одновременных запросов размером своего
+пула. Время ожидания свободного места в пуле пишется в метрику
+bot_http_pool_wait_seconds{client=...}: по ней видно, хватает ли пула
+(ожидания около нуля) или запросы стоят в очереди за соединением.
+"""
+import asyncio
+import importlib.util
+import logging
+import time
+from functools import lru_cache
+from typing import AsyncIterator, Callable, Optional, Tuple
+
+import httpx
+from telegram.request import HTTPXRequest
+
+from config import (HTTP2_ENABLED, HTTP_KEEPALIVE_EXPIRY, OPENAI_MAX_CONNECTIONS,
+                    OPENAI_MAX_KEEPALIVE, OPENAI_POOL_TIMEOUT, TELEGRAM_API_BASE_URL,
+                    TELEGRAM_POOL_SIZE, TELEGRAM_POOL_TIMEOUT, TELEGRAM_UPDATES_POOL_SIZE)
+from metrics import Counter, Histogram
+from tracing import current_span
+
+# Таймауты OpenAI (как в SDK по умолчанию): долгий ответ модели, быстрый connect
+OPENAI_READ_TIMEOUT = 600.0
+OPENAI_CONNECT_TIMEOUT = 5.0
+
+TELEGRAM_CLOUD_API_URL = "https://api.telegram.org"
+
+# Таймауты запросов к Bot API (сек)
+TELEGRAM_TIMEOUT = 30.0
+
+HTTP_POOL_WAIT = Histogram(
+    "bot_http_pool_wait_seconds",
+    "Time an outgoing HTTP request waited for a free connection pool slot",
+    labelnames=("client",),
+)
+HTTP_POOL_TIMEOUTS = Counter(
+    "bot_http_pool_timeouts_total",
+    "Outgoing HTTP requests failed because the connection pool stayed full",
+    labelnames=("client",),
+)
+
+
+@lru_cache(maxsize=None)
+def http2_available() -> bool:
+    """HTTP/2 включён в настройках и установлен пакет h2 (httpx[http2])."""
+    if not HTTP2_ENABLED:
+        return False
+    if importlib.util.find_spec("h2") is None:
+        logging.warning("HTTP2_ENABLED=true, but package h2 is not installed; using HTTP/1.1")
+        return False
+    return True
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """Тело ответа, освобождающее место в пуле после чтения или закрытия."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, release: Callable[[], None]):
+        self._stream = stream
+        self._release: Optional[Callable[[], None]] = release
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._release is not None:
+                self._release, release = None, self._release
+                release()
+
+
+class PoolMeteredTransport(httpx.AsyncHTTPTransport):
+    """Транспорт httpx, измеряющий ожидание свободного соединения.
+
+    Место в пуле занимается до закрытия тела ответа (для потоковых ответов
+    OpenAI - до конца потока), как и соединение внутри httpcore, поэтому
+    собственный пул httpcore не ждёт, а всё ожидание видно в метрике.
+    При HTTP/2 место - это одновременный запрос (поток) на соединении.
+    Таймаут ожидания - pool-таймаут запроса, как у самого httpx.
+    """
+
+    def __init__(self, client: str, limits: httpx.Limits, http2: bool = False, **kwargs):
+        super().__init__(limits=limits, http1=True, http2=http2, **kwargs)
+        self.client = client
+        self._slots = asyncio.Semaphore(limits.max_connections or 1)
+        self._pool_wait = HTTP_POOL_WAIT.labels(client)
+        self._pool_timeouts = HTTP_POOL_TIMEOUTS.labels(client)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        # Повторы запроса внутри SDK видны в трассировке числом HTTP-запросов этапа
+        span = current_span()
+        if span is not None:
+            span.incr("http_requests")
+        timeout = request.extensions.get("timeout", {}).get("pool")
+        started = time.perf_counter()
+        try:
+            if self._slots.locked():
+                await asyncio.wait_for(self._slots.acquire(), timeout)
+            else:
+                await self._slots.acquire()
+        except asyncio.TimeoutError:
+            self._pool_timeouts.inc()
+            raise httpx.PoolTimeout(
+                f"No free connection in {self.client} pool after {timeout} s", request=request
+            ) from None
+        finally:
+            self._pool_wait.observe(time.perf_counter() - started)
+
+        try:
+            response = await super().handle_async_request(request)
+        except BaseException:
+            self._slots.release()
+            raise
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_ReleasingStream(response.stream, self._slots.release),
+            extensions=response.extensions,
+        )
+
+
+def create_openai_http_client() -> httpx.AsyncClient:
+    """httpx-клиент для AsyncOpenAI (Responses и Files API)."""
+    transport = PoolMeteredTransport(
+        "openai",
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        http2=http2_available(),
+    )
+    timeout = httpx.Timeout(
+        OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT, pool=OPENAI_POOL_TIMEOUT
+    )
+    return httpx.AsyncClient(transport=transport, timeout=timeout, follow_redirects=True)
+
+
+def create_telegram_file_client(max_connections: int) -> httpx.AsyncClient:
+    """httpx-клиент скачивания файлов Bot API.
+
+    Отдельный пул: долгие скачивания не занимают соединения отправки ответов.
+    """
+    transport = PoolMeteredTransport(
+        "telegram_files",
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+    timeout = httpx.Timeout(TELEGRAM_TIMEOUT, pool=TELEGRAM_POOL_TIMEOUT)
+    return httpx.AsyncClient(transport=transport, timeout=timeout, follow_redirects=True)
+
+
+class MeteredHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest python-telegram-bot с транспортом PoolMeteredTransport."""
+
+    __slots__ = ("_pool_client", "_pool_size")
+
+    def __init__(self, client: str, connection_pool_size: int, pool_timeout: float, http2: bool):
+        self._pool_client = client
+        self._pool_size = connection_pool_size
+        super().__init__(
+            connection_pool_size=connection_pool_size,
+            connect_timeout=TELEGRAM_TIMEOUT,
+            read_timeout=TELEGRAM_TIMEOUT,
+            write_timeout=TELEGRAM_TIMEOUT,
+            pool_timeout=pool_timeout,
+            http_version="2" if http2 else "1.1",
+        )
+
+    def _build_client(self) -> httpx.AsyncClient:
+        # С явным транспортом httpx не использует limits и http1/http2 клиента
+        transport = PoolMeteredTransport(
+            self._pool_client,
+            limits=httpx.Limits(
+                max_connections=self._pool_size,
+                max_keepalive_connections=self._pool_size,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            http2=self.http_version != "1.1",
+        )
+        kwargs = dict(self._client_kwargs, transport=transport, http1=True)
+        return httpx.AsyncClient(**kwargs)
+
+
+def create_telegram_requests() -> Tuple[HTTPXRequest, HTTPXRequest]:
+    """Запросы Bot API: пул для отправки и отдельный пул для getUpdates."""
+    # Локальный Bot API сервер поддерживает только HTTP/1.1
+    http2 = http2_available() and TELEGRAM_API_BASE_URL.startswith(TELEGRAM_CLOUD_API_URL)
+    return (
+        MeteredHTTPXRequest("telegram", TELEGRAM_POOL_SIZE, TELEGRAM_POOL_TIMEOUT, http2),
+        MeteredHTTPXRequest(
+            "telegram_updates", TELEGRAM_UPDATES_POOL_SIZE, TELEGRAM_POOL_TIMEOUT, http2
+        ),
+    )
@@ -0,0 +1,227 @@
+"""Логирование вне event loop: очередь записей и отдельный поток записи.
+
+Обработчик в event loop только готовит запись (форматирует сообщение) и
+кладёт её в ограниченную очередь; в файл пишет QueueListener в своём
+потоке, там же происходит ротация в полночь. При переполнении очереди
+записи INFO отбрасываются (LOG_QUEUE_POLICY=drop) или event loop ждёт
+места (block); WARNING и выше не отбрасываются. Частые INFO-записи одного
+места в коде можно прореживать (LOG_INFO_SAMPLE_RATE), а в формате JSON
+каждая запись несёт request_id обновления, к которому относится.
+"""
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import sys
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from config import (LOG_DIR, LOG_FORMAT, LOG_INFO_SAMPLE_RATE, LOG_QUEUE_POLICY,
+                    LOG_QUEUE_SIZE)
+from metrics import CounterFunction, GaugeFunction
+
+# Сколько ждать места в очереди для WARNING и выше при политике drop (сек)
+_URGENT_PUT_TIMEOUT = 1.0
+
+# Идентификатор обрабатываемого обновления Telegram ("-" - вне обновления)
+_request_id: ContextVar[str] = ContextVar("request_id", default="-")
+
+
+def get_request_id() -> str:
+    return _request_id.get()
+
+
+def set_request_id(request_id: Optional[str]):
+    """Задаёт request_id текущей задачи (и задач, созданных из неё)."""
+    _request_id.set(request_id or "-")
+
+
+class RequestIdFilter(logging.Filter):
+    """Добавляет к записи request_id из контекста задачи, создавшей её."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = _request_id.get()
+        return True
+
+
+class CallSiteSampler(logging.Filter):
+    """Пропускает каждую N-ю запись INFO и ниже из одного места в коде.
+
+    Первая запись каждого места проходит всегда, поэтому редкие сообщения
+    (запуск, загрузка снимков) не теряются; WARNING и выше не прореживаются.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        # rate 0 - только первая запись каждого места
+        self.every = max(1, round(1 / rate)) if rate > 0 else sys.maxsize
+        self.sampled_out = 0
+        self._counts: Dict[Tuple[str, int], int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.every == 1 or record.levelno >= logging.WARNING:
+            return True
+        key = (record.pathname, record.lineno)
+        count = self._counts.get(key, 0)
+        self._counts[key] = count + 1
+        if count % self.every:
+            self.sampled_out += 1
+            return False
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", "-"),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """QueueHandler с ограниченной очередью и политикой переполнения."""
+
+    def __init__(self, log_queue: queue.Queue, block: bool):
+        super().__init__(log_queue)
+        self.block = block
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Аргументы подставляются сейчас (объекты могут измениться), а
+        # оформление - в потоке записи. Трассировка исключения - текстом
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        if self.block:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno < logging.WARNING:
+                self.dropped += 1
+                return
+            try:
+                self.queue.put(record, timeout=_URGENT_PUT_TIMEOUT)
+            except queue.Full:
+                self.dropped += 1
+
+
+class _BlockingSentinelListener(QueueListener):
+    """QueueListener, дожидающийся места для сигнала остановки в полной очереди."""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+_listener: Optional[QueueListener] = None
+_queue_handler: Optional[BoundedQueueHandler] = None
+_sampler: Optional[CallSiteSampler] = None
+
+
+def setup_logging():
+    """Настройка логирования: очередь записей и файл с ежедневной ротацией."""
+    global _listener, _queue_handler, _sampler
+    log_file = os.path.join(LOG_DIR, "bot.log")
+
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+        )
+
+    file_handler = TimedRotatingFileHandler(
+        log_file,
+        when="midnight",
+        interval=1,
+        backupCount=7,
+        encoding="utf-8",
+    )
+    file_handler.setFormatter(formatter)
+
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _queue_handler = BoundedQueueHandler(log_queue, block=LOG_QUEUE_POLICY == "block")
+    if LOG_INFO_SAMPLE_RATE < 1:
+        _sampler = CallSiteSampler(LOG_INFO_SAMPLE_RATE)
+        _queue_handler.addFilter(_sampler)
+    _queue_handler.addFilter(RequestIdFilter())
+
+    _listener = _BlockingSentinelListener(log_queue, file_handler, respect_handler_level=True)
+    _listener.start()
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(_queue_handler)
+    # Записи в очереди дописываются при любом выходе, в том числе sys.exit
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Дописывает записи из очереди и останавливает поток записи."""
+    global _listener
+    if _listener is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _listener.stop()
+        _listener = None
+
+
+def create_file_logger(name: str, path: str) -> logging.Logger:
+    """Отдельный логгер, пишущий строки как есть в файл path через свою очередь.
+
+    Для машиночитаемых выгрузок (трассировки): записи не попадают в общий
+    лог, политика переполнения - drop.
+    """
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    file_handler = logging.FileHandler(path, encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter("%(message)s"))
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    listener = _BlockingSentinelListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(BoundedQueueHandler(log_queue, block=False))
+    return logger
+
+
+CounterFunction(
+    "bot_log_records_dropped_total", "Log records dropped because the log queue was full",
+    lambda: _queue_handler.dropped if _queue_handler is not None else 0,
+)
+CounterFunction(
+    "bot_log_records_sampled_out_total", "INFO log records skipped by LOG_INFO_SAMPLE_RATE",
+    lambda: _sampler.sampled_out if _sampler is not None else 0,
+)
+GaugeFunction(
+    "bot_log_queue_size", "Log records waiting to be written",
+    lambda: _queue_handler.queue.qsize() if _queue_handler is not None else 0,
+)
@@ -0,0 +1,252 @@
+"""Метрики в текстовом формате Prometheus (без внешних зависимостей).
+
+Запись метрики - инкремент счётчика или поиск корзины гистограммы, без
+блокировок и аллокаций, поэтому метрики включены постоянно. Значения,
+которые уже хранятся в других объектах (размер кэша, очередь запросов),
+не дублируются, а читаются функцией при экспорте.
+"""
+import asyncio
+import os
+import resource
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# Период проверки задержки event loop (сек)
+LOOP_LAG_INTERVAL = 0.5
+
+# Корзины гистограмм задержек (сек): от локальных проверок до ответа OpenAI
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0,
+)
+
+_metrics: List["_Metric"] = []
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        _metrics.append(self)
+        if not self.labelnames:
+            # Метрика без меток экспортируется сразу, с нулевым значением
+            self.labels()
+
+    def labels(self, *values: str):
+        """Дочерняя метрика для значений меток (создаётся один раз)."""
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+            *self._samples(),
+        ]
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    """Монотонный счётчик событий."""
+    type_name = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+            for values, child in list(self._children.items())
+        ]
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        """Измеряет длительность блока (в том числе завершённого исключением)."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам (le - верхняя граница включительно)."""
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, values, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class _FunctionMetric(_Metric):
+    """Значение, вычисляемое при экспорте."""
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], float]):
+        self.function = function
+        super().__init__(name, documentation)
+
+    def labels(self, *values: str):
+        return None
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name} {_format_value(self.function())}"]
+
+
+class GaugeFunction(_FunctionMetric):
+    type_name = "gauge"
+
+
+class CounterFunction(_FunctionMetric):
+    type_name = "counter"
+
+
+def render_metrics() -> str:
+    """Все зарегистрированные метрики в текстовом формате Prometheus.
+
+    Может вызываться из отдельного потока: значения только читаются.
+    """
+    lines: List[str] = []
+    for metric in _metrics:
+        try:
+            lines.extend(metric.render())
+        except Exception as e:
+            lines.append(f"# {metric.name} unavailable: {type(e).__name__}")
+    return "\n".join(lines) + "\n"
+
+
+# Метрики обработки сообщений
+STAGE_LATENCY = Histogram(
+    "bot_stage_duration_seconds",
+    "Duration of message handling stages",
+    labelnames=("stage",),
+)
+RATE_LIMIT_REJECTIONS = Counter(
+    "bot_rate_limit_rejections_total",
+    "Messages rejected by rate limits and token quotas",
+    labelnames=("limit",),
+)
+TELEGRAM_SEND_RETRIES = Counter(
+    "bot_telegram_send_retries_total",
+    "Telegram send attempts retried after network errors",
+)
+
+EVENT_LOOP_LAG = Histogram(
+    "bot_event_loop_lag_seconds",
+    "Delay of a periodic event loop wake-up beyond its schedule",
+)
+_last_loop_lag = 0.0
+GaugeFunction(
+    "bot_event_loop_lag_last_seconds",
+    "Last measured event loop lag",
+    lambda: _last_loop_lag,
+)
+
+
+def _resident_memory_bytes() -> int:
+    """RSS процесса: текущий из /proc, иначе пиковый из getrusage."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+GaugeFunction(
+    "process_resident_memory_bytes", "Resident memory size in bytes", _resident_memory_bytes
+)
+
+
+async def monitor_event_loop_lag(interval: float = LOOP_LAG_INTERVAL):
+    """Измеряет, насколько event loop опаздывает с пробуждением по таймеру.
+
+    Задержка показывает, сколько блокирующей работы выполняется в loop:
+    на столько же откладывается обработка всех остальных обновлений.
+    """
+    global _last_loop_lag
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        _last_loop_lag = max(time.perf_counter() - started - interval, 0.0)
+        EVENT_LOOP_LAG.observe(_last_loop_lag)
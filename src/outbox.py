@@ -0,0 +1,469 @@
+"""Очередь исходящих сообщений Telegram с бюджетами отправки и flood control."""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from telegram import Bot, Message
+from telegram.constants import ChatAction
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from config import (OUTBOX_CHAT_BURST, OUTBOX_CHAT_RATE, OUTBOX_GLOBAL_BURST,
+                    OUTBOX_GLOBAL_RATE, OUTBOX_GROUP_BURST, OUTBOX_GROUP_RATE,
+                    OUTBOX_SEND_ATTEMPTS, WORKER_COUNT)
+from log_pipeline import get_request_id, set_request_id
+from metrics import (STAGE_LATENCY, TELEGRAM_SEND_RETRIES, Counter, CounterFunction,
+                     GaugeFunction)
+
+# Индикатор "печатает..." виден 5 секунд - чаще его отправлять незачем
+TYPING_INTERVAL = 4.0
+
+# Пауза перед повтором после сетевой ошибки: 2, 4, 8... но не больше (сек)
+RETRY_BACKOFF_MAX = 10.0
+
+# Период удаления состояний простаивающих чатов (сек)
+SWEEP_INTERVAL = 60.0
+
+# Общий бюджет бота делится поровну между воркерами: у каждого своя доля
+# OUTBOX_GLOBAL_RATE, вместе они не превышают лимит Telegram на бота
+WORKER_GLOBAL_RATE = OUTBOX_GLOBAL_RATE / WORKER_COUNT
+WORKER_GLOBAL_BURST = max(OUTBOX_GLOBAL_BURST / WORKER_COUNT, 1.0)
+
+_telegram_send_latency = STAGE_LATENCY.labels("telegram_send")
+_send_queue_latency = STAGE_LATENCY.labels("send_queue")
+
+TELEGRAM_FLOOD_WAITS = Counter(
+    "bot_telegram_flood_waits_total",
+    "Telegram sends postponed after RetryAfter (flood control)",
+)
+
+
+class Priority(IntEnum):
+    """Приоритет отправки: меньше - раньше."""
+    HIGH = 0    # Служебные ответы: ошибки, отказы, ответы на команды
+    NORMAL = 1  # Ответы ассистента и правки потокового ответа
+
+
+class _Bucket:
+    """Token bucket: rate отправок в секунду с запасом burst."""
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Через сколько секунд будет доступна отправка (0 - сейчас)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class _EditCall:
+    """Правка сообщения; текст заменяется, пока правка ждёт в очереди."""
+    __slots__ = ("message", "text")
+
+    def __init__(self, message: Message, text: str):
+        self.message = message
+        self.text = text
+
+    def __call__(self) -> Awaitable:
+        return self.message.edit_text(self.text)
+
+
+class _Job:
+    """Одна или несколько отправок, выполняемых подряд (части одного ответа)."""
+    __slots__ = ("priority", "seq", "calls", "sizes", "results", "future",
+                 "enqueued", "attempts", "edit_key", "request_id")
+
+    def __init__(
+        self,
+        priority: Priority,
+        seq: int,
+        calls: List[Callable[[], Awaitable]],
+        sizes: List[int],
+        future: asyncio.Future,
+        batch: bool,
+    ):
+        self.priority = priority
+        self.seq = seq
+        self.calls: Deque[Callable[[], Awaitable]] = deque(calls)
+        self.sizes: Deque[int] = deque(sizes)
+        # Результат пакета - список Message, одиночной отправки - её результат
+        self.results: Optional[List[Any]] = [] if batch else None
+        self.future = future
+        self.enqueued: Optional[float] = time.perf_counter()
+        self.attempts = 0
+        self.edit_key: Optional[Tuple[int, int]] = None
+        self.request_id = get_request_id()
+
+    def __lt__(self, other: "_Job") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _ChatState:
+    """Очередь и бюджет отправки одного чата."""
+    __slots__ = ("chat_id", "jobs", "current", "bucket", "paused_until", "busy", "token")
+
+    def __init__(self, chat_id: int, bucket: _Bucket):
+        self.chat_id = chat_id
+        self.jobs: List[_Job] = []  # heap по (priority, seq)
+        self.current: Optional[_Job] = None  # Начатый ответ из нескольких частей
+        self.bucket = bucket
+        self.paused_until = 0.0
+        self.busy = False
+        self.token = 0  # Номер актуальной записи чата в heap диспетчера
+
+    def head(self) -> Optional[_Job]:
+        if self.current is not None:
+            return self.current
+        return self.jobs[0] if self.jobs else None
+
+
+class TelegramOutbox:
+    """Центральная очередь исходящих сообщений.
+
+    Обработчики ставят отправки в очередь и не ждут их (или ждут future,
+    если нужен отправленный Message). Единственный диспетчер выпускает их
+    в рамках бюджетов Telegram: общего на бота и отдельного на чат (в
+    группах он строже). В чате отправки идут по очереди, в порядке
+    приоритета и постановки; части одного ответа не перемежаются другими
+    сообщениями. Из готовых чатов первым обслуживается чат с более
+    приоритетным и более коротким сообщением.
+
+    RetryAfter приостанавливает чат на указанное Telegram время, сетевые
+    ошибки повторяются с растущей паузой - без sleep в обработчиках.
+    Неотправленная правка сообщения заменяется новой, "печатает..."
+    отправляется не чаще раза в TYPING_INTERVAL и пропускается, когда
+    общий бюджет исчерпан.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = WORKER_GLOBAL_RATE,
+        global_burst: float = WORKER_GLOBAL_BURST,
+        chat_rate: float = OUTBOX_CHAT_RATE,
+        chat_burst: float = OUTBOX_CHAT_BURST,
+        group_rate: float = OUTBOX_GROUP_RATE,
+        group_burst: float = OUTBOX_GROUP_BURST,
+        max_attempts: int = OUTBOX_SEND_ATTEMPTS,
+    ):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_attempts = max_attempts
+        self._global = _Bucket(global_rate, global_burst, time.monotonic())
+        self._chats: Dict[int, _ChatState] = {}
+        # Чаты с отправками: готовые - по (priority, размер, seq), ждущие - по времени
+        self._ready: List[Tuple[int, int, int, int, int]] = []
+        self._waiting: List[Tuple[float, int, int]] = []
+        self._edits: Dict[Tuple[int, int], _Job] = {}
+        # chat_id -> время последнего "печатает..." (в порядке отправки)
+        self._typing: Dict[int, float] = {}
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._sends: set = set()
+        self._next_sweep = 0.0
+        self.queued = 0
+        self.failed = 0
+
+    # Постановка в очередь
+
+    def reply(
+        self, message: Message, text: str, priority: Priority = Priority.NORMAL
+    ) -> asyncio.Future:
+        """Ответ на сообщение. Future - отправленный Message."""
+        job = self._submit(
+            message.chat_id, priority, [lambda: message.reply_text(text)], [len(text)]
+        )
+        return job.future
+
+    def reply_parts(
+        self, message: Message, parts: List[str], priority: Priority = Priority.NORMAL
+    ) -> asyncio.Future:
+        """Ответ из нескольких сообщений подряд. Future - список Message."""
+        calls = [lambda part=part: message.reply_text(part) for part in parts]
+        job = self._submit(
+            message.chat_id, priority, calls, [len(part) for part in parts], batch=True
+        )
+        return job.future
+
+    def edit(
+        self, message: Message, text: str, priority: Priority = Priority.NORMAL
+    ) -> asyncio.Future:
+        """Правка сообщения; ждущая правка того же сообщения заменяется."""
+        key = (message.chat_id, message.message_id)
+        job = self._edits.get(key)
+        if job is not None:
+            job.calls[0].text = text
+            job.sizes[0] = len(text)
+            return job.future
+        job = self._submit(message.chat_id, priority, [_EditCall(message, text)], [len(text)])
+        job.edit_key = key
+        self._edits[key] = job
+        return job.future
+
+    def delete(self, message: Message, priority: Priority = Priority.NORMAL) -> asyncio.Future:
+        """Удаление сообщения."""
+        return self._submit(message.chat_id, priority, [message.delete], [0]).future
+
+    def typing(self, bot: Bot, chat_id: int):
+        """Показывает "печатает..." (best effort, не чаще TYPING_INTERVAL)."""
+        now = time.monotonic()
+        last = self._typing.get(chat_id)
+        if last is not None and now - last < TYPING_INTERVAL:
+            return
+        if self._global.wait_time(now) > 0:
+            return
+        self._global.take(now)
+        self._typing.pop(chat_id, None)
+        self._typing[chat_id] = now
+        # Записи упорядочены по времени - истёкшие удаляются с начала
+        for stale_chat, sent_at in list(itertools.islice(self._typing.items(), 8)):
+            if now - sent_at < TYPING_INTERVAL:
+                break
+            del self._typing[stale_chat]
+        self._spawn(self._send_typing(bot, chat_id))
+
+    async def close(self, timeout: float):
+        """Отправляет оставшиеся сообщения (при остановке бота) и останавливает диспетчер."""
+        deadline = time.monotonic() + timeout
+        while (self.queued or self._sends) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.queued:
+            logging.warning(f"{self.queued} outgoing messages dropped on shutdown")
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _submit(
+        self,
+        chat_id: int,
+        priority: Priority,
+        calls: List[Callable[[], Awaitable]],
+        sizes: List[int],
+        batch: bool = False,
+    ) -> _Job:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # Ошибки отправок логирует диспетчер, future может никто не ждать
+        future.add_done_callback(_retrieve_exception)
+        job = _Job(priority, next(self._seq), calls, sizes, future, batch)
+        if not calls:
+            future.set_result([])
+            return job
+
+        state = self._chats.get(chat_id)
+        if state is None:
+            now = time.monotonic()
+            bucket = (
+                _Bucket(self.group_rate, self.group_burst, now)
+                if chat_id < 0
+                else _Bucket(self.chat_rate, self.chat_burst, now)
+            )
+            state = self._chats[chat_id] = _ChatState(chat_id, bucket)
+        heapq.heappush(state.jobs, job)
+        self.queued += len(calls)
+        self._schedule(state)
+
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+        self._wakeup.set()
+        return job
+
+    # Диспетчер
+
+    def _schedule(self, state: _ChatState):
+        """Ставит чат в очередь диспетчера по его первой отправке."""
+        head = state.head()
+        if state.busy or head is None:
+            return
+        now = time.monotonic()
+        state.token += 1
+        ready_at = max(state.paused_until, now + state.bucket.wait_time(now))
+        if ready_at <= now:
+            heapq.heappush(
+                self._ready, (head.priority, head.sizes[0], head.seq, state.token, state.chat_id)
+            )
+        else:
+            heapq.heappush(self._waiting, (ready_at, state.token, state.chat_id))
+
+    def _promote(self, now: float):
+        """Переносит чаты, у которых истекла пауза, в готовые."""
+        while self._waiting and self._waiting[0][0] <= now:
+            _, token, chat_id = heapq.heappop(self._waiting)
+            state = self._chats.get(chat_id)
+            if state is None or state.token != token or state.busy:
+                continue
+            head = state.head()
+            if head is not None:
+                heapq.heappush(
+                    self._ready, (head.priority, head.sizes[0], head.seq, token, chat_id)
+                )
+
+    def _pop_ready(self) -> Optional[_ChatState]:
+        while self._ready:
+            *_, token, chat_id = heapq.heappop(self._ready)
+            state = self._chats.get(chat_id)
+            if state is not None and state.token == token and not state.busy and state.head():
+                return state
+        return None
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            self._promote(now)
+            if now >= self._next_sweep:
+                self._sweep(now)
+            if not self._ready:
+                await self._sleep(self._waiting[0][0] - now if self._waiting else None)
+                continue
+            delay = self._global.wait_time(now)
+            if delay > 0:
+                await self._sleep(delay)
+                continue
+            state = self._pop_ready()
+            if state is not None:
+                self._dispatch(state, now)
+
+    async def _sleep(self, timeout: Optional[float]):
+        """Ждёт timeout секунд или новой отправки/завершения текущей."""
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _dispatch(self, state: _ChatState, now: float):
+        job = state.current
+        if job is None:
+            job = state.current = heapq.heappop(state.jobs)
+        if job.edit_key is not None and self._edits.get(job.edit_key) is job:
+            # Правка уходит в Telegram - следующие правки встают в очередь заново
+            del self._edits[job.edit_key]
+        if job.enqueued is not None:
+            _send_queue_latency.observe(time.perf_counter() - job.enqueued)
+            job.enqueued = None
+        state.busy = True
+        state.bucket.take(now)
+        self._global.take(now)
+        self._spawn(self._send(state, job))
+
+    async def _send(self, state: _ChatState, job: _Job):
+        set_request_id(job.request_id)
+        try:
+            with _telegram_send_latency.time():
+                result = await job.calls[0]()
+        except RetryAfter as e:
+            TELEGRAM_FLOOD_WAITS.inc()
+            logging.warning(f"Flood control in chat {state.chat_id}: retry in {e.retry_after}s")
+            state.paused_until = time.monotonic() + e.retry_after
+        except BadRequest as e:
+            # Правка тем же текстом - не ошибка
+            if "not modified" in str(e).lower():
+                self._complete_call(job, None)
+            else:
+                self._fail(state, job, e)
+        except NetworkError as e:
+            job.attempts += 1
+            if job.attempts >= self.max_attempts:
+                self._fail(state, job, e)
+            else:
+                TELEGRAM_SEND_RETRIES.inc()
+                state.paused_until = time.monotonic() + min(2 ** job.attempts, RETRY_BACKOFF_MAX)
+        except Exception as e:
+            self._fail(state, job, e)
+        else:
+            self._complete_call(job, result)
+        finally:
+            state.busy = False
+            if not job.calls:
+                state.current = None
+            self._schedule(state)
+            self._wakeup.set()
+
+    def _complete_call(self, job: _Job, result: Any):
+        job.calls.popleft()
+        job.sizes.popleft()
+        job.attempts = 0
+        self.queued -= 1
+        if job.results is not None:
+            job.results.append(result)
+        if not job.calls and not job.future.done():
+            job.future.set_result(job.results if job.results is not None else result)
+
+    def _fail(self, state: _ChatState, job: _Job, error: Exception):
+        """Отменяет оставшиеся отправки задачи."""
+        logging.warning(
+            f"Telegram send to chat {state.chat_id} failed: {type(error).__name__}: {error}"
+        )
+        self.failed += 1
+        self.queued -= len(job.calls)
+        job.calls.clear()
+        job.sizes.clear()
+        if not job.future.done():
+            job.future.set_exception(error)
+
+    async def _send_typing(self, bot: Bot, chat_id: int):
+        try:
+            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        except Forbidden:
+            logging.warning(f"User {chat_id} blocked the bot")
+        except Exception as e:
+            logging.debug(f"Typing action for chat {chat_id} failed: {e}")
+
+    def _spawn(self, coro: Awaitable):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._sends.add(task)
+        task.add_done_callback(self._sends.discard)
+
+    def _sweep(self, now: float):
+        """Удаляет состояния чатов без отправок с восстановленным бюджетом."""
+        self._next_sweep = now + SWEEP_INTERVAL
+        idle = [
+            chat_id
+            for chat_id, state in self._chats.items()
+            if not state.busy and state.head() is None
+            and state.paused_until <= now and state.bucket.full(now)
+        ]
+        for chat_id in idle:
+            del self._chats[chat_id]
+
+
+def _retrieve_exception(future: asyncio.Future):
+    if not future.cancelled():
+        future.exception()
+
+
+# Общая очередь исходящих сообщений бота
+outbox = TelegramOutbox()
+
+GaugeFunction(
+    "bot_outbox_queued", "Outgoing Telegram messages waiting to be sent",
+    lambda: outbox.queued,
+)
+CounterFunction(
+    "bot_outbox_failed_total", "Outgoing Telegram messages dropped after errors",
+    lambda: outbox.failed,
+)
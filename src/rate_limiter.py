@@ -0,0 +1,98 @@
+"""Rate limiter в памяти процесса: sliding window counter за O(1) на проверку."""
+import time
+from typing import Dict, Hashable, Optional, Sequence, Tuple
+
+# Проверка лимита: (ключ, максимум сообщений за окно)
+LimitCheck = Tuple[Hashable, int]
+
+
+class _Window:
+    """Счётчики ключа: начало текущего окна, сообщения в прошлом и текущем окне."""
+    __slots__ = ("start", "prev", "cur")
+
+    def __init__(self, start: float):
+        self.start = start
+        self.prev = 0
+        self.cur = 0
+
+
+class SlidingWindowLimiter:
+    """Лимит сообщений за скользящее окно по двум счётчикам на ключ.
+
+    Время делится на окна длиной window; число сообщений за последние
+    window секунд оценивается как prev * (доля прошлого окна в интервале) +
+    cur. Алгоритм тот же, что у SharedRateLimiter, поэтому лимиты ведут себя
+    одинаково в одно- и многопроцессном режиме.
+
+    Ключи хранятся в dict в порядке последнего обращения (при обращении ключ
+    переставляется в конец), поэтому устаревшие - без сообщений два окна -
+    лежат в начале, и sweep удаляет их за O(числа удалённых). При
+    периодическом sweep память пропорциональна числу активных пользователей,
+    а не всех, кто когда-либо писал боту.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._windows: Dict[Hashable, _Window] = {}
+        # Начало текущего окна: один объект float на все ключи окна
+        self._window_start = 0.0
+
+    def allow(self, checks: Sequence[LimitCheck], now: Optional[float] = None) -> bool:
+        """Учитывает сообщение, если не превышен ни один из лимитов.
+
+        Проверки выполняются все или ни одна: отклонённое сообщение не
+        расходует лимиты остальных ключей.
+        """
+        if now is None:
+            now = time.monotonic()
+        window_start = now // self.window * self.window
+        if window_start == self._window_start:
+            window_start = self._window_start
+        else:
+            self._window_start = window_start
+        elapsed = (now - window_start) / self.window
+
+        windows = []
+        for key, limit in checks:
+            entry = self._get(key, window_start)
+            if entry.prev * (1 - elapsed) + entry.cur >= limit:
+                return False
+            windows.append(entry)
+
+        for entry in windows:
+            entry.cur += 1
+        return True
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """Удаляет ключи без сообщений за последние два окна."""
+        if now is None:
+            now = time.monotonic()
+        return self._evict(now // self.window * self.window - self.window)
+
+    def __len__(self) -> int:
+        return len(self._windows)
+
+    def _get(self, key: Hashable, window_start: float) -> _Window:
+        """Возвращает счётчики ключа, сдвинутые к текущему окну."""
+        entry = self._windows.pop(key, None)
+        if entry is None:
+            entry = self._windows[key] = _Window(window_start)
+            return entry
+
+        self._windows[key] = entry
+        if entry.start != window_start:
+            entry.prev = entry.cur if entry.start == window_start - self.window else 0
+            entry.cur = 0
+            entry.start = window_start
+        return entry
+
+    def _evict(self, stale_before: float) -> int:
+        """Удаляет ключи с началом окна раньше stale_before (с начала порядка)."""
+        stale = []
+        for key, entry in self._windows.items():
+            if entry.start >= stale_before:
+                break
+            stale.append(key)
+        for key in stale:
+            del self._windows[key]
+        return len(stale)
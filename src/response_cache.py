@@ -0,0 +1,253 @@
+"""Кэш ответов на повторяющиеся первые вопросы к одному prompt."""
+import asyncio
+import logging
+import random
+import re
+import unicodedata
+import zlib
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional, Set, Tuple
+
+from cache import LRUCache
+from citations import Citation, ProcessedResponse
+from config import (PROMPT_ID, RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_MAX_CHARS,
+                    RESPONSE_CACHE_MAX_SIZE, RESPONSE_CACHE_SIMILARITY,
+                    RESPONSE_CACHE_SNAPSHOT_PATH, RESPONSE_CACHE_TTL_HOURS, Settings,
+                    on_settings_reload)
+from metrics import CounterFunction, GaugeFunction
+from utils import write_file_atomic
+
+# MinHash: BANDS полос по ROWS значений подписи (LSH). Кандидат находится,
+# если совпала хотя бы одна полоса - с вероятностью ~0.5 уже при сходстве 0.5
+MINHASH_BANDS = 16
+MINHASH_ROWS = 4
+# Длина символьных n-грамм (устойчивы к окончаниям слов)
+SHINGLE_SIZE = 4
+
+_MERSENNE_PRIME = (1 << 61) - 1
+# Фиксированное зерно: подписи из снимка остаются сравнимыми после перезапуска
+_rng = random.Random(0x5EED)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+    for _ in range(MINHASH_BANDS * MINHASH_ROWS)
+]
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]+")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_question(text: str) -> str:
+    """Приводит вопрос к каноническому виду: регистр, ё, пунктуация, пробелы."""
+    text = unicodedata.normalize("NFKC", text).casefold().replace("ё", "е")
+    text = _PUNCTUATION_RE.sub(" ", text)
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def minhash_signature(text: str) -> List[int]:
+    """MinHash-подпись множества символьных n-грамм текста."""
+    padded = f" {text} "
+    shingles = list({
+        zlib.crc32(padded[i:i + SHINGLE_SIZE].encode())
+        for i in range(max(len(padded) - SHINGLE_SIZE + 1, 1))
+    })
+    # Стоимость - число n-грамм на число перестановок (~1 мс на 50 символов)
+    return [min([(a * shingle + b) % _MERSENNE_PRIME for shingle in shingles])
+            for a, b in _PERMUTATIONS]
+
+
+def _bands(signature: List[int]) -> List[Tuple[int, int]]:
+    return [
+        (band, hash(tuple(signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS])))
+        for band in range(MINHASH_BANDS)
+    ]
+
+
+@dataclass
+class CachedAnswer:
+    """Обработанный ответ на вопрос.
+
+    response_id ответа не хранится: цепочка другого пользователя не должна
+    становиться контекстом диалога того, кто получил ответ из кэша.
+    """
+    processed: ProcessedResponse
+
+
+def _encode(answer: CachedAnswer) -> dict:
+    return asdict(answer)
+
+
+def _decode(value: dict) -> CachedAnswer:
+    processed = value["processed"]
+    return CachedAnswer(
+        processed=ProcessedResponse(
+            text=processed["text"],
+            citations=[Citation(**citation) for citation in processed["citations"]],
+            footnotes=processed["footnotes"],
+        ),
+    )
+
+
+class ResponseCache:
+    """LRU-кэш ответов на первые сообщения диалога (без previous_response_id).
+
+    Ключ - PROMPT_ID и нормализованный текст вопроса, значение - готовый к
+    отправке ProcessedResponse (citations уже обработаны). При similarity > 0
+    вопрос, не совпавший точно, ищется среди похожих по MinHash с
+    LSH-индексом: подходит ответ с оценкой сходства n-грамм не ниже
+    similarity.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = RESPONSE_CACHE_ENABLED,
+        maxsize: int = RESPONSE_CACHE_MAX_SIZE,
+        ttl: float = RESPONSE_CACHE_TTL_HOURS * 3600,
+        max_chars: int = RESPONSE_CACHE_MAX_CHARS,
+        similarity: float = RESPONSE_CACHE_SIMILARITY,
+        prompt_id: Optional[str] = PROMPT_ID,
+        snapshot_path: str = RESPONSE_CACHE_SNAPSHOT_PATH,
+    ):
+        self.enabled = enabled
+        self.max_chars = max_chars
+        self.similarity = similarity
+        self.prefix = f"{prompt_id}:"
+        self.snapshot_path = snapshot_path
+        self._cache = LRUCache(maxsize=maxsize, ttl=ttl)
+        # Подписи и LSH-индекс; записи, вытесненные из кэша, удаляются при перестроении
+        self._signatures: Dict[str, List[int]] = {}
+        self._index: Dict[Tuple[int, int], Set[str]] = {}
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def key(self, text: str) -> Optional[str]:
+        """Ключ кэша для вопроса (None - вопрос не кэшируется)."""
+        if not self.enabled or len(text) > self.max_chars:
+            return None
+        normalized = normalize_question(text)
+        return self.prefix + normalized if normalized else None
+
+    def get(self, key: str) -> Optional[CachedAnswer]:
+        answer = self._cache.get(key)
+        if answer is not None:
+            self.hits += 1
+            return answer
+        if self.similarity > 0:
+            similar = self._find_similar(key)
+            if similar is not None:
+                answer = self._cache.get(similar)
+                if answer is not None:
+                    self.near_hits += 1
+                    return answer
+        self.misses += 1
+        return None
+
+    def put(self, key: str, processed: ProcessedResponse):
+        self._cache.set(key, CachedAnswer(processed=processed))
+        if self.similarity > 0:
+            self._add_signature(key)
+
+    def _add_signature(self, key: str, signature: Optional[List[int]] = None):
+        if key in self._signatures:
+            return
+        if signature is None:
+            signature = minhash_signature(key[len(self.prefix):])
+        self._signatures[key] = signature
+        for band in _bands(signature):
+            self._index.setdefault(band, set()).add(key)
+        if len(self._signatures) > 2 * len(self._cache) + 100:
+            self._rebuild_index()
+
+    def _rebuild_index(self):
+        """Перестраивает индекс по ключам кэша (вытесненные ключи удаляются)."""
+        signatures = self._signatures
+        self._signatures = {}
+        self._index = {}
+        for key in self._cache.keys():
+            self._add_signature(key, signatures.get(key))
+
+    def _find_similar(self, key: str) -> Optional[str]:
+        signature = minhash_signature(key[len(self.prefix):])
+        candidates: Set[str] = set()
+        for band in _bands(signature):
+            candidates.update(self._index.get(band, ()))
+
+        best_key, best_score = None, self.similarity
+        for candidate in candidates:
+            if candidate not in self._cache:
+                continue
+            other = self._signatures[candidate]
+            score = sum(a == b for a, b in zip(signature, other)) / len(signature)
+            if score >= best_score:
+                best_key, best_score = candidate, score
+        return best_key
+
+    def clear(self):
+        self._cache.clear()
+        self._signatures = {}
+        self._index = {}
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def load_snapshot(self):
+        """Загружает снимок кэша с диска (если включён)."""
+        if not self.enabled or not self.snapshot_path:
+            return
+        self._cache.load(self.snapshot_path, decode=_decode)
+        # Ответы другого prompt не подойдут
+        for key in self._cache.keys():
+            if not key.startswith(self.prefix):
+                self._cache.pop(key)
+        if self.similarity > 0:
+            self._rebuild_index()
+        logging.info(f"Response cache snapshot loaded: {len(self._cache)} entries")
+
+    async def save_snapshot(self):
+        """Сохраняет кэш на диск вне event loop."""
+        if not self.enabled or not self.snapshot_path:
+            return
+        try:
+            payload = self._cache.dumps(encode=_encode)
+            await asyncio.to_thread(write_file_atomic, self.snapshot_path, payload)
+        except Exception as e:
+            logging.error(f"Error saving response cache snapshot: {e}")
+
+    async def cleanup(self):
+        """Удаляет истёкшие ответы и обновляет снимок (фоновая задача)."""
+        if not self.enabled:
+            return
+        evicted = self._cache.evict_expired()
+        if evicted:
+            logging.info(f"Evicted {evicted} expired response cache entries")
+            self._rebuild_index()
+        await self.save_snapshot()
+
+
+# Кэш ответов бота (включается RESPONSE_CACHE_ENABLED)
+response_cache = ResponseCache()
+
+
+@on_settings_reload
+def _clear_on_format_change(old: Settings, new: Settings):
+    # Кэшированные ответы уже очищены и отформатированы по прежним правилам
+    fields = ("remove_chunks_for_files", "remove_chunk_markers", "enable_citations",
+              "citations_show_quotes", "citations_max_quote_length")
+    if any(getattr(old, name) != getattr(new, name) for name in fields):
+        response_cache.clear()
+
+
+CounterFunction(
+    "bot_response_cache_hits_total", "Questions answered from the response cache",
+    lambda: response_cache.hits,
+)
+CounterFunction(
+    "bot_response_cache_near_hits_total",
+    "Questions answered from the response cache by a near-duplicate match",
+    lambda: response_cache.near_hits,
+)
+CounterFunction(
+    "bot_response_cache_misses_total", "First-turn questions not found in the response cache",
+    lambda: response_cache.misses,
+)
+GaugeFunction("bot_response_cache_entries", "Response cache size", lambda: len(response_cache))
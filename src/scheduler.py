@@ -0,0 +1,145 @@
+"""Планировщик запросов к OpenAI - порядок в диалоге и лимиты параллельности."""
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Deque, Dict, List, Set, Tuple
+
+from config import MAX_CONCURRENT_PER_CHAT, MAX_CONCURRENT_REQUESTS, REQUEST_QUEUE_SIZE
+from log_pipeline import get_request_id, set_request_id
+from metrics import STAGE_LATENCY
+
+# Задача планировщика - корутина без аргументов
+Job = Callable[[], Awaitable[None]]
+
+# Тип ключа: (chat_id, user_id)
+ConversationKey = Tuple[int, int]
+
+# Ожидание в очереди: от submit до получения слота
+_queue_wait_latency = STAGE_LATENCY.labels("queue_wait")
+
+
+@dataclass
+class SchedulerStats:
+    """Снимок состояния очереди запросов."""
+    queued: int                 # Ожидают свободного слота
+    in_flight: int              # Выполняются сейчас
+    active_conversations: int   # Диалогов с незавершёнными задачами
+    active_chats: int           # Чатов с незавершёнными задачами
+    rejected: int               # Отклонено из-за переполнения (всего)
+
+
+class RequestScheduler:
+    """Очередь запросов с упорядочиванием по диалогу и справедливыми лимитами.
+
+    Задачи одного (chat_id, user_id) выполняются строго по очереди, поэтому
+    следующий запрос видит previous_response_id предыдущего. Одновременно
+    выполняется не больше max_concurrent задач, из них не больше max_per_chat
+    из одного чата - загруженная группа не занимает все слоты. Общее число
+    задач (в очереди и выполняющихся) ограничено max_queue: при переполнении
+    submit возвращает False, и обработчик отвечает пользователю отказом.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = MAX_CONCURRENT_REQUESTS,
+        max_per_chat: int = MAX_CONCURRENT_PER_CHAT,
+        max_queue: int = REQUEST_QUEUE_SIZE,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_per_chat = max_per_chat
+        self.max_queue = max_queue
+        self._global_slots = asyncio.Semaphore(max_concurrent)
+        # chat_id -> [семафор чата, число диалогов чата с задачами]
+        self._chat_slots: Dict[int, List] = {}
+        # Задачи диалога с временем постановки в очередь
+        self._queues: Dict[ConversationKey, Deque[Tuple[Job, float, str]]] = {}
+        self._workers: Set[asyncio.Task] = set()
+        self.pending = 0
+        self.in_flight = 0
+        self.rejected = 0
+
+    def submit(self, chat_id: int, user_id: int, job: Job) -> bool:
+        """Ставит задачу в очередь диалога. False - очередь переполнена."""
+        if self.pending >= self.max_queue:
+            self.rejected += 1
+            logging.warning(
+                f"Request queue is full ({self.pending}), rejecting chat={chat_id}, user={user_id}"
+            )
+            return False
+
+        self.pending += 1
+        key = (chat_id, user_id)
+        # request_id - чтобы записи лога задачи относились к её обновлению
+        entry = (job, time.perf_counter(), get_request_id())
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(entry)
+            return True
+
+        self._queues[key] = deque([entry])
+        worker = asyncio.get_running_loop().create_task(self._drain(key))
+        self._workers.add(worker)
+        worker.add_done_callback(self._workers.discard)
+        return True
+
+    def has_pending(self, chat_id: int, user_id: int) -> bool:
+        """Есть ли у диалога задачи в очереди или в работе."""
+        return (chat_id, user_id) in self._queues
+
+    def stats(self) -> SchedulerStats:
+        """Возвращает текущие метрики очереди."""
+        return SchedulerStats(
+            queued=self.pending - self.in_flight,
+            in_flight=self.in_flight,
+            active_conversations=len(self._queues),
+            active_chats=len(self._chat_slots),
+            rejected=self.rejected,
+        )
+
+    async def drain(self, timeout: float):
+        """Ждёт завершения поставленных задач (при остановке бота)."""
+        if not self._workers:
+            return
+        _, pending = await asyncio.wait(set(self._workers), timeout=timeout)
+        if pending:
+            logging.warning(f"{len(pending)} conversations still busy after {timeout}s")
+
+    def _acquire_chat(self, chat_id: int) -> asyncio.Semaphore:
+        entry = self._chat_slots.get(chat_id)
+        if entry is None:
+            entry = self._chat_slots[chat_id] = [asyncio.Semaphore(self.max_per_chat), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _release_chat(self, chat_id: int):
+        entry = self._chat_slots[chat_id]
+        entry[1] -= 1
+        if not entry[1]:
+            del self._chat_slots[chat_id]
+
+    async def _drain(self, key: ConversationKey):
+        """Последовательно выполняет задачи одного диалога."""
+        chat_id = key[0]
+        queue = self._queues[key]
+        chat_slots = self._acquire_chat(chat_id)
+        try:
+            while queue:
+                job, submitted_at, request_id = queue.popleft()
+                set_request_id(request_id)
+                try:
+                    async with chat_slots, self._global_slots:
+                        _queue_wait_latency.observe(time.perf_counter() - submitted_at)
+                        self.in_flight += 1
+                        try:
+                            await job()
+                        finally:
+                            self.in_flight -= 1
+                except Exception as e:
+                    logging.exception(f"Unhandled error in scheduled job for {key}: {e}")
+                finally:
+                    self.pending -= 1
+        finally:
+            del self._queues[key]
+            self._release_chat(chat_id)
@@ -0,0 +1,153 @@
+"""Встроенный HTTP-сервер (ASGI): webhook Telegram, health и метрики."""
+import asyncio
+import contextlib
+import hmac
+import json
+import logging
+from typing import Optional
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+from telegram import Update
+from telegram.ext import Application
+
+from cluster import (INTERNAL_UPDATE_PATH, WORKER_SECRET_HEADER, forward_update,
+                     is_local_chat, is_multi_worker)
+from config import (BOT_MODE, HEALTH_CHECK_ENABLED, HTTP_LISTEN, HTTP_PORT, METRICS_LISTEN,
+                    METRICS_PORT, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN, WORKER_SECRET)
+from metrics import render_metrics
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class EmbeddedServer(uvicorn.Server):
+    """uvicorn без собственных обработчиков сигналов.
+
+    Остановкой управляет бот: сервер завершается через should_exit после
+    того, как бот получил SIGTERM/SIGINT.
+    """
+
+    def install_signal_handlers(self):
+        pass
+
+    @contextlib.contextmanager
+    def capture_signals(self):
+        yield
+
+
+async def metrics(request: Request) -> Response:
+    """Метрики в формате Prometheus.
+
+    Формируются в отдельном потоке: часть значений (число conversations в
+    SQLite) читается из базы.
+    """
+    body = await asyncio.to_thread(render_metrics)
+    return PlainTextResponse(body, media_type=METRICS_CONTENT_TYPE)
+
+
+def create_web_app(application: Application) -> Starlette:
+    """Создаёт ASGI-приложение: /healthz, /metrics, приём обновлений webhook и от воркеров."""
+
+    async def telegram_webhook(request: Request) -> Response:
+        """Принимает Update от Telegram и передаёт его в очередь Application.
+
+        В многопроцессном режиме обновления чужих чатов пересылаются
+        воркеру-владельцу; при ошибке пересылки Telegram повторит доставку.
+        """
+        if WEBHOOK_SECRET_TOKEN:
+            token = request.headers.get(SECRET_TOKEN_HEADER, "")
+            if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET_TOKEN.encode()):
+                logging.warning("Webhook request with invalid secret token")
+                return Response(status_code=403)
+
+        body = await request.body()
+        update = _parse_update(body)
+        if update is None:
+            return Response(status_code=400)
+
+        chat = update.effective_chat
+        if chat is not None and not is_local_chat(chat.id):
+            forwarded = await forward_update(chat.id, body)
+            return Response(status_code=200 if forwarded else 503)
+
+        await application.update_queue.put(update)
+        return Response(status_code=200)
+
+    async def internal_update(request: Request) -> Response:
+        """Принимает обновление, пересланное другим воркером."""
+        token = request.headers.get(WORKER_SECRET_HEADER, "")
+        if not WORKER_SECRET or not hmac.compare_digest(token.encode(), WORKER_SECRET.encode()):
+            return Response(status_code=403)
+
+        update = _parse_update(await request.body())
+        if update is None:
+            return Response(status_code=400)
+
+        await application.update_queue.put(update)
+        return Response(status_code=200)
+
+    def _parse_update(body: bytes):
+        try:
+            return Update.de_json(json.loads(body), application.bot)
+        except Exception as e:
+            logging.warning(f"Invalid webhook payload: {e}")
+            return None
+
+    async def healthz(request: Request) -> Response:
+        """Health check: бот запущен и получает обновления."""
+        healthy = application.running
+        if BOT_MODE == "polling":
+            healthy = healthy and application.updater.running
+        return JSONResponse(
+            {"status": "ok" if healthy else "unavailable", "mode": BOT_MODE},
+            status_code=200 if healthy else 503,
+        )
+
+    routes = [Route("/healthz", healthz, methods=["GET"])]
+    if not METRICS_PORT:
+        routes.append(Route("/metrics", metrics, methods=["GET"]))
+    if BOT_MODE == "webhook":
+        routes.append(Route(WEBHOOK_PATH, telegram_webhook, methods=["POST"]))
+    if is_multi_worker():
+        routes.append(Route(INTERNAL_UPDATE_PATH, internal_update, methods=["POST"]))
+    return Starlette(routes=routes)
+
+
+def _embedded_server(app: Starlette, host: str, port: int) -> EmbeddedServer:
+    config = uvicorn.Config(
+        app,
+        host=host,
+        port=port,
+        log_config=None,
+        access_log=False,
+        lifespan="off",
+    )
+    return EmbeddedServer(config)
+
+
+def create_server(application: Application) -> Optional[EmbeddedServer]:
+    """Создаёт uvicorn-сервер для ASGI-приложения бота.
+
+    В режиме polling сервер нужен только для /healthz (HEALTH_CHECK_ENABLED)
+    или /metrics на HTTP_PORT; иначе None и порт не занимается.
+    """
+    if BOT_MODE == "polling" and not HEALTH_CHECK_ENABLED and METRICS_PORT:
+        return None
+    return _embedded_server(create_web_app(application), HTTP_LISTEN, HTTP_PORT)
+
+
+def create_metrics_server() -> Optional[EmbeddedServer]:
+    """Сервер /metrics на METRICS_LISTEN:METRICS_PORT (None - /metrics на HTTP_PORT).
+
+    Метрики (число чатов, очереди, квоты) не публикуются на порту webhook,
+    если оператор явно не задал METRICS_PORT=0.
+    """
+    if not METRICS_PORT:
+        return None
+    app = Starlette(routes=[Route("/metrics", metrics, methods=["GET"])])
+    return _embedded_server(app, METRICS_LISTEN, METRICS_PORT)
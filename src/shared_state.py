@@ -0,0 +1,100 @@
+"""Общее состояние воркеров в SQLite на общем томе (многопроцессный режим)."""
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Sequence, Tuple
+
+from config import SHARED_STATE_PATH
+
+
+def open_sqlite(path) -> sqlite3.Connection:
+    """Открывает SQLite в режиме WAL, с ожиданием блокировок других процессов."""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(
+        path, check_same_thread=False, isolation_level=None, timeout=5.0
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class SharedRateLimiter:
+    """Rate limiter со счётчиками в общей SQLite (sliding window counter).
+
+    На ключ хранятся начало текущего окна и два счётчика: предыдущего и
+    текущего окна. Оценка числа сообщений за последние window секунд -
+    prev * (доля предыдущего окна, попадающая в интервал) + cur.
+    Проверка и инкремент выполняются одной транзакцией BEGIN IMMEDIATE,
+    поэтому воркеры не теряют инкременты друг друга.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            key TEXT PRIMARY KEY,
+            window_start INTEGER NOT NULL,
+            prev_count INTEGER NOT NULL,
+            cur_count INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_rate_limits_window_start
+            ON rate_limits (window_start);
+    """
+
+    def __init__(self, db_path: str = SHARED_STATE_PATH):
+        self._lock = threading.Lock()
+        self._conn = open_sqlite(db_path)
+        self._conn.executescript(self._SCHEMA)
+
+    def allow(self, checks: Sequence[Tuple[str, int]], window: int) -> bool:
+        """Учитывает сообщение, если не превышен ни один из лимитов (ключ, максимум).
+
+        Все ключи проверяются и обновляются в одной транзакции; отклонённое
+        сообщение не расходует лимиты.
+        """
+        now = time.time()
+        window_start = int(now // window) * window
+        elapsed = (now - window_start) / window
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                counters = []
+                allowed = True
+                for key, limit in checks:
+                    row = self._conn.execute(
+                        "SELECT window_start, prev_count, cur_count FROM rate_limits "
+                        "WHERE key = ?",
+                        (key,),
+                    ).fetchone()
+
+                    prev_count, cur_count = 0, 0
+                    if row is not None:
+                        if row[0] == window_start:
+                            prev_count, cur_count = row[1], row[2]
+                        elif row[0] == window_start - window:
+                            prev_count = row[2]
+
+                    if prev_count * (1 - elapsed) + cur_count >= limit:
+                        allowed = False
+                        break
+                    counters.append((key, window_start, prev_count, cur_count + 1))
+
+                if allowed:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO rate_limits "
+                        "(key, window_start, prev_count, cur_count) VALUES (?, ?, ?, ?)",
+                        counters,
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return allowed
+
+    def sweep(self, window: int) -> int:
+        """Удаляет счётчики без сообщений за последние два окна."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM rate_limits WHERE window_start < ?",
+                (time.time() - 2 * window,),
+            )
+            return cursor.rowcount
@@ -0,0 +1,88 @@
+"""Потоковый вывод ответа в Telegram через редактирование сообщений."""
+import asyncio
+import logging
+import time
+from typing import Dict, List
+
+from telegram import Message
+from telegram.error import BadRequest
+
+from outbox import outbox
+from utils import split_message
+
+
+class StreamingReply:
+    """Ответ, который постепенно выводится в одно или несколько сообщений.
+
+    Текст накапливается из delta-событий и не чаще раза в edit_interval
+    переносится в Telegram через outbox: первая часть отправляется как
+    reply, дальше сообщения редактируются (ещё не отправленная правка
+    заменяется новой, flood control соблюдает outbox). При превышении
+    лимита split_message ответ продолжается в новом сообщении. finalize
+    заменяет черновик итоговым текстом (с обработанными citations) без
+    учёта интервала и ждёт доставки, discard удаляет черновик прерванного
+    ответа.
+    """
+
+    def __init__(self, message: Message, edit_interval: float):
+        self.message = message
+        self.edit_interval = edit_interval
+        self.text = ""
+        self.sent: List[Message] = []
+        self._shown: List[str] = []
+        # Последняя поставленная в очередь правка каждого сообщения
+        self._edits: Dict[int, asyncio.Future] = {}
+        self._next_sync = 0.0
+
+    async def append(self, delta: str):
+        """Добавляет фрагмент ответа и при необходимости обновляет сообщения."""
+        self.text += delta
+        if time.monotonic() < self._next_sync or not self.text.strip():
+            return
+        await self._sync(self.text)
+        self._next_sync = time.monotonic() + self.edit_interval
+
+    async def finalize(self, text: str):
+        """Приводит отправленные сообщения к итоговому тексту ответа."""
+        await self._sync(text)
+        await asyncio.gather(*self._edits.values())
+
+        # Итоговый текст мог оказаться короче черновика
+        parts_count = len(self._parts(text))
+        for extra in self.sent[parts_count:]:
+            try:
+                await outbox.delete(extra)
+            except BadRequest as e:
+                logging.warning(f"Не удалось удалить лишнюю часть ответа: {e}")
+        del self.sent[parts_count:]
+        del self._shown[parts_count:]
+
+    async def discard(self):
+        """Удаляет черновик ответа, прерванного ошибкой.
+
+        Удаление встаёт в очередь outbox после ждущих правок тех же сообщений.
+        """
+        results = await asyncio.gather(
+            *(outbox.delete(message) for message in self.sent), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logging.warning(f"Не удалось удалить черновик ответа: {result}")
+        self.sent.clear()
+        self._shown.clear()
+        self._edits.clear()
+
+    @staticmethod
+    def _parts(text: str) -> List[str]:
+        return [part for part in split_message(text) if part.strip()]
+
+    async def _sync(self, text: str):
+        """Отправляет новые части и ставит в очередь правки изменившихся."""
+        for i, part in enumerate(self._parts(text)):
+            if i < len(self.sent):
+                if self._shown[i] != part:
+                    self._edits[i] = outbox.edit(self.sent[i], part)
+                    self._shown[i] = part
+            else:
+                self.sent.append(await outbox.reply(self.message, part))
+                self._shown.append(part)
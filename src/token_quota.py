@@ -0,0 +1,348 @@
+"""Дневные квоты токенов OpenAI на пользователя, чат и бота в целом."""
+import asyncio
+import json
+import logging
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from config import (SHARED_STATE_PATH, TOKEN_CACHED_WEIGHT, TOKEN_ESTIMATE_CHARS,
+                    TOKEN_ESTIMATE_OVERHEAD, TOKEN_OUTPUT_WEIGHT, TOKEN_USAGE_PATH,
+                    WORKER_COUNT, Settings, get_settings, on_settings_reload)
+from shared_state import open_sqlite
+from utils import write_file_atomic
+
+# Вес нового наблюдения в скользящих средних оценки запроса
+_ESTIMATE_ALPHA = 0.1
+
+# Счётчики ключа за день: [input, output, cached]
+Counters = List[int]
+
+
+@dataclass
+class TokenUsage:
+    """Токены одного ответа из блока usage Responses API."""
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0
+
+
+@dataclass
+class Reservation:
+    """Оценка стоимости запроса, зарезервированная до получения usage."""
+    keys: List[str]
+    text_tokens: int
+    cost: float
+    active: bool = field(default=True)
+
+
+def usage_from_response(response) -> TokenUsage:
+    """Извлекает usage из ответа Responses API (нули, если блока нет)."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return TokenUsage()
+    details = getattr(usage, "input_tokens_details", None)
+    return TokenUsage(
+        input_tokens=getattr(usage, "input_tokens", 0) or 0,
+        output_tokens=getattr(usage, "output_tokens", 0) or 0,
+        cached_tokens=getattr(details, "cached_tokens", 0) or 0,
+    )
+
+
+def token_cost(input_tokens: float, output_tokens: float, cached_tokens: float = 0) -> float:
+    """Стоимость в условных токенах: вывод и кэшированный ввод - с весами."""
+    return (
+        input_tokens - cached_tokens
+        + cached_tokens * TOKEN_CACHED_WEIGHT
+        + output_tokens * TOKEN_OUTPUT_WEIGHT
+    )
+
+
+def _today() -> str:
+    return datetime.now(timezone.utc).date().isoformat()
+
+
+class TokenQuota:
+    """Учёт токенов за сутки (UTC) и проверка квот до запроса к OpenAI.
+
+    Перед постановкой запроса в очередь reserve оценивает его стоимость:
+    токены текста сообщения плюс средние по последним ответам добавка
+    контекста (prompt, история, file_search) и объём ответа. Оценка
+    резервируется, поэтому параллельные запросы не превышают квоту вместе;
+    commit заменяет её фактическим usage, release снимает при ошибке.
+
+    Счётчики сбрасываются на диск отложенно (flush из job_queue) в JSON или,
+    в многопроцессном режиме, прибавляются к общей таблице SQLite, из
+    которой воркер перечитывает итоги всех воркеров.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS token_usage (
+            day TEXT NOT NULL,
+            key TEXT NOT NULL,
+            input_tokens INTEGER NOT NULL,
+            output_tokens INTEGER NOT NULL,
+            cached_tokens INTEGER NOT NULL,
+            PRIMARY KEY (day, key)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(
+        self,
+        file_path: str = TOKEN_USAGE_PATH,
+        user_limit: Optional[int] = None,
+        chat_limit: Optional[int] = None,
+        global_limit: Optional[int] = None,
+        db_path: Optional[str] = None,
+    ):
+        self.file_path = Path(file_path)
+        settings = get_settings()
+        self.user_limit = settings.token_quota_user_daily if user_limit is None else user_limit
+        self.chat_limit = settings.token_quota_chat_daily if chat_limit is None else chat_limit
+        self.global_limit = (
+            settings.token_quota_global_daily if global_limit is None else global_limit
+        )
+        self.day = _today()
+        # Итоги на момент последней записи/чтения и изменения после неё
+        self._base: Dict[str, Counters] = {}
+        self._pending: Dict[str, Counters] = {}
+        self._reserved: Dict[str, float] = {}
+        self._unsaved = False
+        # Несохранённые изменения прошедших суток: (день, счётчики) для flush
+        self._rolled: List[Tuple[str, Dict[str, Counters]]] = []
+        self._input_overhead = float(TOKEN_ESTIMATE_OVERHEAD)
+        self._output_estimate = float(TOKEN_ESTIMATE_OVERHEAD) / 4
+        self._write_lock = threading.Lock()
+        self._db = None
+        if db_path:
+            self._db = open_sqlite(db_path)
+            self._db.executescript(self._SCHEMA)
+            self._base = self._read_db(self.day)
+        else:
+            self._load()
+
+    def _load(self):
+        """Загружает счётчики текущих суток из файла"""
+        if not self.file_path.exists():
+            return
+        try:
+            data = json.loads(self.file_path.read_text(encoding="utf-8"))
+            if data.get("day") == self.day:
+                self._base = data.get("usage", {})
+        except Exception as e:
+            logging.error(f"Error loading token usage: {e}")
+
+    def _roll_day(self):
+        """Начинает новые сутки: квоты обнуляются.
+
+        Несохранённые изменения прошлых суток не теряются: ближайший flush
+        запишет их под прошлым днём.
+        """
+        today = _today()
+        if today != self.day:
+            if self._db is not None:
+                if self._pending:
+                    self._rolled.append((self.day, self._pending))
+            elif self._pending or self._unsaved:
+                usage = {key: list(counters) for key, counters in self._base.items()}
+                _add_counters(usage, self._pending)
+                self._rolled.append((self.day, usage))
+            self.day = today
+            self._base = {}
+            self._pending = {}
+            self._unsaved = False
+
+    def _checks(self, user_id: int, chat_id: int) -> List[Tuple[str, int]]:
+        return [
+            (key, limit)
+            for key, limit in (
+                (f"user:{user_id}", self.user_limit),
+                (f"chat:{chat_id}", self.chat_limit),
+                ("global", self.global_limit),
+            )
+            if limit > 0
+        ]
+
+    def used(self, key: str) -> float:
+        """Стоимость токенов ключа за сутки, включая зарезервированные."""
+        cost = self._reserved.get(key, 0.0)
+        for counters in (self._base.get(key), self._pending.get(key)):
+            if counters:
+                cost += token_cost(counters[0], counters[1], counters[2])
+        return cost
+
+    def estimate(self, text: str) -> Tuple[int, float]:
+        """Оценка запроса: токены текста и стоимость с контекстом и ответом."""
+        text_tokens = len(text) // TOKEN_ESTIMATE_CHARS + 1
+        return text_tokens, token_cost(text_tokens + self._input_overhead, self._output_estimate)
+
+    def reserve(self, user_id: int, chat_id: int, text: str) -> Optional[Reservation]:
+        """Резервирует оценку запроса. None - запрос не укладывается в квоту."""
+        self._roll_day()
+        checks = self._checks(user_id, chat_id)
+        text_tokens, cost = self.estimate(text)
+        for key, limit in checks:
+            if self.used(key) + cost > limit:
+                logging.info(f"Token quota exceeded for {key}: {self.used(key):.0f}/{limit}")
+                return None
+
+        keys = [key for key, _ in checks]
+        for key in keys:
+            self._reserved[key] = self._reserved.get(key, 0.0) + cost
+        return Reservation(keys=keys, text_tokens=text_tokens, cost=cost)
+
+    def release(self, reservation: Reservation):
+        """Снимает резерв (запрос не выполнен или уже учтён)."""
+        if not reservation.active:
+            return
+        reservation.active = False
+        for key in reservation.keys:
+            left = self._reserved.get(key, 0.0) - reservation.cost
+            if left > 1e-6:
+                self._reserved[key] = left
+            else:
+                self._reserved.pop(key, None)
+
+    def commit(self, reservation: Reservation, user_id: int, chat_id: int, usage: TokenUsage):
+        """Учитывает фактический usage ответа вместо резерва."""
+        self.release(reservation)
+        self.record(user_id, chat_id, usage)
+
+        # Уточняем оценку следующих запросов по фактическому ответу
+        overhead = max(usage.input_tokens - reservation.text_tokens, 0)
+        self._input_overhead += _ESTIMATE_ALPHA * (overhead - self._input_overhead)
+        self._output_estimate += _ESTIMATE_ALPHA * (usage.output_tokens - self._output_estimate)
+
+    def partial_usage(self, reservation: Reservation, output_text: str) -> TokenUsage:
+        """Оценка usage ответа, прерванного после вывода output_text.
+
+        Если модель успела начать ответ, контекст уже обработан: ввод
+        оценивается как при резерве, вывод - по длине полученного текста.
+        """
+        if not output_text:
+            return TokenUsage()
+        return TokenUsage(
+            input_tokens=round(reservation.text_tokens + self._input_overhead),
+            output_tokens=len(output_text) // TOKEN_ESTIMATE_CHARS + 1,
+        )
+
+    def record(self, user_id: int, chat_id: int, usage: TokenUsage):
+        """Учитывает usage запроса без резерва (служебные запросы, например summary)."""
+        self._roll_day()
+        counters = [usage.input_tokens, usage.output_tokens, usage.cached_tokens]
+        _add_counters(
+            self._pending,
+            {key: counters for key in (f"user:{user_id}", f"chat:{chat_id}", "global")},
+        )
+
+    def _read_db(self, day: str) -> Dict[str, Counters]:
+        rows = self._db.execute(
+            "SELECT key, input_tokens, output_tokens, cached_tokens FROM token_usage "
+            "WHERE day = ?",
+            (day,),
+        ).fetchall()
+        return {key: [input_tokens, output_tokens, cached_tokens]
+                for key, input_tokens, output_tokens, cached_tokens in rows}
+
+    def _write_db(self, day: str, pending: Dict[str, Counters]) -> Dict[str, Counters]:
+        """Прибавляет изменения к общей таблице и возвращает итоги всех воркеров"""
+        rows = [(day, key, *counters) for key, counters in pending.items()]
+        with self._write_lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany(
+                    "INSERT INTO token_usage "
+                    "(day, key, input_tokens, output_tokens, cached_tokens) "
+                    "VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (day, key) DO UPDATE SET "
+                    "input_tokens = input_tokens + excluded.input_tokens, "
+                    "output_tokens = output_tokens + excluded.output_tokens, "
+                    "cached_tokens = cached_tokens + excluded.cached_tokens",
+                    rows,
+                )
+                self._db.execute("DELETE FROM token_usage WHERE day < ?", (day,))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            return self._read_db(day)
+
+    def _write_file(self, day: str, usage: Dict[str, Counters]):
+        with self._write_lock:
+            write_file_atomic(
+                self.file_path, json.dumps({"day": day, "usage": usage}, ensure_ascii=False)
+            )
+
+    async def _flush_rolled(self):
+        """Записывает изменения прошедших суток (при ошибке - до следующего flush)"""
+        while self._rolled:
+            day, usage = self._rolled.pop(0)
+            try:
+                if self._db is not None:
+                    await asyncio.to_thread(self._write_db, day, usage)
+                else:
+                    await asyncio.to_thread(self._write_file, day, usage)
+            except Exception as e:
+                self._rolled.insert(0, (day, usage))
+                logging.error(f"Error saving token usage for {day}: {e}")
+                return
+
+    async def flush(self):
+        """Сбрасывает накопленный usage на диск вне event loop"""
+        self._roll_day()
+        await self._flush_rolled()
+        day = self.day
+        if self._db is not None:
+            # Итоги перечитываются и без своих изменений - их пишут другие воркеры
+            pending, self._pending = self._pending, {}
+            try:
+                base = await asyncio.to_thread(self._write_db, day, pending)
+            except Exception as e:
+                if day == self.day:
+                    _add_counters(self._pending, pending)
+                elif pending:
+                    self._rolled.append((day, pending))
+                logging.error(f"Error saving token usage: {e}")
+                return
+            if day == self.day:
+                self._base = base
+            return
+
+        if not self._pending and not self._unsaved:
+            return
+        # Списки в base заменяются, а не изменяются, поэтому хватает копии dict
+        for key, counters in self._pending.items():
+            total = self._base.get(key, (0, 0, 0))
+            self._base[key] = [a + b for a, b in zip(total, counters)]
+        self._pending = {}
+        self._unsaved = True
+        try:
+            await asyncio.to_thread(self._write_file, day, dict(self._base))
+            self._unsaved = False
+        except Exception as e:
+            logging.error(f"Error saving token usage: {e}")
+
+
+def _add_counters(target: Dict[str, Counters], source: Dict[str, Counters]):
+    for key, counters in source.items():
+        total = target.setdefault(key, [0, 0, 0])
+        for i, value in enumerate(counters):
+            total[i] += value
+
+
+def create_token_quota() -> TokenQuota:
+    """Создаёт учёт токенов: JSON-файл или общая SQLite при нескольких воркерах.
+
+    Квоты следуют за настройками: при их смене счётчики сохраняются.
+    """
+    quota = TokenQuota(db_path=SHARED_STATE_PATH if WORKER_COUNT > 1 else None)
+
+    @on_settings_reload
+    def _update_limits(old: Settings, new: Settings):
+        quota.user_limit = new.token_quota_user_daily
+        quota.chat_limit = new.token_quota_chat_daily
+        quota.global_limit = new.token_quota_global_daily
+
+    return quota
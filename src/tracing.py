@@ -0,0 +1,230 @@
+"""Трассировка обработки сообщения по этапам.
+
+Trace создаётся на сообщение, прошедшее проверку доступа, и собирает
+спаны этапов (access, queue_wait, openai, citations, resolve_filenames,
+send) с атрибутами. Законченная трассировка уходит в Sentry (если задан
+SENTRY_DSN, с его выборкой traces_sample_rate) или строкой JSON в
+TRACE_EXPORT_PATH. Запрос дольше SLOW_REQUEST_THRESHOLD секунд пишется в
+лог с разбивкой по этапам независимо от экспорта.
+"""
+import asyncio
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional
+
+import sentry_sdk
+
+from config import SENTRY_DSN, SLOW_REQUEST_THRESHOLD, TRACE_EXPORT_PATH, TRACE_SAMPLE_RATE
+from log_pipeline import create_file_logger, get_request_id
+from metrics import Counter
+
+SLOW_REQUESTS = Counter(
+    "bot_slow_requests_total", "Messages processed slower than SLOW_REQUEST_THRESHOLD"
+)
+
+# Спан, к которому относится текущая работа задачи
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+_exporter: Optional[logging.Logger] = None
+
+
+class Span:
+    """Интервал этапа обработки с атрибутами и вложенными этапами."""
+
+    __slots__ = ("trace", "name", "start", "end", "attributes", "children", "_sentry")
+
+    def __init__(self, trace: "Trace", name: str, start: float, sentry_parent=None):
+        self.trace = trace
+        self.name = name
+        self.start = start
+        self.end: Optional[float] = None
+        self.attributes: Dict[str, Any] = {}
+        self.children: List["Span"] = []
+        self._sentry = (
+            sentry_parent.start_child(op=name, start_timestamp=trace.wall(start))
+            if sentry_parent is not None
+            else None
+        )
+
+    def set(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def incr(self, key: str, value: int = 1):
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def child(self, name: str, start: Optional[float] = None) -> "Span":
+        if start is None:
+            start = time.perf_counter()
+        span = Span(self.trace, name, start, self._sentry)
+        self.children.append(span)
+        return span
+
+    def finish(self, end: Optional[float] = None):
+        if self.end is not None:
+            return
+        self.end = time.perf_counter() if end is None else end
+        if self._sentry is not None:
+            for key, value in self.attributes.items():
+                self._sentry.set_data(key, value)
+            self._sentry.finish(end_timestamp=self.trace.wall(self.end))
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def to_dict(self, origin: float) -> dict:
+        entry = {
+            "name": self.name,
+            "offset_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round(self.duration * 1000, 3),
+        }
+        if self.attributes:
+            entry["attributes"] = self.attributes
+        if self.children:
+            entry["spans"] = [child.to_dict(origin) for child in self.children]
+        return entry
+
+
+class Trace:
+    """Трассировка одного сообщения; корневой спан - сама обработка."""
+
+    __slots__ = ("request_id", "wall_start", "perf_start", "root", "_sentry", "exported")
+
+    def __init__(self, name: str, start: float, exported: bool, **attributes):
+        self.request_id = get_request_id()
+        self.perf_start = start
+        self.wall_start = time.time() - (time.perf_counter() - start)
+        self.exported = exported
+        self._sentry = (
+            sentry_sdk.start_transaction(
+                op="bot.message", name=name, start_timestamp=self.wall(start)
+            )
+            if SENTRY_DSN
+            else None
+        )
+        self.root = Span(self, name, start)
+        self.root._sentry = self._sentry
+        self.root.attributes.update(attributes)
+
+    def wall(self, perf: float) -> datetime:
+        return datetime.fromtimestamp(self.wall_start + perf - self.perf_start, timezone.utc)
+
+    def set(self, key: str, value: Any):
+        self.root.set(key, value)
+
+    def record(self, name: str, start: float, end: Optional[float] = None) -> Span:
+        """Добавляет уже прошедший этап (например, ожидание в очереди)."""
+        span = self.root.child(name, start)
+        span.finish(end)
+        return span
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        """Этап внутри текущего спана задачи (или корня трассировки)."""
+        parent = _current_span.get()
+        if parent is None or parent.trace is not self:
+            parent = self.root
+        span = parent.child(name)
+        span.attributes.update(attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set("error", type(e).__name__)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.finish()
+
+    @contextmanager
+    def activate(self) -> Iterator["Trace"]:
+        """Делает корень трассировки текущим спаном задачи."""
+        token = _current_span.set(self.root)
+        try:
+            yield self
+        finally:
+            _current_span.reset(token)
+
+    def finish(self):
+        """Завершает трассировку: экспорт и журнал медленных запросов."""
+        if self.root.end is not None:
+            return
+        self.root.finish()
+        duration = self.root.duration
+        if SLOW_REQUEST_THRESHOLD > 0 and duration >= SLOW_REQUEST_THRESHOLD:
+            SLOW_REQUESTS.inc()
+            logging.warning(f"Slow request {self.request_id}: {duration:.2f}s, {self.breakdown()}")
+        if _exporter is not None and self.exported:
+            _exporter.info(json.dumps(self.to_dict(), ensure_ascii=False, default=str))
+
+    def finish_after(self, future: asyncio.Future, name: str = "send"):
+        """Завершает трассировку, когда отправка в outbox выполнена."""
+        span = self.root.child(name)
+
+        def done(future: asyncio.Future):
+            if future.cancelled():
+                span.set("error", "cancelled")
+            elif future.exception() is not None:
+                span.set("error", type(future.exception()).__name__)
+            span.finish()
+            self.finish()
+
+        future.add_done_callback(done)
+
+    def breakdown(self) -> str:
+        """Этапы в виде "access 0.001s, openai 12.400s (...)" для лога."""
+        def describe(span: Span) -> str:
+            text = f"{span.name} {span.duration:.3f}s"
+            if span.children:
+                text += f" ({', '.join(describe(child) for child in span.children)})"
+            return text
+        stages = ", ".join(describe(child) for child in self.root.children)
+        attributes = " ".join(f"{key}={value}" for key, value in self.root.attributes.items())
+        return f"{attributes}; {stages}"
+
+    def to_dict(self) -> dict:
+        entry = {
+            "request_id": self.request_id,
+            "time": self.wall(self.perf_start).isoformat(timespec="milliseconds"),
+        }
+        entry.update(self.root.to_dict(self.perf_start))
+        return entry
+
+
+def start_trace(name: str, start: Optional[float] = None, **attributes) -> Trace:
+    """Начинает трассировку сообщения (start - время perf_counter начала)."""
+    return Trace(
+        name,
+        time.perf_counter() if start is None else start,
+        exported=TRACE_SAMPLE_RATE >= 1 or random.random() < TRACE_SAMPLE_RATE,
+        **attributes,
+    )
+
+
+def current_span() -> Optional[Span]:
+    """Текущий спан задачи (None - вне трассировки)."""
+    return _current_span.get()
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """Вложенный этап текущей трассировки; вне трассировки ничего не делает."""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    with parent.trace.span(name, **attributes) as child:
+        yield child
+
+
+def setup_tracing():
+    """Включает локальный экспорт трассировок (без SENTRY_DSN)."""
+    global _exporter
+    if TRACE_EXPORT_PATH and not SENTRY_DSN:
+        _exporter = create_file_logger("bot.traces", TRACE_EXPORT_PATH)
+        logging.info(f"Traces are exported to {TRACE_EXPORT_PATH}")
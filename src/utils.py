@@ -1,59 +1,140 @@
-"""Утилиты бота - логирование и очистка ответов."""
-import logging
+"""Утилиты бота - разбивка сообщений, запись файлов, очистка ответов."""
 import os
 import re
-from logging.handlers import TimedRotatingFileHandler
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+from typing import Sequence
 
-from config import REMOVE_CHUNK_MARKERS, REMOVE_CHUNKS_FOR_FILES
+from config import Settings, get_settings, on_settings_reload
 
 
-def setup_logging():
-    """Настройка логирования с ежедневной ротацией."""
-    log_dir = "/app/logs"
-    log_file = os.path.join(log_dir, "bot.log")
+TELEGRAM_MESSAGE_LIMIT = 4096
 
-    formatter = logging.Formatter(
-        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-    )
 
-    file_handler = TimedRotatingFileHandler(
-        log_file,
-        when="midnight",
-        interval=1,
-        backupCount=7,
-        encoding="utf-8",
-    )
-    file_handler.setFormatter(formatter)
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list[str]:
+    """Разбивает длинное сообщение на части."""
+    if len(text) <= limit:
+        return [text]
 
-    root_logger = logging.getLogger()
-    root_logger.setLevel(logging.INFO)
-    root_logger.addHandler(file_handler)
+    parts = []
+    while text:
+        if len(text) <= limit:
+            parts.append(text)
+            break
 
+        # Ищем место для разбивки (по переносу строки или пробелу)
+        split_pos = text.rfind('\n', 0, limit)
+        if split_pos == -1 or split_pos < limit // 2:
+            split_pos = text.rfind(' ', 0, limit)
+        if split_pos == -1 or split_pos < limit // 2:
+            split_pos = limit
 
-async def clean_response(response: str) -> str:
-    """Очищает ответ модели от технических метаданных."""
-    cleaned = response
+        parts.append(text[:split_pos])
+        text = text[split_pos:].lstrip()
+
+    return parts
+
+
+def write_file_atomic(path: Path, content: str):
+    """Атомарно записывает файл: временный файл в той же директории + rename."""
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp_file:
+            tmp_file.write(content)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+# Маркер чанка file_search: 【4:0†filename】
+_CHUNK_MARKER_RE = re.compile(r"【\d+:\d+†([^】]+)】")
+# Участок из нескольких пробельных символов (одиночные не меняются)
+_WHITESPACE_RUN_RE = re.compile(r"\s{2,}")
+
+_MULTI_SPACE_RE = re.compile(r" +")
+_MULTI_NEWLINE_RE = re.compile(r"\n\s*\n\s*\n")
+_SPACE_BEFORE_NEWLINE_RE = re.compile(r" +\n")
+_SPACE_AFTER_NEWLINE_RE = re.compile(r"\n +")
+
+
+@lru_cache(maxsize=1024)
+def _normalize_whitespace_run(run: str) -> str:
+    """Нормализует один участок пробельных символов.
+
+    Правила (схлопывание пробелов, не больше одной пустой строки подряд,
+    без пробелов по краям строк) затрагивают только пробельные символы и
+    не объединяют соседние участки, поэтому их можно применять к каждому
+    участку отдельно, а результат кэшировать.
+    """
+    run = _MULTI_SPACE_RE.sub(" ", run)
+    run = _MULTI_NEWLINE_RE.sub("\n\n", run)
+    run = _SPACE_BEFORE_NEWLINE_RE.sub("\n", run)
+    return _SPACE_AFTER_NEWLINE_RE.sub("\n", run)
+
+
+def _replace_whitespace_run(match: re.Match) -> str:
+    return _normalize_whitespace_run(match.group(0))
 
-    # Если в списке есть звездочка, удаляем все чанки
-    if "*" in REMOVE_CHUNKS_FOR_FILES:
-        cleaned = re.sub(r"[\d+:\d+[^]]+]", "", cleaned)
-        return cleaned.strip()
 
-    # Иначе обрабатываем по файлам
-    for filename in REMOVE_CHUNKS_FOR_FILES:
-        filename = filename.strip()
-        if filename:
-            cleaned = re.sub(r"[\d+:\d+" + re.escape(filename) + r"]", "", cleaned)
+class ChunkCleaner:
+    """Очистка ответа от маркеров чанков file_search.
 
-    if REMOVE_CHUNK_MARKERS:
-        cleaned = re.sub(
-            r"[\d+:\d+([^]]+)]", lambda m: f" ({m.group(1)}) ", cleaned
+    Правила из REMOVE_CHUNKS_FOR_FILES компилируются один раз (и заново при
+    смене настроек): маркеры обрабатываются одним регулярным выражением с
+    проверкой имени файла по множеству, пробелы нормализуются вторым проходом.
+    """
+
+    def __init__(self, remove_for_files: Sequence[str], rewrite_markers: bool):
+        # Звёздочка - удалять маркеры всех файлов
+        self.remove_all = "*" in remove_for_files
+        self.remove_for_files = frozenset(
+            filename.strip() for filename in remove_for_files if filename.strip()
         )
+        self.rewrite_markers = rewrite_markers
+
+    def _replace_marker(self, match: re.Match) -> str:
+        filename = match.group(1)
+        if filename in self.remove_for_files:
+            return ""
+        if self.rewrite_markers:
+            return f" ({filename}) "
+        return match.group(0)
+
+    def clean(self, response: str) -> str:
+        """Очищает ответ модели от технических метаданных."""
+        if self.remove_all:
+            return _CHUNK_MARKER_RE.sub("", response).strip()
+
+        cleaned = _CHUNK_MARKER_RE.sub(self._replace_marker, response)
+
+        # Исправляем множественные пробелы и переносы строк
+        cleaned = _WHITESPACE_RUN_RE.sub(_replace_whitespace_run, cleaned)
+
+        return cleaned.strip()
 
-    # Исправляем множественные пробелы и переносы строк
-    cleaned = re.sub(r" +", " ", cleaned)
-    cleaned = re.sub(r"\n\s*\n\s*\n", "\n\n", cleaned)
-    cleaned = re.sub(r" +\n", "\n", cleaned)
-    cleaned = re.sub(r"\n +", "\n", cleaned)
 
-    return cleaned.strip()
+_chunk_cleaner = ChunkCleaner(
+    get_settings().remove_chunks_for_files, get_settings().remove_chunk_markers
+)
+
+
+@on_settings_reload
+def _recompile_chunk_cleaner(old: Settings, new: Settings):
+    global _chunk_cleaner
+    if (old.remove_chunks_for_files, old.remove_chunk_markers) != (
+        new.remove_chunks_for_files, new.remove_chunk_markers
+    ):
+        _chunk_cleaner = ChunkCleaner(new.remove_chunks_for_files, new.remove_chunk_markers)
+
+
+async def clean_response(response: str) -> str:
+    """Очищает ответ модели от технических метаданных."""
+    return _chunk_cleaner.clean(response)